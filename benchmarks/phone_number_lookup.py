@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+#
+# Benchmark the lookup of inbound phone numbers in our service area: the in-memory
+# E.164 prefix trie (AreaCode.lookup_phone_number) against the per-message database
+# query that it replaced.
+#
+# Like smircd.py, this requires the DJANGO_SETTINGS_MODULE environment variable to
+# be set, and the database that it points at to have been synchronized:
+#
+#	export DJANGO_SETTINGS_MODULE="smirc.settings"
+#	python benchmarks/phone_number_lookup.py [number of lookups]
+#
+import logging
+import os
+import random
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from smirc.message.models import AreaCode
+
+def database_lookup(s):
+	try:
+		AreaCode.objects.get(area_code__exact=s[1:4], country_code__exact=s[0])
+		return True
+	except AreaCode.DoesNotExist:
+		return False
+
+def phone_numbers(count):
+	"""A mix of phone numbers that is roughly what we see in production: mostly
+	numbers from within our service area, with some (international) spam.
+	"""
+	area_codes = ['%d%03d' % (country_code, area_code) for (country_code, area_code) in AreaCode.objects.values_list('country_code', 'area_code')]
+	numbers = []
+	for _unused_i in xrange(count):
+		if random.random() < 0.8:
+			numbers.append('%s%07d' % (random.choice(area_codes), random.randint(0, 9999999)))
+		else:
+			numbers.append('%d%010d' % (random.randint(2, 99), random.randint(0, 9999999999)))
+	return numbers
+
+def benchmark(name, func, numbers):
+	start = time.time()
+	for number in numbers:
+		func(number)
+	elapsed = time.time() - start
+	print '%-24s %8d lookups in %8.3f seconds, %10.2f microseconds/lookup' % (name, len(numbers), elapsed, elapsed * 1000000 / len(numbers))
+	return elapsed
+
+if __name__ == '__main__':
+	logging.disable(logging.WARNING)
+	count = 10000
+	if len(sys.argv) > 1:
+		count = int(sys.argv[1])
+	numbers = phone_numbers(count)
+
+	start = time.time()
+	AreaCode.load_index()
+	print '%-24s %8d prefixes in %8.3f seconds' % ('load_index', len(AreaCode.index), time.time() - start)
+	database = benchmark('database query', database_lookup, numbers)
+	trie = benchmark('prefix trie', AreaCode.lookup_phone_number, numbers)
+	print 'prefix trie is %.1fx faster than the database query' % (database / trie)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+#
+# End-to-end throughput benchmark of smircd: generates a synthetic mix of SMSTools
+# inbound message files (chat, commands, Unicode chat, out-of-area and malformed
+# messages), runs them through smircd against a spool and a SQLite database on tmpfs
+# (/dev/shm, when it is available), and reports the throughput, the per-message
+# latency distribution (from the moment that a file is dropped into the inbound
+# directory until smircd has archived it), the per-stage latencies and database
+# queries per message (from smircd's stats files) and the number of outbound message
+# files produced, as JSON.
+#
+# Everything that the benchmark needs (settings, database, spool) is created in a
+# run directory of its own, so it does not need DJANGO_SETTINGS_MODULE to be set:
+#
+#	python benchmarks/smircd_throughput.py --messages 2000 --workers 4 --output run.json
+#	python benchmarks/smircd_throughput.py --mix chat=50,unicode=50 --rate 200
+#
+import json
+import optparse
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SETTINGS = """from smirc.settings import *
+DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': '%(run_dir)s/smirc.db'}}
+SMIRC_STATS = dict(SMIRC_STATS, interval=1, stats_dir='%(run_dir)s/stats')
+SMSTOOLS = dict(SMSTOOLS,
+	archive_dir='%(run_dir)s/archive',
+	inbound_dir='%(run_dir)s/incoming',
+	outbound_dir='%(run_dir)s/outgoing',
+	outbound_staging_dir='%(run_dir)s/staging',
+	worker_processes=%(workers)d)
+"""
+
+# The kinds of message in a mix, and the default mix.
+KINDS = ['chat', 'command', 'malformed', 'out_of_area', 'unicode']
+MIX = 'chat=70,command=10,unicode=10,out_of_area=5,malformed=5'
+
+def parse_mix(s):
+	mix = []
+	for item in s.split(','):
+		(kind, weight) = item.split('=')
+		if not kind in KINDS:
+			raise ValueError('unknown message kind %s (known kinds: %s)' % (kind, ', '.join(KINDS)))
+		mix.append((kind, int(weight)))
+	return mix
+
+def choose(mix):
+	r = random.randint(1, sum([weight for (_unused_kind, weight) in mix]))
+	for (kind, weight) in mix:
+		r -= weight
+		if r <= 0:
+			return kind
+
+def message_file(kind, users, i):
+	"""The contents of a synthetic inbound message file of the given kind."""
+	(phone_number, conversation) = random.choice(users)
+	if kind == 'chat':
+		if random.random() < 0.5:
+			return 'From: %d\nAlphabet: ISO\n\nmessage %d to my default conversation' % (phone_number, i)
+		return 'From: %d\nAlphabet: ISO\n\n@%s message %d' % (phone_number, conversation, i)
+	if kind == 'command':
+		return 'From: %d\nAlphabet: ISO\n\n/who %s' % (phone_number, conversation)
+	if kind == 'unicode':
+		return 'From: %d\nAlphabet: UCS2\n\n' % (phone_number) + (u'@%s \u263a \u4f60\u597d %d' % (conversation, i)).encode('utf-16-be')
+	if kind == 'out_of_area':
+		return 'From: 44%010d\nAlphabet: ISO\n\nmessage %d from abroad' % (random.randint(0, 9999999999), i)
+	if random.random() < 0.5:
+		return 'Alphabet: ISO\n\nmessage %d without a sender' % (i)
+	return 'From: %d\nmessage %d without a body' % (phone_number, i)
+
+def percentiles(values):
+	values = sorted(values)
+	if len(values) == 0:
+		return {}
+	stats = { 'max': values[-1], 'mean': sum(values) / len(values) }
+	for p in [50, 90, 95, 99]:
+		stats['p%d' % (p)] = values[min(len(values) - 1, int(len(values) * p / 100.0))]
+	return stats
+
+def setup(run_dir, options):
+	"""Write our settings, synchronize our database and register our users
+	and conversations.  Returns a list of (phone number, conversation name)
+	tuples, one for each user.
+	"""
+	for directory in ['archive', 'incoming', 'outgoing', 'staging', 'stats', 'queued']:
+		os.mkdir('%s/%s' % (run_dir, directory))
+	with open('%s/benchmark_settings.py' % (run_dir), 'w') as f:
+		f.write(SETTINGS % { 'run_dir': run_dir, 'workers': options.workers })
+	os.environ['DJANGO_SETTINGS_MODULE'] = 'benchmark_settings'
+	os.environ['PYTHONPATH'] = os.pathsep.join([run_dir, REPOSITORY, '%s/smirc' % (REPOSITORY)] + [path for path in [os.environ.get('PYTHONPATH')] if path])
+	sys.path[0:0] = [run_dir, REPOSITORY, '%s/smirc' % (REPOSITORY)]
+
+	from django.contrib.auth.models import User
+	from django.core.management import call_command
+	from django.db import connection
+	from smirc.chat.models import Conversation
+	from smirc.chat.models import Membership
+	from smirc.chat.models import UserProfile
+	call_command('syncdb', interactive=False, verbosity=0)
+
+	conversations = []
+	for i in xrange(options.conversations):
+		conversation = Conversation(name='room%d' % (i))
+		conversation.save()
+		conversations.append(conversation)
+	users = []
+	for i in xrange(options.users):
+		user = User(username='user%d' % (i))
+		user.save()
+		UserProfile(phone_number=17804550000 + i, user=user).save()
+		conversation = conversations[i % len(conversations)]
+		Membership(conversation=conversation, user=user).save()
+		users.append((17804550000 + i, conversation.name))
+	connection.close()
+	return users
+
+def wait_for(predicate, timeout, process):
+	deadline = time.time() + timeout
+	while not predicate():
+		if process.poll() is not None:
+			raise RuntimeError('smircd exited with status %d' % (process.returncode))
+		if time.time() > deadline:
+			raise RuntimeError('timed out after %d seconds' % (timeout))
+		time.sleep(0.01)
+
+def run(run_dir, options):
+	mix = parse_mix(options.mix)
+	users = setup(run_dir, options)
+	inbound_dir = '%s/incoming' % (run_dir)
+
+	# Generate every message before smircd starts, so that generating them is not
+	# part of what we measure.
+	kinds = {}
+	for i in xrange(options.messages):
+		kind = choose(mix)
+		kinds[kind] = kinds.get(kind, 0) + 1
+		with open('%s/queued/GSM1.%06d' % (run_dir, i), 'wb') as f:
+			f.write(message_file(kind, users, i))
+
+	log = open('%s/smircd.log' % (run_dir), 'w')
+	process = subprocess.Popen([sys.executable, '%s/smircd.py' % (REPOSITORY)], stdout=log, stderr=subprocess.STDOUT)
+	try:
+		wait_for(lambda: os.path.exists('%s/stats/smircd.json' % (run_dir)), 60, process)
+		# Warm up (and make sure that smircd is processing new messages) with a
+		# single chat message.
+		with open('%s/warmup' % (inbound_dir), 'wb') as f:
+			f.write(message_file('chat', users, -1))
+		wait_for(lambda: not os.path.exists('%s/warmup' % (inbound_dir)), 60, process)
+
+		dropped = {}
+		def drop():
+			for i in xrange(options.messages):
+				if options.rate:
+					delay = start + float(i) / options.rate - time.time()
+					if delay > 0:
+						time.sleep(delay)
+				filename = 'GSM1.%06d' % (i)
+				now = time.time()
+				os.rename('%s/queued/%s' % (run_dir, filename), '%s/%s' % (inbound_dir, filename))
+				# Only once it is in the inbound directory can its absence mean that
+				# it has been processed.
+				dropped[filename] = now
+		start = time.time()
+		dropper = threading.Thread(target=drop)
+		dropper.start()
+
+		latencies = []
+		processed = set()
+		deadline = time.time() + options.timeout
+		while len(latencies) < options.messages:
+			if process.poll() is not None:
+				raise RuntimeError('smircd exited with status %d' % (process.returncode))
+			if time.time() > deadline:
+				raise RuntimeError('timed out with %d message(s) unprocessed' % (options.messages - len(latencies)))
+			now = time.time()
+			present = set(os.listdir(inbound_dir))
+			for filename in dropped.keys():
+				if not filename in present and not filename in processed:
+					processed.add(filename)
+					latencies.append((now - dropped[filename]) * 1000)
+			time.sleep(options.poll)
+		elapsed = time.time() - start
+		dropper.join()
+	finally:
+		if process.poll() is None:
+			os.kill(process.pid, signal.SIGTERM)
+			process.wait()
+		log.close()
+
+	stats = {}
+	for filename in os.listdir('%s/stats' % (run_dir)):
+		if filename.endswith('.json'):
+			with open('%s/stats/%s' % (run_dir, filename)) as f:
+				stats[filename[:-len('.json')]] = json.load(f)
+	counters = {}
+	queries = 0
+	timed = 0
+	for process_stats in stats.values():
+		for (name, value) in process_stats['counters'].items():
+			counters[name] = counters.get(name, 0) + value
+		queries += process_stats['queries_per_message']['total']
+		timed += process_stats['queries_per_message']['count']
+
+	return {
+		'config': {
+			'conversations': options.conversations,
+			'messages': options.messages,
+			'mix': dict(mix),
+			'rate': options.rate,
+			'users': options.users,
+			'workers': options.workers
+		},
+		# Including the warm-up message.
+		'counters': counters,
+		'elapsed_seconds': elapsed,
+		'latency_ms': percentiles(latencies),
+		'messages': kinds,
+		'messages_per_second': options.messages / elapsed,
+		'outbound_files': len(os.listdir('%s/outgoing' % (run_dir))),
+		'queries_per_message': float(queries) / max(timed, 1),
+		'stages': dict([(name, process_stats['stages']) for (name, process_stats) in stats.items()]),
+		'time': time.time()
+	}
+
+if __name__ == '__main__':
+	parser = optparse.OptionParser(usage='%prog [options]')
+	parser.add_option('--conversations', type='int', default=20, help='number of conversations (default: %default)')
+	parser.add_option('--keep', action='store_true', default=False, help='keep the run directory (settings, database, spool and smircd log)')
+	parser.add_option('--messages', type='int', default=1000, help='number of messages (default: %default)')
+	parser.add_option('--mix', default=MIX, help='message mix, as kind=weight pairs (default: %default)')
+	parser.add_option('--output', help='file to write the JSON results to (default: standard output)')
+	parser.add_option('--poll', type='float', default=0.005, help='seconds between polls of the inbound directory (default: %default)')
+	parser.add_option('--rate', type='float', default=0, help='messages per second to drop into the inbound directory (default: all at once)')
+	parser.add_option('--seed', type='int', default=0, help='random seed (default: %default)')
+	parser.add_option('--spool', default=os.path.isdir('/dev/shm') and '/dev/shm' or None, help='directory to create the run directory in (default: %default)')
+	parser.add_option('--timeout', type='float', default=600, help='seconds to wait for smircd to process every message (default: %default)')
+	parser.add_option('--users', type='int', default=200, help='number of registered users (default: %default)')
+	parser.add_option('--workers', type='int', default=4, help='number of smircd worker processes (default: %default)')
+	(options, args) = parser.parse_args()
+
+	random.seed(options.seed)
+	run_dir = tempfile.mkdtemp(prefix='smircd-benchmark-', dir=options.spool)
+	try:
+		results = run(run_dir, options)
+	finally:
+		if options.keep:
+			print >> sys.stderr, 'run directory: %s' % (run_dir)
+		else:
+			shutil.rmtree(run_dir)
+
+	print >> sys.stderr, '%d messages in %.3f seconds, %.1f messages/second, latency p50 %.1f ms, p99 %.1f ms, %.2f queries/message, %d outbound files' % (options.messages, results['elapsed_seconds'], results['messages_per_second'], results['latency_ms']['p50'], results['latency_ms']['p99'], results['queries_per_message'], results['outbound_files'])
+	if options.output:
+		with open(options.output, 'w') as f:
+			json.dump(results, f, indent=1, sort_keys=True)
+	else:
+		json.dump(results, sys.stdout, indent=1, sort_keys=True)
+		print
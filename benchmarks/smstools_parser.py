@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+#
+# Benchmark the parsing of inbound SMSTools message files: the single-pass parser
+# (smirc.message.smstools.parse_message_file) against the line-by-line parser that
+# SMSToolsMessage.raw_receive used before it.  Files of each kind (ISO, UCS2,
+# malformed and large) are written to a temporary directory and parsed repeatedly.
+#
+# The parser does not use the database, so unlike smircd.py this does not need the
+# DJANGO_SETTINGS_MODULE environment variable to be set:
+#
+#	python benchmarks/smstools_parser.py [number of parses per file]
+#
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from smirc.message.smstools import parse_message_file
+
+HEADERS = 'From: 17805551234\nFrom_TOA: 91 international, ISDN/telephone\nFrom_SMSC: 17807605200\nSent: 10-10-18 12:34:56\nReceived: 10-10-18 12:34:59\nSubject: GSM1\nModem: GSM1\nIMSI: 302720123456789\nReport: no\n'
+
+MESSAGES = {
+	'iso': HEADERS + 'Alphabet: ISO\nLength: 26\n\n@room hello there everyone',
+	'ucs2': HEADERS + 'Alphabet: UCS2\nLength: 14\n\n' + u'@room \u4f60\u597d \u263a everyone'.encode('utf-16-be'),
+	# Invalid headers and no empty line between the headers and the body.
+	'malformed': HEADERS + 'Alphabet ISO\nthis is not a header\n@room hello there everyone',
+	# A large body, after headers that end with "\n" only.
+	'large': HEADERS + 'Alphabet: ISO\n\n' + ('x' * 2097152)
+}
+
+def line_parser(location):
+	body = None
+	headers = {}
+	with open(location, 'r') as f:
+		for line in f:
+			if not body is None:
+				body += line
+			else:
+				if line != '\n':
+					try:
+						(key, value) = line.split(':', 1)
+						key = key.strip().lower()
+						value = value.strip()
+						headers[key] = value
+					except ValueError:
+						pass
+				else:
+					body = ''
+	if body is None:
+		return (headers, None)
+	if headers.get('alphabet') in ['UCS', 'UCS2', 'Chinese', 'Unicode']:
+		return (headers, body.decode('utf-16-be'))
+	return (headers, body.decode('latin-1'))
+
+def benchmark(name, func, location, count):
+	start = time.time()
+	for _unused_i in xrange(count):
+		func(location)
+	elapsed = time.time() - start
+	print '%-10s %-16s %8d parses in %8.3f seconds, %10.2f microseconds/parse' % (os.path.basename(location), name, count, elapsed, elapsed * 1000000 / count)
+	return elapsed
+
+if __name__ == '__main__':
+	logging.disable(logging.WARNING)
+	count = 20000
+	if len(sys.argv) > 1:
+		count = int(sys.argv[1])
+
+	directory = tempfile.mkdtemp()
+	try:
+		for kind in sorted(MESSAGES.keys()):
+			location = '%s/%s' % (directory, kind)
+			with open(location, 'wb') as f:
+				f.write(MESSAGES[kind])
+			if parse_message_file(location) != line_parser(location):
+				print '%-10s parsers disagree' % (kind)
+			lines = benchmark('line-by-line', line_parser, location, count)
+			single = benchmark('single pass', parse_message_file, location, count)
+			print '%-10s single pass parser is %.1fx faster than the line-by-line parser' % (kind, lines / single)
+	finally:
+		shutil.rmtree(directory)
@@ -0,0 +1,96 @@
+import logging
+import threading
+import time
+from django.conf import settings
+from django.db import connection
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+class MembershipActivityBuffer:
+	"""
+	Buffers the last_active times of the memberships that chat messages are
+	sent with (see Membership.mark_active), and writes them with a single
+	UPDATE when max_rows memberships have been buffered, or when the oldest of
+	them has been buffered for max_seconds (see flush_if_stale, which smircd
+	calls periodically).  A burst of messages in a conversation costs one
+	write per membership per flush, rather than one per message.  At most
+	max_rows (or max_seconds worth of) last_active times are lost if the
+	process dies.
+
+	Memberships that are loaded while their last_active time is buffered are
+	given the buffered time (see pending), so what is read does not depend on
+	whether it has been written yet.
+	"""
+	def __init__(self, max_rows, max_seconds):
+		self.flushed = 0
+		self.lock = threading.Lock()
+		self.max_rows = max_rows
+		self.max_seconds = max_seconds
+		self.oldest = None
+		# membership id -> last_active time
+		self.times = {}
+
+	def after_fork(self):
+		"""Forget the last_active times that were buffered by the process that
+		we were forked from (which writes them), along with the lock that one of
+		its threads may have been holding.
+		"""
+		self.lock = threading.Lock()
+		self.oldest = None
+		self.times = {}
+
+	def flush(self):
+		"""Write every buffered last_active time to the database."""
+		with self.lock:
+			times = self.times
+			self.times = {}
+			self.oldest = None
+		if len(times) == 0:
+			return
+		qn = connection.ops.quote_name
+		ids = sorted(times.keys())
+		params = []
+		for membership_id in ids:
+			params.extend([membership_id, connection.ops.value_to_db_datetime(times[membership_id])])
+		params.extend(ids)
+		sql = 'UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (qn(Membership._meta.db_table), qn('last_active'), qn('id'), ' '.join(['WHEN %s THEN %s'] * len(ids)), qn('id'), ', '.join(['%s'] * len(ids)))
+		try:
+			cursor = connection.cursor()
+			cursor.execute(sql, params)
+			transaction.commit_unless_managed()
+		except Exception as e:
+			logger.exception('exception occurred while writing %d last_active time(s), discarding them: %s' % (len(times), e))
+			return
+		self.flushed += len(times)
+		logger.debug('wrote %d last_active time(s)', len(times))
+
+	def flush_if_stale(self):
+		"""Write every buffered last_active time to the database if the oldest
+		of them has been buffered for at least max_seconds.
+		"""
+		if self.oldest is not None and time.time() - self.oldest >= self.max_seconds:
+			self.flush()
+
+	def pending(self, membership_id, default=None):
+		"""The buffered last_active time of the given membership, or default if
+		it has none.
+		"""
+		with self.lock:
+			return self.times.get(membership_id, default)
+
+	def record(self, membership):
+		"""Buffer the last_active time of the given membership."""
+		with self.lock:
+			self.times[membership.id] = membership.last_active
+			if self.oldest is None:
+				self.oldest = time.time()
+			full = len(self.times) >= self.max_rows
+		if full:
+			self.flush()
+
+membership_activity = MembershipActivityBuffer(settings.SMIRC_ACTIVITY['flush_rows'], settings.SMIRC_ACTIVITY['flush_seconds'])
+
+# We import smirc.* modules at the bottom (instead of at the top) as a fix for
+# circular import problems.
+from smirc.chat.models import Membership
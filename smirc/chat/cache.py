@@ -0,0 +1,277 @@
+import logging
+import os
+import time
+from django.conf import settings
+from django.db.models.signals import post_save
+from smirc.remiutilities import LRUCache
+
+logger = logging.getLogger(__name__)
+
+class SharedGenerationCache:
+	"""
+	Base class of our in-process caches.  Processes that share a generation
+	counter (see share_generation) clear their caches whenever one of them
+	reports a change to the data that it caches (see changed).
+
+	The processes of other smircd nodes (on other hosts) can't share a
+	counter with us; they share a generation file instead (see
+	share_generation_file), which is checked at most every check_seconds.
+	"""
+	def __init__(self, caches):
+		# The LRUCache instances that make up this cache.
+		self._caches = caches
+		self.generation = None
+		self.generation_file = None
+		self.generation_file_checked = 0
+		self.generation_file_check_seconds = 0
+		self.generation_file_token = None
+		self.seen_generation = 0
+
+	def after_fork(self):
+		for cache in self._caches:
+			cache.after_fork()
+
+	def changed(self):
+		"""Tell the processes that we share a generation counter with that they
+		need to clear their caches.
+		"""
+		if self.generation is not None:
+			with self.generation.get_lock():
+				self.generation.value += 1
+				self.seen_generation = self.generation.value
+		if self.generation_file is not None:
+			# Any token that differs from the one that the other nodes last read will
+			# do, so concurrent changes by several nodes need no locking.
+			token = '%s %d %.6f' % (os.uname()[1], os.getpid(), time.time())
+			try:
+				with open('%s.%d.tmp' % (self.generation_file, os.getpid()), 'w') as f:
+					f.write(token)
+				os.rename('%s.%d.tmp' % (self.generation_file, os.getpid()), self.generation_file)
+			except (IOError, OSError) as e:
+				logger.error('could not write cache generation file %s: %s' % (self.generation_file, e))
+				return
+			self.generation_file_token = token
+
+	def check_generation(self):
+		if self.generation is not None and self.generation.value != self.seen_generation:
+			logger.debug('%s generation changed from %d to %d, clearing cache', self.__class__.__name__, self.seen_generation, self.generation.value)
+			self.seen_generation = self.generation.value
+			self.clear()
+		if self.generation_file is not None and time.time() - self.generation_file_checked >= self.generation_file_check_seconds:
+			self.generation_file_checked = time.time()
+			token = self.read_generation_file()
+			if token != self.generation_file_token:
+				logger.debug('%s generation file %s changed, clearing cache', self.__class__.__name__, self.generation_file)
+				self.generation_file_token = token
+				self.clear()
+
+	def clear(self):
+		for cache in self._caches:
+			cache.clear()
+
+	def read_generation_file(self):
+		try:
+			with open(self.generation_file, 'r') as f:
+				return f.read()
+		except IOError:
+			return None
+
+	def share_generation(self, generation):
+		"""Share the given generation counter (a multiprocessing.Value) with the
+		processes that are about to be forked from this one.
+		"""
+		self.generation = generation
+		self.seen_generation = generation.value
+
+	def share_generation_file(self, path, check_seconds):
+		"""Share the given generation file (on a filesystem that every smircd
+		node shares, i.e. in the claim directory) with the other smircd nodes.
+		Changes that the other nodes make are seen within check_seconds.
+		"""
+		self.generation_file = path
+		self.generation_file_check_seconds = check_seconds
+		self.generation_file_token = self.read_generation_file()
+
+class MembershipCache(SharedGenerationCache):
+	"""
+	An in-process cache of conversation rosters and of the memberships of
+	each user, so that resolving the conversation that a message is for (and
+	who to forward it to) does not have to go to the database for every
+	message.
+
+	Entries are invalidated by the Django signals of Membership, Conversation,
+	UserProfile and User (see the bottom of smirc.chat.models) when those rows
+	are changed by this process, and cleared when a process that we share a
+	generation counter with changes them.  Changes that are made by any other
+	process (i.e. the website) are only seen once the entry expires, after
+	SMIRC_CACHE['ttl'] seconds, unless it is a smircd node that shares a
+	generation file with us.
+	"""
+	def __init__(self, max_entries, ttl):
+		# user id -> id of their default conversation (or None)
+		self.defaults = LRUCache(max_entries, ttl)
+		# user id -> list of Membership instances (with conversation and user loaded)
+		self.memberships = LRUCache(max_entries, ttl)
+		# conversation id -> list of (user id, phone number) tuples
+		self.rosters = LRUCache(max_entries, ttl)
+		SharedGenerationCache.__init__(self, [self.defaults, self.memberships, self.rosters])
+
+	def default_conversation_of(self, user_id):
+		"""The id of the default conversation of the given user (see
+		DefaultConversation), or None if they have none.  Every message from a
+		user is handled by the same process of a node (see SMSWorkerPool), so
+		it is cached unless we share a generation file with other nodes, whose
+		messages from the user change it without telling us.
+		"""
+		self.check_generation()
+		if self.generation_file is None:
+			conversation_id = self.defaults.get(user_id, False)
+			if conversation_id is not False:
+				return conversation_id
+		conversation_ids = list(DefaultConversation.objects.filter(user__id__exact=user_id).values_list('conversation', flat=True))
+		if len(conversation_ids) > 0:
+			conversation_id = conversation_ids[0]
+		else:
+			conversation_id = None
+		if self.generation_file is None:
+			self.defaults.set(user_id, conversation_id)
+		return conversation_id
+
+	def default_membership(self, user_id, conversation_id=False):
+		"""The membership of the given user in their default conversation (the
+		given conversation id, if it has already been looked up with
+		default_conversation_of) or, if they have none (or have left it), their
+		most recently active membership.  Raises Membership.DoesNotExist if they
+		have no memberships.
+		"""
+		memberships = self.memberships_of(user_id)
+		if conversation_id is False:
+			conversation_id = self.default_conversation_of(user_id)
+		for membership in memberships:
+			if membership.conversation_id == conversation_id:
+				return membership
+		if len(memberships) == 0:
+			raise Membership.DoesNotExist
+		return max(memberships, key=lambda m: m.last_active)
+
+	def memberships_of(self, user_id):
+		self.check_generation()
+		memberships = self.memberships.get(user_id)
+		if memberships is None:
+			memberships = list(Membership.objects.select_related('conversation', 'user').filter(user__id__exact=user_id))
+			for membership in memberships:
+				# Their last_active times may not have been written yet.
+				membership.last_active = membership_activity.pending(membership.id, membership.last_active)
+			self.memberships.set(user_id, memberships)
+		return memberships
+
+	def roster(self, conversation_id):
+		self.check_generation()
+		roster = self.rosters.get(conversation_id)
+		if roster is None:
+			roster = list(UserProfile.objects.filter(user__membership__conversation__id__exact=conversation_id).values_list('user', 'phone_number'))
+			self.rosters.set(conversation_id, roster)
+		return roster
+
+	def stats(self):
+		return {
+			'defaults': self.defaults.stats(),
+			'memberships': self.memberships.stats(),
+			'rosters': self.rosters.stats()
+		}
+
+	def conversation_changed(self, sender, instance, created=False, **kwargs):
+		if created:
+			return
+		logger.debug('invalidating cached roster and memberships of conversation id:%d', instance.id)
+		self.rosters.discard(instance.id)
+		self.memberships.discard_if(lambda _unused_user_id, memberships: instance.id in [m.conversation_id for m in memberships])
+		self.changed()
+
+	def default_conversation_changed(self, user_id, conversation_id):
+		# Other processes are not told (see default_conversation_of).
+		if self.generation_file is None:
+			self.defaults.set(user_id, conversation_id)
+
+	def membership_changed(self, sender, instance, created=False, **kwargs):
+		if not created and kwargs.get('signal') is post_save:
+			# An existing membership has been updated (i.e. its last_active time or
+			# its modes), which doesn't change who is in the conversation.  If it
+			# is the instance that we have cached then our cache is already current.
+			memberships = self.memberships.peek(instance.user_id)
+			if memberships is None or any([m is instance for m in memberships]):
+				return
+		logger.debug('invalidating cached memberships of user id:%d and roster of conversation id:%d', instance.user_id, instance.conversation_id)
+		self.memberships.discard(instance.user_id)
+		self.rosters.discard(instance.conversation_id)
+		self.changed()
+
+	def user_changed(self, sender, instance, created=False, **kwargs):
+		if created:
+			return
+		# Our cached memberships carry the user, whose username is part of the
+		# attribution of every message that they send.
+		self.memberships.discard(instance.id)
+		self.changed()
+
+	def userprofile_changed(self, sender, instance, **kwargs):
+		logger.debug('invalidating cached rosters that include user id:%d', instance.user_id)
+		self.rosters.discard_if(lambda _unused_conversation_id, roster: instance.user_id in [user_id for (user_id, _unused_phone_number) in roster])
+		self.changed()
+
+class UserCache(SharedGenerationCache):
+	"""
+	An in-process cache of the users that UserProfile.load_user finds by phone
+	number or (lowercased) username.  Lookups that find no user are cached as
+	well, so that a burst of messages from an unregistered phone number does
+	not cost a query each, but only for negative_ttl seconds: users register
+	through the website, whose changes we are not told about.  Entries are
+	invalidated in the same way as those of MembershipCache, by the signals of
+	User and UserProfile.
+	"""
+	# Cached for lookups that did not find a user.
+	NO_USER = None
+
+	def __init__(self, max_entries, ttl, negative_ttl):
+		self.negative_ttl = negative_ttl
+		# phone number or lowercased username -> User (or NO_USER)
+		self.users = LRUCache(max_entries, ttl)
+		SharedGenerationCache.__init__(self, [self.users])
+
+	def get(self, key, default):
+		self.check_generation()
+		return self.users.get(key, default)
+
+	def set(self, key, user):
+		if user is UserCache.NO_USER:
+			self.users.set(key, user, self.negative_ttl)
+		else:
+			self.users.set(key, user)
+
+	def stats(self):
+		return {
+			'users': self.users.stats()
+		}
+
+	def user_changed(self, sender, instance, **kwargs):
+		# The user may have been renamed (or created, or deleted), so forget both
+		# the user's old entries and any negative entry for their new username.
+		logger.debug('invalidating cached lookups of user id:%d (%s)', instance.id, instance.username)
+		self.users.discard_if(lambda _unused_key, user: user is not UserCache.NO_USER and user.id == instance.id)
+		self.users.discard(instance.username.lower())
+		self.changed()
+
+	def userprofile_changed(self, sender, instance, **kwargs):
+		logger.debug('invalidating cached lookups of phone number %s', instance.phone_number)
+		self.users.discard(str(instance.phone_number))
+		self.changed()
+
+membership_cache = MembershipCache(settings.SMIRC_CACHE['max_entries'], settings.SMIRC_CACHE['ttl'])
+user_cache = UserCache(settings.SMIRC_CACHE['max_entries'], settings.SMIRC_CACHE['ttl'], settings.SMIRC_CACHE['negative_ttl'])
+
+# We import smirc.* modules at the bottom (instead of at the top) as a fix for
+# circular import problems.
+from smirc.chat.activity import membership_activity
+from smirc.chat.models import DefaultConversation
+from smirc.chat.models import Membership
+from smirc.chat.models import UserProfile
@@ -19,6 +19,8 @@ class SmircException(Exception):
 class SmircRestrictedNameException(SmircException):
 	pass
 
+PHONE_NUMBER_REGEX = re.compile('^[0-9]+$')
+
 class Conversation(models.Model):
 	name = models.CharField(max_length=16, db_index=True)
 	topic = models.CharField(max_length=64, default='')
@@ -38,6 +40,17 @@ class Conversation(models.Model):
 			raise SmircRestrictedNameException('conversation names may not contain the string "smirc"')
 		return True
 
+class DefaultConversation(models.Model):
+	"""The conversation that a user last sent a chat message to, which their
+	un-targeted chat messages are sent to.  It is a row of its own (keyed by
+	the user) so that following a user from one conversation to another is a
+	single-column update of a single row, and looking it up needs neither a
+	sort of their memberships nor a write to their Membership rows (see
+	Membership.mark_active).
+	"""
+	conversation = models.ForeignKey(Conversation)
+	user = models.OneToOneField(User, primary_key=True, related_name='default_conversation')
+
 class Invitation(models.Model):
 	class Meta:
 		unique_together = (('invitee','conversation'))
@@ -68,6 +81,24 @@ class Membership(models.Model):
 			usermode = ''
 		return '%s%s@%s' % (usermode, self.user.username, self.conversation.name)
 
+	def mark_active(self, default_conversation_id=False):
+		"""Record that a chat message has just been sent with this membership:
+		bump its last_active time (which is buffered, and written in batches by
+		membership_activity) and make its conversation the default conversation
+		of its user (which is a narrow update, and only written when it
+		changes).  The current default conversation of the user is looked up
+		unless the caller already has (see SMSToolsMessage.receive).
+		"""
+		self.last_active = datetime.datetime.utcnow()
+		membership_activity.record(self)
+		if default_conversation_id is False:
+			default_conversation_id = membership_cache.default_conversation_of(self.user_id)
+		if default_conversation_id == self.conversation_id:
+			return
+		if DefaultConversation.objects.filter(user__id__exact=self.user_id).update(conversation=self.conversation_id) == 0:
+			DefaultConversation(conversation_id=self.conversation_id, user_id=self.user_id).save()
+		membership_cache.default_conversation_changed(self.user_id, self.conversation_id)
+
 	@staticmethod
 	def load_membership(u, c):
 		"""A convenience method to load a given membership, given some
@@ -85,9 +116,14 @@ class Membership(models.Model):
 			raise Membership.DoesNotExist
 		assert isinstance(c, str) or isinstance(c, unicode) or isinstance(c, Conversation), "load_membership(u, c): c is not Membership, Conversation, or string: %s" % (type(c)) 
 		if isinstance(c, str) or isinstance(c, unicode):
-			return Membership.objects.get(conversation__name__iexact=c, user__id__exact=u.id)
+			c = c.lower()
+			for membership in membership_cache.memberships_of(u.id):
+				if membership.conversation.name.lower() == c:
+					return membership
 		elif isinstance(c, Conversation):
-			return Membership.objects.get(conversation__id__exact=c.id, user__id__exact=u.id)
+			for membership in membership_cache.memberships_of(u.id):
+				if membership.conversation_id == c.id:
+					return membership
 		raise Membership.DoesNotExist
 
 # Add a user profile to the Django User model so that we can
@@ -104,7 +140,8 @@ class UserProfile(models.Model):
 	@staticmethod
 	def load_user(u):
 		"""A convenience method to load a given user, given some
-		identifying information about them.
+		identifying information about them.  Lookups by phone number or
+		username (including those that find nothing) are cached by user_cache.
 
 		Raises User.DoesNotExist if the user cannot be found.
 		"""
@@ -115,15 +152,20 @@ class UserProfile(models.Model):
 		if isinstance(u, UserProfile):
 			return u.user
 		assert isinstance(u, str) or isinstance(u, unicode), "load_user(u): u is not User, UserProfile, or string: %s" % (type(u))
-		if re.match('^[0-9]+$', u):
+		key = u.lower()
+		user = user_cache.get(key, False)
+		if user is False:
 			try:
-				profile = UserProfile.objects.get(phone_number=u)
-			except UserProfile.DoesNotExist:
-				raise User.DoesNotExist
-			else:
-				return profile.user
-		else:
-			return User.objects.get(username=u)
+				if PHONE_NUMBER_REGEX.match(u):
+					user = UserProfile.objects.select_related('user').get(phone_number=u).user
+				else:
+					user = User.objects.get(username__iexact=u)
+			except (User.DoesNotExist, UserProfile.DoesNotExist):
+				user = UserCache.NO_USER
+			user_cache.set(key, user)
+		if user is UserCache.NO_USER:
+			raise User.DoesNotExist
+		return user
 
 	@staticmethod
 	def validate_name(s):
@@ -134,4 +176,25 @@ class UserProfile(models.Model):
 			raise SmircRestrictedNameException('user nicknames must start with a letter and be made up only of alphanumeric characters')
 		if s.find('smirc') != -1:
 			raise SmircRestrictedNameException('user nicknames may not contain the string "smirc"')
-		return True
\ No newline at end of file
+		return True
+# Keep our membership and user caches coherent with the database.  We import smirc.*
+# modules at the bottom (instead of at the top) as a fix for circular import
+# problems.
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from smirc.chat.activity import membership_activity
+from smirc.chat.cache import membership_cache
+from smirc.chat.cache import user_cache
+from smirc.chat.cache import UserCache
+post_delete.connect(membership_cache.conversation_changed, sender=Conversation)
+post_delete.connect(membership_cache.membership_changed, sender=Membership)
+post_delete.connect(membership_cache.user_changed, sender=User)
+post_delete.connect(membership_cache.userprofile_changed, sender=UserProfile)
+post_delete.connect(user_cache.user_changed, sender=User)
+post_delete.connect(user_cache.userprofile_changed, sender=UserProfile)
+post_save.connect(membership_cache.conversation_changed, sender=Conversation)
+post_save.connect(membership_cache.membership_changed, sender=Membership)
+post_save.connect(membership_cache.user_changed, sender=User)
+post_save.connect(membership_cache.userprofile_changed, sender=UserProfile)
+post_save.connect(user_cache.user_changed, sender=User)
+post_save.connect(user_cache.userprofile_changed, sender=UserProfile)
@@ -0,0 +1,3 @@
+-- Installed by syncdb when the chat_membership table is created.  Existing databases
+-- need it applied by hand: manage.py sqlcustom chat | manage.py dbshell
+CREATE INDEX chat_membership_user_last_active ON chat_membership (user_id, last_active);
@@ -5,7 +5,158 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
+import multiprocessing
+import os
+import tempfile
+from django.contrib.auth.models import User
 from django.test import TestCase
+from smirc.chat.activity import membership_activity
+from smirc.chat.cache import MembershipCache
+from smirc.chat.cache import UserCache
+from smirc.chat.cache import membership_cache
+from smirc.chat.cache import user_cache
+from smirc.chat.models import Conversation
+from smirc.chat.models import DefaultConversation
+from smirc.chat.models import Membership
+from smirc.chat.models import UserProfile
+
+class MembershipCacheTest(TestCase):
+	def setUp(self):
+		membership_activity.flush()
+		membership_cache.clear()
+		self.conversation = Conversation(name='foo')
+		self.conversation.save()
+		self.users = []
+		for i in xrange(3):
+			u = User.objects.create_user('user%d' % (i), '')
+			p = UserProfile(phone_number=17805550100 + i, user=u)
+			p.save()
+			self.users.append(u)
+		Membership(conversation=self.conversation, user=self.users[0]).save()
+		Membership(conversation=self.conversation, user=self.users[1]).save()
+
+	def test_roster_is_invalidated_by_membership_changes(self):
+		self.assertEqual(sorted(membership_cache.roster(self.conversation.id)), [(self.users[0].id, 17805550100), (self.users[1].id, 17805550101)])
+		Membership(conversation=self.conversation, user=self.users[2]).save()
+		self.assertEqual(len(membership_cache.roster(self.conversation.id)), 3)
+		Membership.load_membership(self.users[0], 'FOO').delete()
+		self.assertEqual(len(membership_cache.roster(self.conversation.id)), 2)
+
+	def test_memberships_are_cached(self):
+		hits = membership_cache.memberships.hits
+		m = Membership.load_membership(self.users[0], 'foo')
+		self.assertTrue(Membership.load_membership(self.users[0], self.conversation) is m)
+		self.assertEqual(membership_cache.memberships.hits, hits + 1)
+		self.assertRaises(Membership.DoesNotExist, Membership.load_membership, self.users[2], 'foo')
+
+	def test_memberships_are_invalidated_by_renames(self):
+		m = Membership.load_membership(self.users[0], 'foo')
+		self.assertEqual(str(m), 'user0@foo')
+		self.users[0].username = 'bar'
+		self.users[0].save()
+		self.assertEqual(str(Membership.load_membership(self.users[0], 'foo')), 'bar@foo')
+
+	def test_generation_file_is_shared_between_nodes(self):
+		(fd, path) = tempfile.mkstemp()
+		os.close(fd)
+		try:
+			node1 = MembershipCache(16, 300)
+			node2 = MembershipCache(16, 300)
+			node1.share_generation_file(path, 0)
+			node2.share_generation_file(path, 0)
+			node2.roster(self.conversation.id)
+			node1.changed()
+			self.assertEqual(len(node2.rosters), 1)
+			node2.check_generation()
+			self.assertEqual(len(node2.rosters), 0)
+		finally:
+			os.unlink(path)
+
+	def test_default_conversation_follows_activity(self):
+		other = Conversation(name='bar')
+		other.save()
+		Membership(conversation=other, user=self.users[0]).save()
+		foo = Membership.load_membership(self.users[0], 'foo')
+		bar = Membership.load_membership(self.users[0], 'bar')
+		foo.mark_active()
+		self.assertTrue(membership_cache.default_membership(self.users[0].id) is foo)
+		bar.mark_active()
+		self.assertTrue(membership_cache.default_membership(self.users[0].id) is bar)
+		self.assertEqual(list(DefaultConversation.objects.filter(user=self.users[0]).values_list('conversation', flat=True)), [other.id])
+		membership_activity.flush()
+		self.assertEqual(Membership.objects.get(id=bar.id).last_active, bar.last_active)
+		# Without a cached pointer, it is read from the database.
+		membership_cache.clear()
+		self.assertEqual(membership_cache.default_membership(self.users[0].id).conversation_id, other.id)
+		self.assertRaises(Membership.DoesNotExist, membership_cache.default_membership, self.users[2].id)
+
+	def test_default_conversation_is_cached_between_workers(self):
+		node = MembershipCache(16, 300)
+		node.share_generation(multiprocessing.Value('i', 0))
+		DefaultConversation(conversation=self.conversation, user=self.users[0]).save()
+		self.assertEqual(node.default_conversation_of(self.users[0].id), self.conversation.id)
+		self.assertEqual(node.default_conversation_of(self.users[0].id), self.conversation.id)
+		self.assertEqual((node.defaults.hits, node.defaults.misses), (1, 1))
+
+	def test_default_conversation_is_not_cached_between_nodes(self):
+		other = Conversation(name='bar')
+		other.save()
+		(fd, path) = tempfile.mkstemp()
+		os.close(fd)
+		try:
+			node = MembershipCache(16, 300)
+			node.share_generation_file(path, 300)
+			DefaultConversation(conversation=self.conversation, user=self.users[0]).save()
+			self.assertEqual(node.default_conversation_of(self.users[0].id), self.conversation.id)
+			# Another node moves the user to another conversation.
+			DefaultConversation.objects.filter(user=self.users[0]).update(conversation=other.id)
+			self.assertEqual(node.default_conversation_of(self.users[0].id), other.id)
+		finally:
+			os.unlink(path)
+
+	def test_last_active_is_written_behind(self):
+		m = Membership.load_membership(self.users[0], 'foo')
+		before = Membership.objects.get(id=m.id).last_active
+		m.mark_active()
+		self.assertEqual(Membership.objects.get(id=m.id).last_active, before)
+		# Memberships that are (re)loaded see the buffered time.
+		membership_cache.clear()
+		self.assertEqual(Membership.load_membership(self.users[0], 'foo').last_active, m.last_active)
+		membership_activity.flush()
+		self.assertEqual(Membership.objects.get(id=m.id).last_active, m.last_active)
+		self.assertEqual(membership_activity.pending(m.id), None)
+
+class UserCacheTest(TestCase):
+	def setUp(self):
+		user_cache.users.clear()
+
+	def test_negative_lookups_are_cached_until_registration(self):
+		self.assertRaises(User.DoesNotExist, UserProfile.load_user, '17805550100')
+		misses = user_cache.users.misses
+		self.assertRaises(User.DoesNotExist, UserProfile.load_user, '17805550100')
+		self.assertEqual(user_cache.users.misses, misses)
+		u = User.objects.create_user('foo', '')
+		UserProfile(phone_number=17805550100, user=u).save()
+		self.assertEqual(UserProfile.load_user('17805550100').id, u.id)
+		self.assertEqual(UserProfile.load_user('FOO').id, u.id)
+
+	def test_negative_lookups_expire_quickly(self):
+		# Users who register through the website are not signalled to us.
+		cache = UserCache(16, 300, 0)
+		u = User.objects.create_user('foo', '')
+		cache.set('17805550100', UserCache.NO_USER)
+		cache.set('foo', u)
+		self.assertEqual(cache.get('17805550100', False), False)
+		self.assertTrue(cache.get('foo', False) is u)
+
+	def test_renames_invalidate_lookups(self):
+		u = User.objects.create_user('foo', '')
+		self.assertEqual(UserProfile.load_user('foo').id, u.id)
+		self.assertRaises(User.DoesNotExist, UserProfile.load_user, 'bar')
+		u.username = 'bar'
+		u.save()
+		self.assertEqual(UserProfile.load_user('bar').id, u.id)
+		self.assertRaises(User.DoesNotExist, UserProfile.load_user, 'foo')
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -1,8 +1,7 @@
-import inspect
 import logging
 import re
 import string
-import sys
+from django.conf import settings
 from django.contrib.auth.models import User
 from smirc.chat.models import SmircException
 
@@ -11,23 +10,62 @@ logger = logging.getLogger(__name__)
 class SmircCommandException(SmircException):
 	pass
 
-class SmircCommand:
+COMMAND_REGEX = re.compile('^([A-Za-z]+)\s*(.*)')
+
+class SmircCommandRegistry(type):
+	"""
+	Metaclass of SmircCommand, which registers every command class (i.e.
+	every subclass of SmircCommand) by its command name as soon as the class is
+	defined.  Command classes can therefore live in any module, as long as that
+	module is imported (see SMIRC_COMMAND_MODULES in settings.py).
+
+	The work that is the same for every execution of a command is done once,
+	at registration: the ARGUMENTS_REGEX of the command is compiled, and its
+	usage, description and examples are parsed out of its docstring.
+	"""
+	commands = {}
+
+	def __init__(klass, name, bases, attributes):
+		type.__init__(klass, name, bases, attributes)
+		if not [base for base in bases if isinstance(base, SmircCommandRegistry)]:
+			# SmircCommand itself is not a command.
+			return
+		if not 'COMMAND_NAME' in attributes:
+			klass.COMMAND_NAME = name.replace('SmircCommand', '').lower()
+		klass.ARGUMENTS_PATTERN = None
+		if klass.ARGUMENTS_REGEX is not None:
+			klass.ARGUMENTS_PATTERN = re.compile(klass.ARGUMENTS_REGEX)
+		klass.DESCRIPTION = SmircCommand.command_description(klass)
+		klass.EXAMPLES = SmircCommand.command_examples(klass)
+		klass.USAGE = SmircCommand.command_usage(klass)
+		if klass.COMMAND_NAME in SmircCommandRegistry.commands:
+			logger.warning('command %s%s is being re-registered, replacing %s with %s' % (SmircCommand.COMMAND_CHARACTER, klass.COMMAND_NAME, repr(SmircCommandRegistry.commands[klass.COMMAND_NAME]), repr(klass)))
+		SmircCommandRegistry.commands[klass.COMMAND_NAME] = klass
+
+class SmircCommand(object):
+	__metaclass__ = SmircCommandRegistry
+
 	ANONYMOUSLY_EXECUTABLE = False
+	ARGUMENTS_PATTERN = None
 	ARGUMENTS_REGEX = None
 	COMMAND_CHARACTER = '/'
+	COMMAND_NAME = None
+	DESCRIPTION = ''
+	EXAMPLES = []
+	USAGE = ''
 	arguments = None
 	command = None
 	executor = None
 
 	def __init__(self, command, arguments):
 		self.command = command
-		if self.ARGUMENTS_REGEX is None:
+		if self.ARGUMENTS_PATTERN is None:
 			raise SmircCommandException('command "%s%s" has not yet been implemented' % (SmircCommand.COMMAND_CHARACTER, self.command))
-		match = re.match(self.ARGUMENTS_REGEX, arguments)
+		match = self.ARGUMENTS_PATTERN.match(arguments)
 		if match:
 			self.arguments = match.groupdict()
 		else:
-			raise SmircCommandException('invalid arguments given, try "%s"' % (SmircCommand.command_usage(self)))
+			raise SmircCommandException('invalid arguments given, try "%s"' % (self.USAGE))
 		if 'user' in self.arguments:
 			try:
 				u = UserProfile.load_user(self.arguments['user'])
@@ -38,9 +76,11 @@ class SmircCommand:
 
 	@staticmethod
 	def available_commands():
-		for name, obj in inspect.getmembers(sys.modules[__name__]):
-			if inspect.isclass(obj) and obj != SmircCommand and issubclass(obj, SmircCommand):
-				yield (name, obj)
+		"""Yield (command name, command class) for every registered command, in
+		order of command name.
+		"""
+		for name in sorted(SmircCommandRegistry.commands.keys()):
+			yield (name, SmircCommandRegistry.commands[name])
 
 	@staticmethod
 	def command_description(klass):
@@ -97,23 +137,18 @@ class SmircCommand:
 	@staticmethod
 	def fetch_command_class(klass_name):
 		try:
-			if not re.match('^[A-Za-z]+$', klass_name):
-				raise AttributeError
-			klass_name = klass_name[0:1].upper() + klass_name[1:].lower()
-			klass = getattr(sys.modules[__name__], 'SmircCommand%s' % (klass_name))
-		except AttributeError:
+			return SmircCommandRegistry.commands[klass_name.lower()]
+		except KeyError:
 			raise SmircCommandException('unknown command "%s%s", try "%shelp".' % (SmircCommand.COMMAND_CHARACTER, klass_name.lower(), SmircCommand.COMMAND_CHARACTER))
-		else:
-			return klass
 
 	@staticmethod
 	def handle(u, s):
 		if len(s) == 0 or s[0:1] != SmircCommand.COMMAND_CHARACTER:
 			return False
-		match = re.match('^([A-Za-z]+)\s*(.*)', s[1:])
+		match = COMMAND_REGEX.match(s[1:])
 		if match:
 			klass = SmircCommand.fetch_command_class(match.group(1))
-			logger.debug('mapped raw command "%s" to %s("%s", "%s")' % (s, klass, match.group(1).lower(), match.group(2)))
+			logger.debug('mapped raw command "%s" to %s("%s", "%s")', s, klass, match.group(1).lower(), match.group(2))
 			cmd = klass(match.group(1).lower(), match.group(2))
 			if isinstance(u, User) or cmd.ANONYMOUSLY_EXECUTABLE:
 				cmd.executor = u
@@ -168,13 +203,9 @@ class SmircCommandHelp(SmircCommand):
 		/HELP or /HELP [command]
 		"""
 		if self.arguments['command']:
-			klass = SmircCommand.fetch_command_class(self.arguments['command'])
-			return SmircCommand.command_usage(klass)
+			return SmircCommand.fetch_command_class(self.arguments['command']).USAGE
 		else:
-			commands = []
-			for klassname, _unused_obj in SmircCommand.available_commands():
-				commands.append(klassname.replace('SmircCommand', '').upper())
-			commands.sort()
+			commands = [name.upper() for (name, _unused_klass) in SmircCommand.available_commands()]
 			return 'Commands: %s. Usage: "%sHELP [command]"' % (string.join(commands, ', '), SmircCommand.COMMAND_CHARACTER)
 	
 class SmircCommandInvite(SmircCommand):
@@ -220,6 +251,7 @@ class SmircCommandInvite(SmircCommand):
 		
 		notification = SMSToolsMessage()
 		notification.body = 'you have been invited to the conversation "%s" by %s.  Respond with "%sjoin %s in %s" to accept the invitation.' % (membership.conversation.name, self.executor.username, SmircCommand.COMMAND_CHARACTER, self.executor.username, membership.conversation.name)
+		notification.priority = OutboundSpool.PRIORITY_INVITATION
 		notification.system = True
 		notification.send(self.arguments['user'].get_profile().phone_number)
 
@@ -411,3 +443,13 @@ from smirc.chat.models import Membership
 from smirc.chat.models import SmircRestrictedNameException
 from smirc.chat.models import UserProfile
 from smirc.message.models import SMSToolsMessage
+from smirc.message.spool import OutboundSpool
+
+def load_command_modules():
+	"""Import the modules of SMIRC_COMMAND_MODULES, which register the
+	commands that are defined outside of this module.
+	"""
+	for module in getattr(settings, 'SMIRC_COMMAND_MODULES', ()):
+		__import__(module)
+
+load_command_modules()
@@ -6,6 +6,41 @@ Replace these with more appropriate tests for your application.
 """
 
 from django.test import TestCase
+from smirc.command.models import SmircCommand
+from smirc.command.models import SmircCommandException
+from smirc.command.models import SmircCommandHelp
+from smirc.command.models import SmircCommandRegistry
+
+class SmircCommandRegistryTest(TestCase):
+	def tearDown(self):
+		SmircCommandRegistry.commands.pop('ping', None)
+
+	def test_builtin_commands_are_registered(self):
+		self.assertTrue(SmircCommand.fetch_command_class('HeLp') is SmircCommandHelp)
+		self.assertEqual(SmircCommandHelp.USAGE, '/HELP or /HELP [command]')
+		self.assertEqual([name for (name, _unused_klass) in SmircCommand.available_commands()], ['create', 'help', 'invite', 'join', 'kick', 'nick', 'part', 'who'])
+		self.assertRaises(SmircCommandException, SmircCommand.fetch_command_class, 'nonexistent')
+
+	def test_commands_register_themselves(self):
+		class SmircCommandPing(SmircCommand):
+			ANONYMOUSLY_EXECUTABLE = True
+			ARGUMENTS_REGEX = '\s*$'
+
+			def execute(self):
+				"""Check that SMIRC is alive.
+
+				/PING
+
+				Example: /PING
+				Responds with "pong".
+				"""
+				return 'pong'
+
+		self.assertEqual(SmircCommandPing.DESCRIPTION, 'Check that SMIRC is alive.')
+		self.assertEqual(SmircCommandPing.EXAMPLES, [('/PING', 'Responds with "pong".')])
+		self.assertEqual(SmircCommand.handle('17805550100', '/ping').execute(), 'pong')
+		self.assertTrue('PING' in SmircCommand.handle('17805550100', '/help').execute())
+		self.assertEqual(SmircCommand.handle('17805550100', '/help ping').execute(), '/PING')
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
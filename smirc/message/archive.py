@@ -0,0 +1,274 @@
+import gzip
+import logging
+import os
+import shutil
+import threading
+import time
+from django.conf import settings
+from smirc.message.claim import node_name
+
+logger = logging.getLogger(__name__)
+
+class MessageArchive:
+	"""
+	An archive of the inbound message files that have been processed.  Instead
+	of one file per message in a single flat directory, messages are appended
+	to segment files that are sharded by (UTC) date:
+
+		<archive_dir>/<YYYY>/<MM>/<DD>/<HHMMSS>-<node>-<pid>-<sequence>.seg
+
+	A segment is rolled over (closed, and a new one started) when it reaches
+	max_bytes, when it is older than max_seconds or when the date changes, and
+	it is compressed (to .seg.gz) once it is closed.  Every process (of every
+	smircd node) writes to segments of its own, so no locking between
+	processes is needed.
+
+	Every record in a segment is a header line, followed by the contents of
+	the message file and a newline:
+
+		SMIRC-ARCHIVE <timestamp> <phone number> <filename> <length>\\n
+
+	Every segment has an (uncompressed) index, <segment>.idx, with a line of
+	"<phone number>\\t<timestamp>\\t<offset>\\t<length>\\t<filename>" for each
+	record, so that lookup only has to read the indexes of the days that are
+	being looked up and the records that match.
+
+	Message files are only removed from the inbound directory once their
+	records have been synced to disk, which is done once per batch of up to
+	sync_messages files, or once the oldest of them has waited sync_seconds
+	(see sync), rather than for every message.  Until then they are left in
+	place, but are known to have been archived (see archived); those of a
+	process that dies in the meantime are processed again.
+	"""
+	def __init__(self, archive_dir, max_bytes, max_seconds, node, sync_messages=1, sync_seconds=0):
+		self.archive_dir = archive_dir
+		self.compressors = []
+		self.index = None
+		self.lock = threading.RLock()
+		self.max_bytes = max_bytes
+		self.max_seconds = max_seconds
+		self.node = node
+		self.opened = None
+		self.path = None
+		self.pid = None
+		self.segment = None
+		self.sequence = 0
+		self.sync_messages = sync_messages
+		self.sync_seconds = sync_seconds
+		# The message files that have been archived but not yet removed (see
+		# sync), and the time that the first of them was archived.
+		self.unlinks = []
+		self.unlinks_since = None
+
+	def after_fork(self):
+		"""Forget the lock (which one of its threads may have been holding),
+		the compressor threads and the archived message files of the process
+		that we were forked from; its segment is left to it (see roll).
+		"""
+		self.compressors = []
+		self.lock = threading.RLock()
+		self.unlinks = []
+		self.unlinks_since = None
+
+	def archived(self, pathname):
+		"""Whether the message file at the given path has been archived by this
+		process, but not yet removed.
+		"""
+		with self.lock:
+			return pathname in self.unlinks
+
+	def close(self):
+		"""Close (and compress) the current segment, and wait for every segment
+		that is being compressed.
+		"""
+		with self.lock:
+			self.roll()
+			compressors = self.compressors
+			self.compressors = []
+		for compressor in compressors:
+			compressor.join()
+
+	def compress(self, path):
+		try:
+			with open(path, 'rb') as f_in:
+				f_out = gzip.open('%s.gz.tmp' % (path), 'wb')
+				try:
+					shutil.copyfileobj(f_in, f_out)
+				finally:
+					f_out.close()
+			os.rename('%s.gz.tmp' % (path), '%s.gz' % (path))
+			os.unlink(path)
+		except (IOError, OSError) as e:
+			logger.exception('exception occurred while compressing archive segment %s: %s' % (path, e))
+		else:
+			logger.debug('compressed archive segment %s', path)
+
+	def expire(self):
+		"""Roll the current segment over if it is older than max_seconds (or is
+		from an earlier day), even if no messages are being archived.
+		"""
+		with self.lock:
+			if self.segment is not None and self.pid == os.getpid() and self.expired(time.time()):
+				self.roll()
+
+	def expired(self, now):
+		return now - self.opened >= self.max_seconds or time.gmtime(now)[:3] != time.gmtime(self.opened)[:3]
+
+	def lookup(self, phone_number, start=None, end=None):
+		"""Return the archived messages from the given phone number that were
+		received between the given start and end times (in seconds since the
+		epoch, either of which may be None), as a list of (timestamp, filename,
+		message file contents) tuples, oldest first.
+		"""
+		matches = []
+		for day in self.days(start, end):
+			for filename in sorted(os.listdir(day)):
+				if not filename.endswith('.idx'):
+					continue
+				segment = '%s/%s' % (day, filename[:-len('.idx')])
+				records = []
+				with open('%s/%s' % (day, filename), 'r') as f:
+					for line in f:
+						if not line.endswith('\n'):
+							# The record is still being written.
+							break
+						(record_phone_number, timestamp, offset, length, record_filename) = line.rstrip('\n').split('\t')
+						timestamp = float(timestamp)
+						if record_phone_number != phone_number or (start is not None and timestamp < start) or (end is not None and timestamp > end):
+							continue
+						records.append((timestamp, record_filename, int(offset), int(length)))
+				if len(records) == 0:
+					continue
+				try:
+					f = open(segment, 'rb')
+				except IOError:
+					f = gzip.open('%s.gz' % (segment), 'rb')
+				try:
+					for (timestamp, record_filename, offset, length) in records:
+						f.seek(offset)
+						matches.append((timestamp, record_filename, f.read(length)))
+				finally:
+					f.close()
+		matches.sort()
+		return matches
+
+	def days(self, start, end):
+		"""The shard directories of the days between the given times.  Only the
+		years and months that overlap those times are listed.
+		"""
+		first = last = None
+		if start is not None:
+			first = time.strftime('%Y/%m/%d', time.gmtime(start))
+		if end is not None:
+			last = time.strftime('%Y/%m/%d', time.gmtime(end))
+		days = ['']
+		for length in [4, 7, 10]:
+			children = []
+			for parent in days:
+				try:
+					names = sorted(os.listdir('%s/%s' % (self.archive_dir, parent)))
+				except OSError:
+					continue
+				for name in names:
+					child = ('%s/%s' % (parent, name)).lstrip('/')
+					if len(child) != length or (first is not None and child < first[:length]) or (last is not None and child > last[:length]):
+						continue
+					children.append(child)
+			days = children
+		return ['%s/%s' % (self.archive_dir, day) for day in days]
+
+	def open_segment(self, now):
+		self.pid = os.getpid()
+		self.sequence += 1
+		day = '%s/%s' % (self.archive_dir, time.strftime('%Y/%m/%d', time.gmtime(now)))
+		if not os.path.isdir(day):
+			try:
+				os.makedirs(day)
+			except OSError:
+				# Another process may have created it first.
+				if not os.path.isdir(day):
+					raise
+		self.path = '%s/%s-%s-%d-%d.seg' % (day, time.strftime('%H%M%S', time.gmtime(now)), self.node, self.pid, self.sequence)
+		self.segment = open(self.path, 'ab')
+		self.index = open('%s.idx' % (self.path), 'ab')
+		self.opened = now
+		logger.debug('opened archive segment %s', self.path)
+
+	def roll(self):
+		if self.segment is None:
+			return
+		if self.pid != os.getpid():
+			# We were forked from the process that owns this segment; it will close
+			# (and compress) it.
+			self.segment = None
+			return
+		self.sync()
+		self.segment.close()
+		self.index.close()
+		self.segment = None
+		compressor = threading.Thread(target=self.compress, args=(self.path,), name='archive-compressor')
+		compressor.daemon = True
+		compressor.start()
+		self.compressors = [c for c in self.compressors if c.is_alive()] + [compressor]
+
+	def store(self, pathname, phone_number):
+		"""Append the message file at the given path (from the given phone
+		number) to the archive, and then remove it from the inbound directory.
+		"""
+		with open(pathname, 'rb') as f:
+			data = f.read()
+			timestamp = os.fstat(f.fileno()).st_mtime
+		filename = os.path.basename(pathname)
+		if phone_number is None:
+			phone_number = 'unknown'
+		header = 'SMIRC-ARCHIVE %.3f %s %s %d\n' % (timestamp, phone_number, filename, len(data))
+		with self.lock:
+			now = time.time()
+			if self.segment is not None and (self.pid != os.getpid() or self.segment.tell() >= self.max_bytes or self.expired(now)):
+				self.roll()
+			if self.segment is None:
+				self.open_segment(now)
+			offset = self.segment.tell() + len(header)
+			self.segment.write(header + data + '\n')
+			self.segment.flush()
+			self.index.write('%s\t%.3f\t%d\t%d\t%s\n' % (phone_number, timestamp, offset, len(data), filename))
+			self.index.flush()
+			if len(self.unlinks) == 0:
+				self.unlinks_since = now
+			self.unlinks.append(pathname)
+			if len(self.unlinks) >= self.sync_messages or now - self.unlinks_since >= self.sync_seconds:
+				self.sync()
+
+	def sync(self):
+		"""Sync the current segment (and its index) to disk, and then remove
+		the message files that have been archived to it.
+		"""
+		with self.lock:
+			if len(self.unlinks) == 0:
+				return
+			try:
+				os.fsync(self.segment.fileno())
+				os.fsync(self.index.fileno())
+			except (IOError, OSError) as e:
+				# They are removed by the next sync that succeeds.
+				logger.exception('exception occurred while syncing archive segment %s: %s' % (self.path, e))
+				return
+			unlinks = self.unlinks
+			self.unlinks = []
+			self.unlinks_since = None
+			for pathname in unlinks:
+				try:
+					os.unlink(pathname)
+				except OSError as e:
+					logger.error('could not remove archived message file %s: %s' % (pathname, e))
+			logger.debug('synced archive segment %s and removed %d archived message file(s)', self.path, len(unlinks))
+
+	def sync_if_stale(self):
+		"""Sync the current segment if the oldest message file that is waiting
+		to be removed was archived at least sync_seconds ago.
+		"""
+		with self.lock:
+			if self.unlinks_since is not None and time.time() - self.unlinks_since >= self.sync_seconds:
+				self.sync()
+
+inbound_archive = MessageArchive(settings.SMSTOOLS['archive_dir'], settings.SMSTOOLS['archive_segment_bytes'], settings.SMSTOOLS['archive_segment_seconds'], node_name(), settings.SMSTOOLS['archive_sync_messages'], settings.SMSTOOLS['archive_sync_seconds'])
@@ -0,0 +1,189 @@
+import errno
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from django.conf import settings
+from smirc.message.smstools import ignored
+
+logger = logging.getLogger(__name__)
+
+class InboundClaims:
+	"""
+	Claims inbound message files for this smircd node, so that several smircd
+	nodes (on different hosts) can share one SMSTools spool without any two
+	of them processing the same message.
+
+	A node claims a file by renaming it from the inbound directory into a
+	working directory of its own, <claim_dir>/<node>, before it processes it;
+	the rename is atomic, so exactly one node succeeds and the others find
+	the file gone.  claim_dir must be on the same filesystem as the inbound
+	directory.  Claimed files are removed from the working directory once they
+	have been processed (archived).
+
+	Every node rewrites a heartbeat file, <claim_dir>/<node>.heartbeat, every
+	lease_seconds / 4 seconds (see heartbeat).  A node whose heartbeat is more
+	than lease_seconds old is presumed dead, and the files that it had claimed
+	but not processed are taken over by the first node that notices (see
+	recover).  Heartbeats are compared by the modification times that the file
+	server gives them, so the clocks of the nodes do not need to agree.  The
+	lease must be longer than any node can stall for; a node that stalls for
+	longer may have its claims taken over while it is processing them.
+
+	The heartbeat file also reports the throughput of the node: the number of
+	files that it has claimed, lost to other nodes and recovered from dead
+	ones, and the rate at which it has claimed files since its last heartbeat.
+	"""
+	def __init__(self, claim_dir, node, lease_seconds):
+		self.claim_dir = claim_dir
+		self.counters = { 'claimed': 0, 'lost': 0, 'recovered': 0 }
+		self.last_heartbeat = None
+		self.lease_seconds = lease_seconds
+		self.lock = threading.Lock()
+		self.node = node
+		self.node_dir = '%s/%s' % (claim_dir, node)
+		self.seen = {}
+		self.started = time.time()
+
+	def claim(self, pathname, counter='claimed'):
+		"""Claim the given file for this node.  Returns the path of the claimed
+		file (in our working directory), or None if another node claimed it
+		first.
+		"""
+		claimed = '%s/%s' % (self.node_dir, os.path.basename(pathname))
+		try:
+			os.rename(pathname, claimed)
+		except OSError as e:
+			if e.errno != errno.ENOENT:
+				raise
+			# Over NFS, a rename that succeeded can report ENOENT when its request
+			# was retransmitted; the file is ours if it made it to our directory.
+			if not os.path.exists(claimed):
+				with self.lock:
+					self.counters['lost'] += 1
+				logger.debug('%s was claimed by another node', pathname)
+				return None
+		with self.lock:
+			self.counters[counter] += 1
+		return claimed
+
+	def claimed(self):
+		"""List the files that this node has claimed but not yet processed
+		(i.e. that were left behind when it last stopped), oldest first.
+		"""
+		return list_messages(self.node_dir)
+
+	def heartbeat(self):
+		"""Rewrite our heartbeat file.  Returns the modification time that the
+		file server gave it.
+		"""
+		now = time.time()
+		with self.lock:
+			status = dict(self.counters)
+		if self.last_heartbeat is not None:
+			(then, claimed) = self.last_heartbeat
+			status['claimed_per_second'] = (status['claimed'] - claimed) / max(now - then, 0.001)
+		else:
+			status['claimed_per_second'] = status['claimed'] / max(now - self.started, 0.001)
+		status.update({ 'node': self.node, 'pid': os.getpid(), 'time': now, 'uptime': now - self.started })
+		self.last_heartbeat = (now, status['claimed'])
+		path = '%s/%s.heartbeat' % (self.claim_dir, self.node)
+		with open('%s.tmp' % (path), 'w') as f:
+			json.dump(status, f, indent=1, sort_keys=True)
+		os.rename('%s.tmp' % (path), path)
+		return os.stat(path).st_mtime
+
+	def nodes(self):
+		"""The most recent heartbeat of every node, as a dictionary of node
+		names to the (decoded) contents of their heartbeat files, along with the
+		modification time of each file (as 'mtime').
+		"""
+		nodes = {}
+		for filename in os.listdir(self.claim_dir):
+			if not filename.endswith('.heartbeat'):
+				continue
+			path = '%s/%s' % (self.claim_dir, filename)
+			try:
+				with open(path, 'r') as f:
+					status = json.load(f)
+					status['mtime'] = os.fstat(f.fileno()).st_mtime
+			except (IOError, OSError, ValueError) as e:
+				logger.warning('could not read heartbeat file %s: %s' % (path, e))
+				continue
+			nodes[filename[:-len('.heartbeat')]] = status
+		return nodes
+
+	def recover(self, now):
+		"""Take over the claims of every node whose heartbeat is more than
+		lease_seconds older than the given time (the modification time of our
+		own latest heartbeat).  Returns the paths of the recovered files, oldest
+		first.
+		"""
+		recovered = []
+		for (node, status) in self.nodes().items():
+			age = now - status['mtime']
+			if node == self.node or age <= self.lease_seconds:
+				continue
+			files = list_messages('%s/%s' % (self.claim_dir, node))
+			if len(files) == 0:
+				continue
+			claims = [claimed for claimed in [self.claim(pathname, 'recovered') for pathname in files] if claimed is not None]
+			logger.warning('recovered %d claimed message(s) from node %s, whose heartbeat is %d seconds old' % (len(claims), node, age))
+			recovered.extend(claims)
+		return recovered
+
+	def settled(self, pathnames):
+		"""Of the given (unclaimed) files, return those whose size and
+		modification time have not changed since the last call.  Files that
+		other hosts write into a shared inbound directory generate no inotify
+		events here, so they are found by scanning, and are only claimed once
+		they have settled (i.e. once they are no longer being written).
+		"""
+		seen = {}
+		settled = []
+		for pathname in pathnames:
+			if ignored(pathname) is not None:
+				continue
+			try:
+				st = os.stat(pathname)
+			except OSError:
+				continue
+			seen[pathname] = (st.st_size, st.st_mtime)
+			if self.seen.get(pathname) == seen[pathname]:
+				settled.append(pathname)
+		self.seen = seen
+		return settled
+
+	def setup(self):
+		if not os.path.isdir(self.node_dir):
+			os.makedirs(self.node_dir)
+
+def list_files(directory):
+	"""List the files in the given directory, oldest (by modification time)
+	first.
+	"""
+	files = []
+	for filename in os.listdir(directory):
+		pathname = '%s/%s' % (directory, filename)
+		try:
+			st = os.stat(pathname)
+		except OSError:
+			continue
+		if not os.path.isfile(pathname):
+			continue
+		files.append((st.st_mtime, filename, pathname))
+	files.sort()
+	return [pathname for (_unused_mtime, _unused_filename, pathname) in files]
+
+def list_messages(directory):
+	"""List the message files in the given directory, oldest first, leaving
+	out SMSTools' own files (see smirc.message.smstools.ignored), which are
+	never claimed or processed.
+	"""
+	return [pathname for pathname in list_files(directory) if ignored(pathname) is None]
+
+def node_name():
+	"""The name of this smircd node: SMSTOOLS['node_name'], or our host name."""
+	return settings.SMSTOOLS.get('node_name') or socket.gethostname()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+# The GSM 03.38 default alphabet, in the order of its septets (the escape septet,
+# 0x1b, is a placeholder that no character maps to).
+GSM_BASIC = frozenset(u'@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞ\x1bÆæßÉ !"#¤%&\'()*+,-./0123456789:;<=>?¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà') - frozenset(u'\x1b')
+
+# The characters of the GSM 03.38 extension table, each of which is sent as the
+# escape septet followed by a septet of its own.
+GSM_EXTENDED = frozenset(u'\x0c^{}\\[~]|€')
+
+# The number of characters (septets, or UTF-16 code units for UCS2) that fit in a
+# single SMS, and in each part of a concatenated (multipart) SMS, whose user data
+# header takes up the rest.
+SEGMENT_LENGTHS = {
+	'GSM': (160, 153),
+	'UCS2': (70, 67)
+}
+
+def alphabet(text):
+	"""The alphabet that the given (unicode) text is sent in: 'GSM' if every
+	character of it is in the GSM 03.38 default alphabet (or its extension
+	table), otherwise 'UCS2'.
+	"""
+	for c in text:
+		if not c in GSM_BASIC and not c in GSM_EXTENDED:
+			return 'UCS2'
+	return 'GSM'
+
+def cost(c, alphabet):
+	"""The number of septets (or UTF-16 code units) that the given character
+	takes up in the given alphabet.
+	"""
+	if alphabet == 'GSM':
+		if c in GSM_EXTENDED:
+			return 2
+		return 1
+	if ord(c) > 0xffff:
+		return 2
+	return 1
+
+def segments(text):
+	"""Return a tuple of the alphabet that the given text is sent in and the
+	number of SMS (segments of a concatenated SMS) that it takes to send it.
+	"""
+	text_alphabet = alphabet(text)
+	length = sum([cost(c, text_alphabet) for c in text])
+	(single, multipart) = SEGMENT_LENGTHS[text_alphabet]
+	if length <= single:
+		return (text_alphabet, 1)
+	return (text_alphabet, (length + multipart - 1) // multipart)
+
+def truncate(text, max_segments):
+	"""Truncate the given text to the longest prefix of it that can be sent in
+	at most max_segments SMS.
+	"""
+	(text_alphabet, count) = segments(text)
+	if count <= max_segments:
+		return text
+	(single, multipart) = SEGMENT_LENGTHS[text_alphabet]
+	if max_segments == 1:
+		limit = single
+	else:
+		limit = multipart * max_segments
+	length = 0
+	for (i, c) in enumerate(text):
+		length += cost(c, text_alphabet)
+		if length > limit:
+			return text[:i]
+	return text
@@ -0,0 +1,105 @@
+import datetime
+import logging
+import threading
+import time
+from django.conf import settings
+from django.db import connection
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+class MessageHistoryBuffer:
+	"""
+	Buffers the MessageHistory rows of the chat messages that this process
+	forwards, and writes them with a single multi-row insert when max_rows of
+	them have been buffered, or when the oldest of them has been buffered for
+	max_seconds (see flush_if_stale, which smircd calls periodically).  At most
+	max_rows rows (or max_seconds worth of rows) are lost if the process dies.
+	"""
+	COLUMNS = ['body', 'conversation_id', 'received', 'recipients', 'recipient_count', 'sender_id']
+
+	def __init__(self, max_rows, max_seconds):
+		self.flushed = 0
+		self.lock = threading.Lock()
+		self.max_rows = max_rows
+		self.max_seconds = max_seconds
+		self.oldest = None
+		self.rows = []
+
+	def after_fork(self):
+		"""Forget the rows that were buffered by the process that we were forked
+		from (which writes them), along with the lock that one of its threads
+		may have been holding.
+		"""
+		self.lock = threading.Lock()
+		self.oldest = None
+		self.rows = []
+
+	def flush(self):
+		"""Write every buffered row to the database."""
+		with self.lock:
+			rows = self.rows
+			self.rows = []
+			self.oldest = None
+		if len(rows) == 0:
+			return
+		qn = connection.ops.quote_name
+		sql = 'INSERT INTO %s (%s) VALUES (%s)' % (qn(MessageHistory._meta.db_table), ', '.join([qn(column) for column in MessageHistoryBuffer.COLUMNS]), ', '.join(['%s'] * len(MessageHistoryBuffer.COLUMNS)))
+		try:
+			cursor = connection.cursor()
+			cursor.executemany(sql, rows)
+			transaction.commit_unless_managed()
+		except Exception as e:
+			logger.exception('exception occurred while writing %d message history row(s), discarding them: %s' % (len(rows), e))
+			return
+		self.flushed += len(rows)
+		logger.debug('wrote %d message history row(s)', len(rows))
+
+	def flush_if_stale(self):
+		"""Write every buffered row to the database if the oldest of them has
+		been buffered for at least max_seconds.
+		"""
+		if self.oldest is not None and time.time() - self.oldest >= self.max_seconds:
+			self.flush()
+
+	def record(self, membership, body, recipients):
+		"""Buffer the history of a chat message, sent with the given membership
+		and forwarded to the given phone numbers.
+		"""
+		row = (body, membership.conversation_id, connection.ops.value_to_db_datetime(datetime.datetime.utcnow()), ','.join([str(recipient) for recipient in recipients]), len(recipients), membership.user_id)
+		with self.lock:
+			self.rows.append(row)
+			if self.oldest is None:
+				self.oldest = time.time()
+			full = len(self.rows) >= self.max_rows
+		if full:
+			self.flush()
+
+def purge_message_history(retention_days, chunk_size, pause=0.1):
+	"""Delete the MessageHistory rows that are older than the given number of
+	days, chunk_size rows (and one short transaction) at a time, pausing
+	between chunks so that other writers are not held up.  Returns the number
+	of rows that were deleted.
+	"""
+	before = datetime.datetime.utcnow() - datetime.timedelta(days=retention_days)
+	qn = connection.ops.quote_name
+	deleted = 0
+	while True:
+		ids = list(MessageHistory.objects.filter(received__lt=before).order_by('id').values_list('id', flat=True)[:chunk_size])
+		if len(ids) == 0:
+			break
+		cursor = connection.cursor()
+		cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (qn(MessageHistory._meta.db_table), qn('id'), ', '.join(['%s'] * len(ids))), ids)
+		transaction.commit_unless_managed()
+		deleted += len(ids)
+		if len(ids) < chunk_size:
+			break
+		time.sleep(pause)
+	logger.info('purged %d message history row(s) from before %s' % (deleted, before))
+	return deleted
+
+message_history = MessageHistoryBuffer(settings.SMIRC_MESSAGE_HISTORY['flush_rows'], settings.SMIRC_MESSAGE_HISTORY['flush_seconds'])
+
+# We import smirc.* modules at the bottom (instead of at the top) as a fix for
+# circular import problems.
+from smirc.message.models import MessageHistory
@@ -0,0 +1,157 @@
+import collections
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+from django.conf import settings
+from django.db import connection
+from smirc.remiutilities import RollingHistogram
+
+logger = logging.getLogger(__name__)
+
+class PipelineMetrics:
+	"""
+	Counters and per-stage latency histograms (in milliseconds) of the
+	messages that this process handles, along with a histogram of the number
+	of database queries that each message takes (see count_queries).  The
+	numbers are exposed by periodically rewriting a JSON stats file (see
+	write), which our monitoring scrapes.
+	"""
+	def __init__(self, max_samples):
+		self.counters = collections.defaultdict(int)
+		self.last_write = 0
+		self.local = threading.local()
+		self.lock = threading.Lock()
+		self.max_samples = max_samples
+		self.queries = RollingHistogram(max_samples)
+		self.sources = {}
+		self.stages = {}
+		self.started = time.time()
+
+	def add_source(self, name, source):
+		"""Include the result of the given function (unless it is None) in
+		our snapshots, as name.
+		"""
+		self.sources[name] = source
+
+	def after_fork(self):
+		"""Start counting afresh in a process that has just been forked (the
+		counters and histograms that we inherited are those of our parent, and
+		their locks may have been held by one of its threads).
+		"""
+		self.counters = collections.defaultdict(int)
+		self.local = threading.local()
+		self.lock = threading.Lock()
+		self.queries = RollingHistogram(self.max_samples)
+		self.stages = {}
+		self.started = time.time()
+
+	def begin_message(self):
+		self.local.queries = 0
+		self.local.started = time.time()
+
+	def count(self, name, n=1):
+		with self.lock:
+			self.counters[name] += n
+
+	def end_message(self):
+		self.stage('total').add((time.time() - self.local.started) * 1000)
+		self.queries.add(self.local.queries)
+		del self.local.queries
+
+	def query_executed(self):
+		# Only the queries of a message that is being timed are counted.
+		if hasattr(self.local, 'queries'):
+			self.local.queries += 1
+
+	def snapshot(self):
+		with self.lock:
+			counters = dict(self.counters)
+			stages = self.stages.items()
+		snapshot = {
+			'counters': counters,
+			'pid': os.getpid(),
+			'queries_per_message': self.queries.stats(),
+			'stages': dict([(name, histogram.stats()) for (name, histogram) in stages]),
+			'time': time.time(),
+			'uptime': time.time() - self.started
+		}
+		for (name, source) in self.sources.items():
+			value = source()
+			if value is not None:
+				snapshot[name] = value
+		return snapshot
+
+	def stage(self, name):
+		histogram = self.stages.get(name)
+		if histogram is None:
+			with self.lock:
+				histogram = self.stages.setdefault(name, RollingHistogram(self.max_samples))
+		return histogram
+
+	@contextlib.contextmanager
+	def timer(self, name):
+		"""Time the body of a with statement as the given stage."""
+		start = time.time()
+		try:
+			yield
+		finally:
+			self.stage(name).add((time.time() - start) * 1000)
+
+	def write(self, path):
+		"""(Re)write the stats file at the given path.  The file is replaced
+		atomically, so it is never seen half-written.
+		"""
+		self.last_write = time.time()
+		try:
+			with open('%s.tmp' % (path), 'w') as f:
+				json.dump(self.snapshot(), f, indent=1, sort_keys=True)
+			os.rename('%s.tmp' % (path), path)
+		except (IOError, OSError) as e:
+			logger.error('could not write stats file %s: %s' % (path, e))
+
+	def write_if_due(self, path, interval):
+		if time.time() - self.last_write >= interval:
+			self.write(path)
+
+class QueryCountingCursor:
+	"""A database cursor that tells a PipelineMetrics about the queries that
+	are executed through it.
+	"""
+	def __init__(self, cursor, metrics):
+		self.cursor = cursor
+		self.metrics = metrics
+
+	def __getattr__(self, attr):
+		return getattr(self.cursor, attr)
+
+	def __iter__(self):
+		return iter(self.cursor)
+
+	def execute(self, sql, params=()):
+		self.metrics.query_executed()
+		return self.cursor.execute(sql, params)
+
+	def executemany(self, sql, param_list):
+		self.metrics.query_executed()
+		return self.cursor.executemany(sql, param_list)
+
+def count_queries(metrics):
+	"""Count the database queries of every message that the given metrics
+	time.  Django (without DEBUG) keeps no count of its own, so the cursors of
+	our database connection class are wrapped in a QueryCountingCursor.  This
+	needs to be called (once) before any worker processes are forked.
+	"""
+	wrapper = connection.__class__
+	cursor = wrapper.cursor
+	def counting_cursor(self):
+		return QueryCountingCursor(cursor(self), metrics)
+	wrapper.cursor = counting_cursor
+
+def stats_path(name):
+	"""Path of the stats file of the process with the given name."""
+	return '%s/%s.json' % (settings.SMIRC_STATS['stats_dir'], name)
+
+pipeline_metrics = PipelineMetrics(settings.SMIRC_STATS['samples'])
@@ -1,13 +1,17 @@
 import logging
-import os
 import re
-import stat
-import tempfile
+import time
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.db import models
+from smirc.chat.models import Conversation
 from smirc.chat.models import Membership
 from smirc.chat.models import SmircException
+from smirc.message.gsm import truncate
+from smirc.message.metrics import pipeline_metrics
+from smirc.message.smstools import parse_message_file
+from smirc.message.smstools import parse_message_headers
+from smirc.remiutilities import PrefixTrie
 
 logger = logging.getLogger(__name__)
 
@@ -30,36 +34,138 @@ class AreaCode(models.Model):
 	region = models.CharField(max_length=32)
 	country = models.CharField(max_length=32, choices=COUNTRY_CHOICES)
 
+	# E.164 prefix trie of our service area (see load_index), the rows that it
+	# was loaded from, and the time that they were last compared with those in
+	# the database (see check_index).
+	index = None
+	index_checked = 0
+	index_rows = None
+
+	@staticmethod
+	def check_index(now):
+		"""Reload the index if the area codes or numbering prefixes have been
+		changed since it was loaded, by any process (i.e. in the admin, whose
+		changes we are not signalled about).  They are compared with the
+		database at most every SMIRC_AREA_CODE_INDEX['check_seconds'] seconds,
+		when the phone number of an inbound message is validated (rather than
+		when an outbound message is routed, which the spool writer thread does
+		without going to the database).
+		"""
+		if AreaCode.index is None or now - AreaCode.index_checked < settings.SMIRC_AREA_CODE_INDEX['check_seconds']:
+			return
+		AreaCode.index_checked = now
+		rows = AreaCode.read_index_rows()
+		if rows != AreaCode.index_rows:
+			logger.info('area codes or numbering prefixes have changed, reloading the area code index')
+			AreaCode.load_index(rows)
+
+	@staticmethod
+	def index_changed(sender, **kwargs):
+		# Reloaded (lazily) by the next call to lookup_phone_number.
+		AreaCode.index = None
+
+	@staticmethod
+	def load_index(rows=None):
+		"""(Re)load the in-memory E.164 prefix trie that phone numbers are looked
+		up in, from the given rows (see read_index_rows) or from the database.
+		Every area code is a (country code + area code) prefix, which is
+		overridden by any NumberingPrefix for the same prefix; a phone number
+		matches its longest prefix in the trie.  The index is loaded when smircd
+		starts, and reloaded when it receives SIGHUP, after an area code or
+		numbering prefix is saved or deleted by this process, and once any
+		other process has changed them (see check_index).
+		"""
+		if rows is None:
+			rows = AreaCode.read_index_rows()
+		(area_codes, prefixes) = rows
+		index = PrefixTrie()
+		for (country_code, area_code, region) in area_codes:
+			index.insert('%d%03d' % (country_code, area_code), NumberingPrefix(prefix='%d%03d' % (country_code, area_code), region=region))
+		for (prefix, region, allowed, modem) in prefixes:
+			index.insert(prefix, NumberingPrefix(prefix=prefix, region=region, allowed=allowed, modem=modem))
+		AreaCode.index = index
+		AreaCode.index_checked = time.time()
+		AreaCode.index_rows = rows
+		logger.info('loaded %d prefix(es) into the area code index' % (len(AreaCode.index)))
+
+	@staticmethod
+	def lookup_phone_number(s):
+		"""Return the NumberingPrefix (region, allowed/blocked and preferred
+		modem) of the longest known prefix of the given E.164 phone number, or
+		None if the phone number is not in any known prefix.
+		"""
+		if AreaCode.index is None:
+			AreaCode.load_index()
+		if s is None:
+			return None
+		return AreaCode.index.longest_prefix(s.lstrip('+'))
+
+	@staticmethod
+	def read_index_rows():
+		"""The rows of the area codes and numbering prefixes that the index is
+		loaded from, in a form that can be compared (see check_index).
+		"""
+		return (list(AreaCode.objects.order_by('country_code', 'area_code').values_list('country_code', 'area_code', 'region')), list(NumberingPrefix.objects.order_by('prefix').values_list('prefix', 'region', 'allowed', 'modem')))
+
 	@staticmethod
 	def validate_phone_number(s):
-		try:
-			country_code = s[0]
-			area_code = s[1:4]
-		except IndexError:
-			logger.warning('invalid phone number failed validation: %s' % (s))
-			pass
-		else:
-			try:
-				AreaCode.objects.get(area_code__exact=area_code, country_code__exact=country_code)
-				return True
-			except AreaCode.DoesNotExist:
-				logger.warning('phone number %s failed validation due to unknown country code (%s) or area code (%s)' % (s, country_code, area_code))
-				pass
-		return False
+		AreaCode.check_index(time.time())
+		prefix = AreaCode.lookup_phone_number(s)
+		if prefix is None:
+			logger.warning('phone number %s failed validation due to unknown country code or area code' % (s))
+			return False
+		if not prefix.allowed:
+			logger.warning('phone number %s failed validation due to blocked prefix %s (%s)' % (s, prefix.prefix, prefix.region))
+			return False
+		return True
+
+class NumberingPrefix(models.Model):
+	"""An E.164 phone number prefix (a country code, followed by any number of
+	digits) along with the routing information for the phone numbers that
+	start with it.  A numbering prefix takes precedence over any shorter prefix
+	(including area codes), so it can be used to add service areas outside of
+	the country code + area code scheme of North America, or to block or route
+	a part of an existing one.
+	"""
+	prefix = models.CharField(max_length=15, primary_key=True)
+	region = models.CharField(max_length=32, blank=True)
+	allowed = models.BooleanField(default=True)
+	modem = models.CharField(max_length=32, blank=True)
+
+class MessageHistory(models.Model):
+	"""A chat message that was received, and the phone numbers that it was
+	forwarded to.  Rows are written in batches by the MessageHistoryBuffer in
+	smirc.message.history, rather than by saving instances.
+	"""
+	body = models.TextField()
+	conversation = models.ForeignKey(Conversation)
+	received = models.DateTimeField(db_index=True)
+	recipients = models.TextField(blank=True)
+	recipient_count = models.PositiveIntegerField()
+	sender = models.ForeignKey(User)
 
 class MessageSkeleton(models.Model):
 	body = None
 	command = False
+	# The id of the default conversation of the sender (or None) if receive
+	# looked it up, otherwise False (see Membership.mark_active).
+	default_conversation_id = False
+	# One of the OutboundSpool.PRIORITY_* constants, or None for PRIORITY_SYSTEM
+	# (system messages) or PRIORITY_CHAT (chat messages).
+	priority = None
 	raw_body = None
 	raw_phone_number = None
 	sender = models.ForeignKey(Membership)
 	system = False
 
 	def receive(self, data):
-		self.raw_receive(data)
-		logger.debug('received raw SMS message text "%s" from %s' % (self.raw_body, self.raw_phone_number))
+		with pipeline_metrics.timer('parse'):
+			self.raw_receive(data)
+		logger.debug('received raw SMS message text "%s" from %s', self.raw_body, self.raw_phone_number)
 		
-		if not AreaCode.validate_phone_number(self.raw_phone_number):
+		with pipeline_metrics.timer('validate'):
+			valid = AreaCode.validate_phone_number(self.raw_phone_number)
+		if not valid:
 			raise SmircOutOfAreaException('disregarding message from outside of SMIRC service area (%s)' % (self.raw_phone_number))
 		
 		if self.raw_body is None:
@@ -69,34 +175,54 @@ class MessageSkeleton(models.Model):
 			raise SmircMessageException('disregarding empty message')
 
 		try:
-			user = UserProfile.load_user(self.raw_phone_number)
-			self.command = SmircCommand.handle(user, self.raw_body)
+			with pipeline_metrics.timer('load_user'):
+				user = UserProfile.load_user(self.raw_phone_number)
+			with pipeline_metrics.timer('command'):
+				self.command = SmircCommand.handle(user, self.raw_body)
 		except User.DoesNotExist:
 			user = None
-			self.command = SmircCommand.handle(self.raw_phone_number, self.raw_body)
+			with pipeline_metrics.timer('command'):
+				self.command = SmircCommand.handle(self.raw_phone_number, self.raw_body)
 
 		if self.command:
 			return
 		if user is None:
 			raise SmircMessageException('unknown sender %s. Maybe you are not registered? Please see www.smirc.com for help registering.' % (self.raw_phone_number))
 
-		conversation_match = re.match('^@(\S*)\s*(.*)', self.raw_body)
-		if conversation_match:
-			conversation_identifier = conversation_match.group(1)
-			self.body = conversation_match.group(2)
-			try:
-				self.sender = Membership.load_membership(user, conversation_identifier)
-			except Membership.DoesNotExist:
-				raise SmircMessageException('you are not involved in a conversation named %s' % (conversation_identifier))
-		else:
-			self.body = self.raw_body
-			try:
-				self.sender = Membership.objects.filter(user__id__exact=user.id).order_by('last_active').reverse()[0]
-			except IndexError:
-				raise SmircMessageException('you did not target a conversation, and you have no last-active (default) conversation')
-		logger.debug('message body = "%s", target conversation = "%s" (id:%d), sender = "%s" (id:%d)' % (self.body, self.sender.conversation.name, self.sender.conversation.id, self.sender.user.username, self.sender.user.id))
+		with pipeline_metrics.timer('membership'):
+			conversation_match = re.match('^@(\S*)\s*(.*)', self.raw_body)
+			if conversation_match:
+				conversation_identifier = conversation_match.group(1)
+				self.body = conversation_match.group(2)
+				try:
+					self.sender = Membership.load_membership(user, conversation_identifier)
+				except Membership.DoesNotExist:
+					raise SmircMessageException('you are not involved in a conversation named %s' % (conversation_identifier))
+			else:
+				self.body = self.raw_body
+				try:
+					self.default_conversation_id = membership_cache.default_conversation_of(user.id)
+					self.sender = membership_cache.default_membership(user.id, self.default_conversation_id)
+				except Membership.DoesNotExist:
+					raise SmircMessageException('you did not target a conversation, and you have no last-active (default) conversation')
+		logger.debug('message body = "%s", target conversation = "%s" (id:%d), sender = "%s" (id:%d)', self.body, self.sender.conversation.name, self.sender.conversation.id, self.sender.user.username, self.sender.user.id)
 		
-	def send(self, phone_number):
+	def fan_out(self):
+		"""Forward this (chat) message to every other member of the conversation
+		that it was sent to.  The phone numbers of the recipients are resolved in
+		a single (cached) query, and the outgoing text is formatted and encoded
+		only once.
+		"""
+		if self.sender is None:
+			raise SmircMessageException('disregarding message with invalid (null) sender')
+		recipients = [phone_number for (user_id, phone_number) in membership_cache.roster(self.sender.conversation_id) if user_id != self.sender.user_id]
+		logger.debug('fanning message out to %d recipient(s) in conversation id:%d', len(recipients), self.sender.conversation_id)
+		message_history.record(self.sender, self.body, recipients)
+		if len(recipients) == 0:
+			return
+		return self.send_many(recipients)
+
+	def render(self):
 		if self.body is None:
 			raise SmircMessageException('disregarding null message')
 		self.body = self.body.strip()
@@ -110,68 +236,64 @@ class MessageSkeleton(models.Model):
 				raise SmircMessageException('disregarding message with invalid (null) sender')
 			message = '%s: %s' % (str(self.sender), self.body)
 
-		message = message[:140]
-		logger.debug('sending message "%s" to %s' % (message, phone_number))
-		return self.raw_send(phone_number, message)
+		# Long messages are sent as concatenated SMS, of up to
+		# SMSTOOLS['outbound_max_segments'] parts.
+		return truncate(message, settings.SMSTOOLS['outbound_max_segments'])
+
+	def send(self, phone_number):
+		return self.send_many([phone_number])
+
+	def send_many(self, phone_numbers):
+		message = self.render()
+		if logger.isEnabledFor(logging.DEBUG):
+			logger.debug('sending message "%s" to %s', message, ', '.join([str(phone_number) for phone_number in phone_numbers]))
+		priority = self.priority
+		if priority is None:
+			if self.system:
+				priority = OutboundSpool.PRIORITY_SYSTEM
+			else:
+				priority = OutboundSpool.PRIORITY_CHAT
+		return self.raw_send_many(phone_numbers, message, priority)
 
 class SMSToolsMessage(MessageSkeleton):
 	def raw_receive(self, location):
-		body = None
-		headers = {}
-		with open(location, 'r') as f:
-			for line in f:
-				if not body is None:
-					body += line
-				else:
-					if line != '\n':
-						try:
-							(key, value) = line.split(':', 1)		
-							key = key.strip().lower()
-							value = value.strip()
-							headers[key] = value
-						except ValueError:
-							logger.warn('skipping invalid header: "%s"' % (line))
-					else:
-						body = ''
-		if headers.has_key('alphabet'):
-			if headers['alphabet'] == 'ISO' or headers['alphabet'] == 'Latin' or headers['alphabet'] == 'Ansi':
-				self.raw_body = body.decode('latin-1')
-			elif headers['alphabet'] == 'UCS' or headers['alphabet'] == 'UCS2' or headers['alphabet'] == 'Chinese' or headers['alphabet'] == 'Unicode':
-				self.raw_body = body.decode('utf-16-be')
-			else:
-				logger.warn('unknown message encoding header encountered (%s), defaulting to latin-1' % (headers['alphabet']))
-				self.raw_body = body.decode('latin-1')
-		else:
-			logger.warn('no message encoding header encountered, defaulting to latin-1')
-			self.raw_body = body.decode('latin-1')
+		(headers, self.raw_body) = parse_message_file(location)
 		if headers.has_key('from'):
 			self.raw_phone_number = headers['from']
 		else:
 			raise SmircRawMessageException('no "from" header was found in the file %s' % (location))
 
-	def raw_send(self, phone_number, message):
-		# Try to encode our message as latin-1 first, and fallback to UTF-16 if
-		# we fail to do so.
-		try:
-			encoding = 'Ansi'
-			encoded_message = ('%s\n' % (message)).encode('latin-1')
-		except UnicodeEncodeError:
-			encoding = 'Unicode'
-			encoded_message = ('%s\n' % (message)).encode('utf-16-be')
-
-		tempfile.tempdir = settings.SMSTOOLS['outbound_dir']
-		(fd, path) = tempfile.mkstemp('.smircd', '%s-' % (phone_number), None, True)
-		os.fchmod(fd, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP)
-		f = os.fdopen(fd, 'w')
-		f.write(('Alphabet: %s\n' % (encoding)).encode('latin-1'))
-		f.write(('From: %s\n' % (settings.SMIRC_PHONE_NUMBER)).encode('latin-1'))
-		f.write(('To: %s\n' % (phone_number)).encode('latin-1'))	
-		f.write('\n'.encode('latin-1'))
-		f.write(encoded_message)
-		f.close()
-		return path
+	@staticmethod
+	def raw_sender(location):
+		"""Read only the headers of the SMSTools message file at the given
+		location and return the phone number of the sender, or None if the
+		file has no "from" header.
+		"""
+		return parse_message_headers(location).get('from')
+
+	def raw_send(self, phone_number, message, priority=None):
+		return self.raw_send_many([phone_number], message, priority)
+
+	def raw_send_many(self, phone_numbers, message, priority=None):
+		# The message files are written (and published to SMSTools) by the writer
+		# thread of the outbound spool.
+		if priority is None:
+			priority = OutboundSpool.PRIORITY_CHAT
+		outbound_spool.enqueue(phone_numbers, message, priority)
 
 # We import smirc.* modules at the bottom (instead of at the top) as a fix for
 # circular import problems.
+from smirc.chat.cache import membership_cache
 from smirc.chat.models import UserProfile
 from smirc.command.models import SmircCommand
+from smirc.message.history import message_history
+from smirc.message.spool import OutboundSpool
+from smirc.message.spool import outbound_spool
+
+# Keep our area code index coherent with the database.
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+post_delete.connect(AreaCode.index_changed, sender=AreaCode)
+post_delete.connect(AreaCode.index_changed, sender=NumberingPrefix)
+post_save.connect(AreaCode.index_changed, sender=AreaCode)
+post_save.connect(AreaCode.index_changed, sender=NumberingPrefix)
@@ -0,0 +1,119 @@
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+# Codecs of the SMSTools "Alphabet" header values (lowercased).
+ALPHABETS = {
+	'ansi': 'latin-1',
+	'chinese': 'utf-16-be',
+	'iso': 'latin-1',
+	'latin': 'latin-1',
+	'ucs': 'utf-16-be',
+	'ucs2': 'utf-16-be',
+	'unicode': 'utf-16-be',
+	'utf-8': 'utf-8'
+}
+
+# The number of bytes that are read at a time when only the headers of a message
+# file are wanted (see parse_message_headers).
+HEADER_CHUNK_SIZE = 4096
+
+# The empty line that ends the headers of an SMSTools message file, along with
+# the newline that ends the last header line.
+HEADERS_END = re.compile(r'\n\r?\n')
+
+def find_body(data, start=0):
+	"""Find the empty line (terminated by "\n" or "\r\n") that ends the
+	headers of an SMSTools message file, searching from the given offset.
+	Returns a tuple of the offset at which the headers end and the offset at
+	which the body starts (None if the headers have not ended).
+	"""
+	if start == 0:
+		for terminator in ['\n', '\r\n']:
+			if data.startswith(terminator):
+				return (0, len(terminator))
+	match = HEADERS_END.search(data, start)
+	if match is None:
+		return (len(data), None)
+	return (match.start(), match.end())
+
+def ignored(pathname):
+	"""The reason that the given file in the inbound directory is to be left
+	alone (because it is one of SMSTools' own files, rather than a message),
+	or None if it is a message.
+	"""
+	filename = os.path.basename(pathname)
+	if os.path.splitext(filename)[0] == 'smsd_script':
+		return 'SMSTools script'
+	if filename.find('-concatenated') != -1:
+		return 'concatenated SMSTools transitional message'
+	return None
+
+def parse_headers(data, warn=True):
+	"""Parse the header lines of an SMSTools message file into a dictionary
+	of lowercased header names to header values.
+	"""
+	headers = {}
+	for line in data.split('\n'):
+		(key, separator, value) = line.partition(':')
+		if not separator:
+			if warn and line.strip():
+				logger.warn('skipping invalid header: "%s"' % (line))
+			continue
+		headers[key.strip().lower()] = value.strip()
+	return headers
+
+def parse_message(data, location=None):
+	"""Parse the contents of an SMSTools message file (a byte string).  Returns a tuple of
+	the headers of the message (a dictionary of lowercased header names to
+	header values) and the body of the message, decoded according to its
+	"Alphabet" header; the body is None if the message has no body.
+	"""
+	# The headers end at the first empty line.
+	(headers_end, body_start) = find_body(data)
+	headers = parse_headers(data[:headers_end])
+
+	if body_start is None:
+		logger.warn('no message body found in %s' % (location))
+		return (headers, None)
+	if headers.has_key('alphabet'):
+		codec = ALPHABETS.get(headers['alphabet'].lower())
+		if codec is None:
+			logger.warn('unknown message encoding header encountered (%s), defaulting to latin-1' % (headers['alphabet']))
+			codec = 'latin-1'
+	else:
+		logger.warn('no message encoding header encountered, defaulting to latin-1')
+		codec = 'latin-1'
+	# Decode the body straight out of the buffer, without copying it first.
+	return (headers, unicode(buffer(data, body_start), codec, 'replace'))
+
+def parse_message_file(location):
+	"""Parse the SMSTools message file at the given location (see
+	parse_message), which is read with a single read.
+	"""
+	fd = os.open(location, os.O_RDONLY)
+	try:
+		return parse_message(os.read(fd, os.fstat(fd).st_size), location)
+	finally:
+		os.close(fd)
+
+def parse_message_headers(location):
+	"""Parse only the headers of the SMSTools message file at the given
+	location (see parse_headers), reading no more of the file than it takes
+	to find the end of them.  Invalid headers are not reported; they are
+	when the file is parsed in full (see parse_message_file).
+	"""
+	data = ''
+	with open(location, 'rb') as f:
+		while True:
+			chunk = f.read(HEADER_CHUNK_SIZE)
+			# Only the new chunk (and the two bytes before it, which an empty
+			# line can start in) has not been searched yet.
+			start = max(len(data) - 2, 0)
+			data += chunk
+			(headers_end, body_start) = find_body(data, start)
+			if body_start is not None or chunk == '':
+				break
+	return parse_headers(data[:headers_end], False)
@@ -0,0 +1,568 @@
+import heapq
+import itertools
+import logging
+import os
+import Queue
+import stat
+import tempfile
+import threading
+import time
+from django.conf import settings
+from smirc.message.gsm import segments
+from smirc.message.metrics import pipeline_metrics
+from smirc.message.smstools import find_body
+from smirc.message.smstools import parse_message_headers
+from smirc.remiutilities import LRUCache
+from smirc.remiutilities import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+class OutboundQueue:
+	"""
+	An SMSTools outbound queue (in general, one GSM modem and its phone
+	number) that messages can be sent through: the directory that message
+	files are published to, the phone number that they are sent from and,
+	optionally, the name of the SMSTools queue that they are for (given to
+	SMSTools in a "Queue" header).
+
+	If given a rate (in messages per minute), message files are released to
+	SMSTools no faster than that, in bursts of at most burst files (see
+	OutboundSpool.release); until then, they are held in the staging
+	directory.
+
+	The depth of a queue (the number of message files in its directory that
+	SMSTools has not sent yet) is counted at most every depth_seconds, and
+	is kept up to date in between by counting the files that we publish.
+	"""
+	def __init__(self, name, outbound_dir, phone_number, queue=None, rate=None, burst=1, depth_seconds=1):
+		self.bucket = None
+		if rate:
+			self.bucket = TokenBucket(rate / 60.0, burst)
+		self.depth = 0
+		self.depth_checked = 0
+		self.depth_seconds = depth_seconds
+		self.disabled_until = 0
+		self.failures = 0
+		self.held = []
+		self.name = name
+		self.outbound_dir = outbound_dir
+		self.phone_number = phone_number
+		self.published = 0
+		self.queue = queue
+		self.saved = 0
+
+	def headers(self):
+		headers = 'From: %s\n' % (self.phone_number)
+		if self.queue:
+			headers += 'Queue: %s\n' % (self.queue)
+		return headers
+
+	def load(self, now):
+		if now - self.depth_checked >= self.depth_seconds:
+			try:
+				self.depth = len(os.listdir(self.outbound_dir))
+			except OSError as e:
+				logger.error('could not count the message files in outbound directory %s: %s' % (self.outbound_dir, e))
+			self.depth_checked = now
+		return self.depth + len(self.held)
+
+	def stats(self):
+		return {
+			'depth': self.depth,
+			'disabled': self.disabled_until > time.time(),
+			'failures': self.failures,
+			'held': len(self.held),
+			'published': self.published,
+			'saved': self.saved
+		}
+
+class OutboundSpool:
+	"""
+	Writes outbound messages into SMSTools outbound queues from a dedicated
+	writer thread, so that the code that sends a message does not
+	block on disk I/O; sending a message to any number of recipients is a
+	single call to enqueue.
+
+	Every message file is built in memory and written in full to a staging
+	directory (which must be on the same filesystem as the outbound directory,
+	and which SMSTools does not look at), and is then published to SMSTools by
+	renaming it into the outbound directory, so SMSTools never sees a partially
+	written file.  A file is written as <phone number>-<random>.<priority>.tmp
+	and renamed to .smircd once it has been written in full, so the files that
+	are left in the staging directory when smircd stops (or dies) can be told
+	apart, and the complete ones are held again when it restarts (see
+	recover).  The writer handles the messages that are queued in batches
+	(of up to batch_size messages), and syncs the staging directory once per
+	batch, after all of the files of the batch have been renamed, rather than
+	every file; likewise every outbound directory is synced once per batch,
+	after all of the files of the batch have been published.  The files of the
+	last batch can therefore be lost (or truncated) if the host, rather than
+	smircd, goes down; those without a "to" header are not recovered.
+
+	Every message has a priority (PRIORITY_SYSTEM for replies to commands,
+	PRIORITY_INVITATION for invitations and PRIORITY_CHAT for chat messages).
+	Files are released to a queue as fast as its rate allows, highest priority
+	(then oldest) first, so a reply to a command never waits behind a large
+	chat fan-out to a slow modem.  Files that are still held when the spool
+	is stopped are left in the staging directory, to be released at the
+	rate of their queue once smircd restarts.
+
+	If given a coalesce_seconds, the chat messages for a recipient that arrive
+	within coalesce_seconds of the first of them are merged (one per line,
+	each with its own attribution) into as few SMS as they fit in (see
+	fits); the merged SMS are written once the window is over, or as soon
+	as the next message does not fit.  The number of SMS that are saved is
+	counted per queue.
+
+	Every recipient is routed to one of the given OutboundQueues (see route):
+	the queue of the modem that the numbering prefix of the recipient prefers,
+	if there is one, or else the queue that the recipient was last routed to,
+	so that a conversation keeps coming from the same phone number, or else
+	the least loaded queue (by depth).  A queue that a message file can't be
+	published to is counted as failed, and is avoided (as are the
+	recipients that were routed to it) for retry_seconds.
+
+	The worker processes of smircd do not write outbound messages themselves;
+	they forward them (see forward_to) to the OutboundSpool of the main smircd
+	process (see receive_from), which writes all outbound messages.
+	"""
+	PRIORITY_SYSTEM = 0
+	PRIORITY_INVITATION = 1
+	PRIORITY_CHAT = 2
+	PRIORITY_NAMES = ['system', 'invitation', 'chat']
+
+	def __init__(self, queues, staging_dir, batch_size=64, max_recipients=65536, retry_seconds=60, coalesce_seconds=0):
+		self.assignments = LRUCache(max_recipients)
+		self.batch_size = batch_size
+		self.coalesce_seconds = coalesce_seconds
+		self.coalescing = {}
+		self.forward_queue = None
+		self.outbound_queues = queues
+		self.pid = None
+		self.queue = Queue.Queue()
+		self.receive_queue = None
+		self.receiver = None
+		self.retry_seconds = retry_seconds
+		self.sequence = itertools.count()
+		self.staging_dir = staging_dir
+		self.writer = None
+		self.written = 0
+
+	def enqueue(self, phone_numbers, message, priority=PRIORITY_CHAT):
+		"""Queue the given message (a unicode string) to be sent to each of the
+		given phone numbers, with the given priority.
+		"""
+		if self.forward_queue is not None:
+			self.forward_queue.put((list(phone_numbers), message, priority))
+			return
+		self.start()
+		self.queue.put((list(phone_numbers), message, priority, time.time()))
+
+	def flush(self):
+		"""Wait until every message that has been queued has been written
+		(although not necessarily released to SMSTools), other than the chat
+		messages that are being coalesced.
+		"""
+		if self.pid == os.getpid():
+			self.queue.join()
+
+	def forward_to(self, queue):
+		"""Forward the messages that are queued in this process to the given
+		(multiprocessing) queue, instead of writing them ourselves.
+		"""
+		self.forward_queue = queue
+
+	def receive_from(self, queue):
+		"""Write the messages that other processes forward to the given
+		(multiprocessing) queue.  The messages are received by a thread of
+		their own until stop is called.
+		"""
+		self.receive_queue = queue
+		self.receiver = threading.Thread(target=self.receiver_main, name='outbound-spool-receiver')
+		self.receiver.daemon = True
+		self.receiver.start()
+
+	def receiver_main(self):
+		while True:
+			item = self.receive_queue.get()
+			if item is None:
+				break
+			self.enqueue(*item)
+
+	def route(self, phone_number, now, exclude=None):
+		"""The OutboundQueue to send messages to the given phone number
+		through (other than the given queue).
+		"""
+		queues = [q for q in self.outbound_queues if q is not exclude and q.disabled_until <= now]
+		if len(queues) == 0:
+			queues = [q for q in self.outbound_queues if q is not exclude] or self.outbound_queues
+		if len(self.outbound_queues) == 1:
+			return queues[0]
+		# Phone numbers come to us as strings (from message files) and as integers
+		# (from rosters).
+		phone_number = str(phone_number)
+		prefix = AreaCode.lookup_phone_number(phone_number)
+		if prefix is not None and prefix.modem:
+			for q in queues:
+				if q.name == prefix.modem:
+					return q
+		name = self.assignments.get(phone_number)
+		for q in queues:
+			if q.name == name:
+				return q
+		q = min(queues, key=lambda q: q.load(now))
+		self.assignments.set(phone_number, q.name)
+		return q
+
+	def start(self):
+		# A writer thread that was started before this process was forked does
+		# not exist in this process, so it needs to be started again.
+		if self.pid == os.getpid() and self.writer.is_alive():
+			return
+		self.pid = os.getpid()
+		self.writer = threading.Thread(target=self.writer_main, name='outbound-spool-writer')
+		self.writer.daemon = True
+		self.writer.start()
+
+	def stop(self):
+		"""Stop receiving forwarded messages, write every message that has been
+		queued and stop the writer thread.  Messages that are held are left in
+		the staging directory (see recover).
+		"""
+		if self.receiver is not None:
+			self.receive_queue.put(None)
+			self.receiver.join()
+			self.receiver = None
+		if self.pid == os.getpid() and self.writer.is_alive():
+			self.queue.put(None)
+			self.writer.join()
+			logger.info('outbound spool wrote %d message file(s), %d left held in %s, queues: %s' % (self.written, sum([len(q.held) for q in self.outbound_queues]), self.staging_dir, self.stats()))
+
+	def stats(self):
+		"""The load of (and number of messages published to and failures of)
+		each of our queues, or None in processes that forward their messages.
+		"""
+		if self.forward_queue is not None:
+			return None
+		return dict([(q.name, q.stats()) for q in self.outbound_queues])
+
+	def write(self, q, phone_number, headers, encoded_message, priority):
+		"""Write the given message file, for the given queue, to the staging
+		directory.  Returns the (open) file and its path.
+		"""
+		return self.write_file(phone_number, priority, headers + q.headers().encode('latin-1') + ('To: %s\n\n' % (phone_number)).encode('latin-1') + encoded_message)
+
+	def write_file(self, phone_number, priority, data):
+		"""Write a message file with the given contents to the staging
+		directory, as a .tmp file until it is completed (see complete).  Returns
+		the (open) file and its path.
+		"""
+		(fd, path) = tempfile.mkstemp('.%d.tmp' % (priority), '%s-' % (phone_number), self.staging_dir, True)
+		os.fchmod(fd, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP)
+		f = os.fdopen(fd, 'w')
+		f.write(data)
+		f.flush()
+		return (f, path)
+
+	def coalesce(self, staged, phone_number, message, queued, now):
+		"""Add the given chat message to the messages that are being coalesced
+		for the given phone number, first writing those out if it does not fit
+		in with them.
+		"""
+		phone_number = str(phone_number)
+		pending = self.coalescing.get(phone_number)
+		if pending is not None:
+			if fits(pending[2] + [message]):
+				pending[2].append(message)
+				return
+			self.stage_coalesced(staged, phone_number, now)
+		self.coalescing[phone_number] = [now + self.coalesce_seconds, queued, [message]]
+
+	def coalesce_wait(self, now):
+		"""The number of seconds until the coalescing window of a recipient is
+		over, or None if no messages are being coalesced.
+		"""
+		if len(self.coalescing) == 0:
+			return None
+		return max(0, min([deadline for (deadline, _unused_queued, _unused_messages) in self.coalescing.itervalues()]) - now)
+
+	def failed(self, q, now):
+		q.failures += 1
+		if q.disabled_until <= now and len(self.outbound_queues) > 1:
+			logger.error('outbound queue %s failed, avoiding it for %d seconds' % (q.name, self.retry_seconds))
+		q.disabled_until = now + self.retry_seconds
+
+	def complete(self, f, path):
+		"""Close the given file from write_file and give it its final (.smircd)
+		name.  The staging directory is synced by the caller, once for all of
+		the files that it completes.  Returns its new path.
+		"""
+		f.close()
+		completed = '%s.smircd' % (path[:-len('.tmp')])
+		os.rename(path, completed)
+		return completed
+
+	def move(self, item, q, other):
+		"""Move the given held message file from queue q (which may be None) to
+		queue other, rewriting its From (and Queue) headers for other.  Returns
+		the item of the moved file, or None if it could not be rewritten.
+		"""
+		(priority, sequence, queued, phone_number, path) = item
+		try:
+			with open(path, 'rb') as f:
+				data = f.read()
+			(headers_end, body_start) = find_body(data)
+			if body_start is None:
+				body_start = len(data)
+			headers = [line for line in data[:headers_end].split('\n') if not line.partition(':')[0].strip().lower() in ['from', 'queue']]
+			(f, moved) = self.write_file(phone_number, priority, other.headers().encode('latin-1') + '\n'.join(headers) + '\n\n' + data[body_start:])
+			moved = self.complete(f, moved)
+			os.unlink(path)
+			fsync_directory(self.staging_dir)
+		except (IOError, OSError) as e:
+			logger.exception('exception occurred while moving message %s to outbound queue %s: %s' % (path, other.name, e))
+			return None
+		return (priority, sequence, queued, phone_number, moved)
+
+	def release(self, now):
+		"""Release the held message files of each queue to SMSTools, highest
+		priority first, for as long as the rate of the queue allows.  Queues
+		that have failed are not released to until they are retried.
+		"""
+		synced = set()
+		for q in self.outbound_queues:
+			if q.disabled_until > now:
+				continue
+			while len(q.held) > 0 and (q.bucket is None or q.bucket.take(now)):
+				item = heapq.heappop(q.held)
+				(priority, _unused_sequence, queued, phone_number, path) = item
+				try:
+					os.rename(path, '%s/%s' % (q.outbound_dir, os.path.basename(path)))
+				except OSError as e:
+					logger.error('could not publish message %s to outbound queue %s: %s' % (path, q.name, e))
+					self.failed(q, now)
+					self.assignments.discard(str(phone_number))
+					# Send it through another queue that has not failed, if there is one;
+					# otherwise hold it until this one is retried.
+					other = self.route(phone_number, now, q)
+					moved = None
+					if other is not q and other.disabled_until <= now:
+						moved = self.move(item, q, other)
+					if moved is None:
+						heapq.heappush(q.held, item)
+						break
+					heapq.heappush(other.held, moved)
+					continue
+				q.depth += 1
+				q.published += 1
+				synced.add(q.outbound_dir)
+				self.written += 1
+				pipeline_metrics.stage('outbound_%s' % (OutboundSpool.PRIORITY_NAMES[priority])).add((now - queued) * 1000)
+		for outbound_dir in synced:
+			fsync_directory(outbound_dir)
+
+	def recover(self):
+		"""Hold the message files that were left in the staging directory when
+		smircd last stopped (because it died, or because they could not be
+		published), so that they are released like any other once the writer
+		is started (see start).  Files that were not completely written are
+		discarded.  This must be called before any messages are queued.
+		Returns the number of files that were recovered.
+		"""
+		now = time.time()
+		recovered = 0
+		for filename in sorted(os.listdir(self.staging_dir)):
+			path = '%s/%s' % (self.staging_dir, filename)
+			if filename.endswith('.tmp'):
+				logger.warning('discarding incompletely written outbound message file %s' % (path))
+				os.unlink(path)
+				continue
+			if not filename.endswith('.smircd'):
+				continue
+			try:
+				priority = int(filename.split('.')[-2])
+			except ValueError:
+				priority = OutboundSpool.PRIORITY_CHAT
+			if priority < 0 or priority >= len(OutboundSpool.PRIORITY_NAMES):
+				priority = OutboundSpool.PRIORITY_CHAT
+			try:
+				headers = parse_message_headers(path)
+				queued = os.stat(path).st_mtime
+			except (IOError, OSError) as e:
+				logger.error('could not read outbound message file %s: %s' % (path, e))
+				continue
+			if not headers.has_key('to'):
+				logger.error('not recovering outbound message file %s, it has no "to" header' % (path))
+				continue
+			item = (priority, self.sequence.next(), queued, headers['to'], path)
+			for q in self.outbound_queues:
+				if q.phone_number == headers.get('from') and (q.queue or '') == headers.get('queue', ''):
+					break
+			else:
+				# The queue that it was written for is no longer configured.
+				q = self.route(headers['to'], now)
+				item = self.move(item, None, q)
+				if item is None:
+					continue
+			heapq.heappush(q.held, item)
+			recovered += 1
+		if recovered > 0:
+			logger.info('recovered %d outbound message file(s) from staging directory %s' % (recovered, self.staging_dir))
+		return recovered
+
+	def release_wait(self, now):
+		"""The number of seconds until the next held message file can be
+		released, or None if there are none.
+		"""
+		wait = None
+		for q in self.outbound_queues:
+			if len(q.held) == 0:
+				continue
+			if q.disabled_until > now:
+				q_wait = q.disabled_until - now
+			elif q.bucket is None:
+				return 0
+			else:
+				q_wait = q.bucket.wait(now)
+			if wait is None or q_wait < wait:
+				wait = q_wait
+		return wait
+
+	def stage(self, staged, phone_number, headers, encoded_message, priority, queued, now):
+		"""Write a message file to the given phone number to the staging
+		directory, adding it to the given list of staged files.  Returns the
+		queue that it was routed to, or None if it could not be written.
+		"""
+		q = self.route(phone_number, now)
+		try:
+			(f, path) = self.write(q, phone_number, headers, encoded_message, priority)
+		except (IOError, OSError) as e:
+			logger.exception('exception occurred while writing message to %s: %s' % (phone_number, e))
+			return None
+		staged.append((q, (priority, self.sequence.next(), queued, phone_number, path), f))
+		return q
+
+	def stage_coalesced(self, staged, phone_number, now):
+		(_unused_deadline, queued, messages) = self.coalescing.pop(phone_number)
+		(headers, encoded_message) = encode(u'\n'.join(messages))
+		q = self.stage(staged, phone_number, headers, encoded_message, OutboundSpool.PRIORITY_CHAT, queued, now)
+		if q is not None and len(messages) > 1:
+			q.saved += len(messages) - 1
+			pipeline_metrics.count('sms_saved', len(messages) - 1)
+
+	def write_batch(self, batch, force=False):
+		"""Write the message files of the given batch of messages (and of the
+		messages whose coalescing window is over, or all of them if forced) to
+		the staging directory, and hold them until they can be released.
+		"""
+		now = time.time()
+		staged = []
+		for (phone_numbers, message, priority, queued) in batch:
+			if priority == OutboundSpool.PRIORITY_CHAT and self.coalesce_seconds > 0:
+				for phone_number in phone_numbers:
+					self.coalesce(staged, phone_number, message, queued, now)
+				continue
+			(headers, encoded_message) = encode(message)
+			for phone_number in phone_numbers:
+				self.stage(staged, phone_number, headers, encoded_message, priority, queued, now)
+		for (phone_number, (deadline, _unused_queued, _unused_messages)) in self.coalescing.items():
+			if force or deadline <= now:
+				self.stage_coalesced(staged, phone_number, now)
+
+		for (q, item, f) in staged:
+			try:
+				path = self.complete(f, item[-1])
+			except (IOError, OSError) as e:
+				logger.exception('exception occurred while writing message %s: %s' % (item[-1], e))
+			else:
+				heapq.heappush(q.held, item[:-1] + (path,))
+		if len(staged) > 0:
+			fsync_directory(self.staging_dir)
+			logger.debug('staged %d message file(s) from a batch of %d message(s)', len(staged), len(batch))
+
+	def writer_main(self):
+		stopping = False
+		while not stopping:
+			now = time.time()
+			waits = [wait for wait in [self.release_wait(now), self.coalesce_wait(now)] if wait is not None]
+			wait = None
+			if len(waits) > 0:
+				wait = min(waits)
+			batch = []
+			try:
+				if wait is None:
+					batch.append(self.queue.get())
+				elif wait > 0:
+					batch.append(self.queue.get(True, wait))
+			except Queue.Empty:
+				pass
+			while len(batch) < self.batch_size:
+				try:
+					batch.append(self.queue.get_nowait())
+				except Queue.Empty:
+					break
+			if None in batch:
+				stopping = True
+				batch = [item for item in batch if item is not None]
+			try:
+				self.write_batch(batch, stopping)
+				self.release(time.time())
+			except Exception as e:
+				logger.exception('unhandled exception occurred while writing outbound messages: %s' % (e))
+			for _unused_i in xrange(len(batch) + int(stopping)):
+				self.queue.task_done()
+
+def encode(message):
+	"""The headers (Alphabet, and Autosplit for a message that takes more than
+	one SMS) and the encoded body of a message file of the given message (a
+	unicode string).
+	"""
+	(message_alphabet, count) = segments(message)
+	# SMSTools converts latin-1 (and UTF-8) message files to the GSM alphabet, so
+	# only messages with characters outside of it are sent as UCS2 (and take up to
+	# 70 characters per SMS, rather than 160).  The few characters of the GSM
+	# alphabet that latin-1 does not have (i.e. the euro sign and the Greek
+	# capitals) are written in UTF-8.
+	if message_alphabet == 'GSM':
+		try:
+			(encoding, encoded_message) = ('Ansi', ('%s\n' % (message)).encode('latin-1'))
+		except UnicodeEncodeError:
+			(encoding, encoded_message) = ('UTF-8', ('%s\n' % (message)).encode('utf-8'))
+	else:
+		(encoding, encoded_message) = ('Unicode', ('%s\n' % (message)).encode('utf-16-be'))
+	headers = 'Alphabet: %s\n' % (encoding)
+	if count > 1:
+		# Split into a concatenated SMS (with a user data header).
+		headers += 'Autosplit: 3\n'
+	return (headers.encode('latin-1'), encoded_message)
+
+def fsync_directory(path):
+	"""Sync the given directory, so that the files that were renamed into (or
+	out of) it stay renamed.
+	"""
+	fd = os.open(path, os.O_RDONLY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+def fits(messages):
+	"""Whether the given messages, one per line, fit in a single SMS."""
+	return segments(u'\n'.join(messages))[1] == 1
+
+def outbound_queues():
+	"""The OutboundQueues of SMSTOOLS['outbound_queues'] or, if there are
+	none, a single queue of SMSTOOLS['outbound_dir'] and SMIRC_PHONE_NUMBER.
+	"""
+	queues = []
+	for q in settings.SMSTOOLS['outbound_queues']:
+		queues.append(OutboundQueue(q['name'], q.get('outbound_dir', settings.SMSTOOLS['outbound_dir']), q.get('phone_number', settings.SMIRC_PHONE_NUMBER), q.get('queue'), q.get('rate', settings.SMSTOOLS['outbound_rate']), q.get('burst', settings.SMSTOOLS['outbound_burst'])))
+	if len(queues) == 0:
+		queues.append(OutboundQueue('default', settings.SMSTOOLS['outbound_dir'], settings.SMIRC_PHONE_NUMBER, None, settings.SMSTOOLS['outbound_rate'], settings.SMSTOOLS['outbound_burst']))
+	return queues
+
+outbound_spool = OutboundSpool(outbound_queues(), settings.SMSTOOLS['outbound_staging_dir'], retry_seconds=settings.SMSTOOLS['outbound_queue_retry_seconds'], coalesce_seconds=settings.SMSTOOLS['coalesce_seconds'])
+
+# We import smirc.* modules at the bottom (instead of at the top) as a fix for
+# circular import problems.
+from smirc.message.models import AreaCode
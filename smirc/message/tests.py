@@ -5,7 +5,755 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
+import datetime
+import imp
+import json
+import logging
+import os
+import Queue
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import zlib
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
 from django.test import TestCase
+from smirc.chat.models import Conversation
+from smirc.chat.models import Membership
+from smirc.message.archive import MessageArchive
+from smirc.message.claim import InboundClaims
+from smirc.message.claim import list_messages
+from smirc.message.gsm import segments
+from smirc.message.gsm import truncate
+from smirc.message.history import MessageHistoryBuffer
+from smirc.message.history import purge_message_history
+from smirc.message.metrics import PipelineMetrics
+from smirc.message.metrics import QueryCountingCursor
+from smirc.message.models import AreaCode
+from smirc.message.models import MessageHistory
+from smirc.message.models import NumberingPrefix
+from smirc.message.models import SMSToolsMessage
+from smirc.message.smstools import HEADER_CHUNK_SIZE
+from smirc.message.smstools import parse_message
+from smirc.message.smstools import parse_message_headers
+from smirc.message.spool import OutboundQueue
+from smirc.message.spool import OutboundSpool
+from smirc.message.spool import encode
+from smirc.remiutilities import AsyncLogHandler
+from smirc.remiutilities import EventLoop
+from smirc.remiutilities import PrefixTrie
+from smirc.remiutilities import RollingHistogram
+from smirc.remiutilities import SamplingProfiler
+
+# smircd is a script, not a module of any of our packages.
+smircd = imp.load_source('smircd', os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'smircd.py'))
+
+class AsyncLogHandlerTest(TestCase):
+	class BlockedHandler(logging.Handler):
+		def __init__(self):
+			logging.Handler.__init__(self)
+			self.messages = []
+			self.unblocked = threading.Event()
+
+		def emit(self, record):
+			self.unblocked.wait()
+			self.messages.append(record.getMessage())
+
+	def test_emit(self):
+		target = AsyncLogHandlerTest.BlockedHandler()
+		handler = AsyncLogHandler(target, 2)
+		handler.handle(logging.makeLogRecord({ 'msg': 'record 0' }))
+		while len(handler.records) > 0:
+			time.sleep(0.01)
+		# The listener is blocked on record 0, two more records fit and the rest
+		# are dropped (and reported).
+		for i in range(1, 6):
+			handler.handle(logging.makeLogRecord({ 'msg': 'record %d', 'args': (i,) }))
+		target.unblocked.set()
+		handler.flush()
+		self.assertEqual(target.messages, ['record 0', 'logging queue overflowed, 3 record(s) dropped', 'record 1', 'record 2'])
+		handler.handle(logging.makeLogRecord({ 'msg': 'record 6' }))
+		handler.close()
+		self.assertEqual(target.messages[-1], 'record 6')
+
+class EventLoopTest(TestCase):
+	def setUp(self):
+		self.loop = EventLoop()
+		# Don't let a broken loop hang the tests.
+		self.loop.call_later(5, self.loop.stop)
+
+	def tearDown(self):
+		self.loop.close()
+
+	def test_timers(self):
+		calls = []
+		self.loop.call_later(0.03, calls.append, 'c')
+		self.loop.call_later(0.01, calls.append, 'a')
+		self.loop.call_later(0.02, calls.append, 'x').cancel()
+		self.loop.call_later(0.01, calls.append, 'b')
+		self.loop.call_later(0.04, self.loop.stop)
+		self.loop.run_forever()
+		self.assertEqual(calls, ['a', 'b', 'c'])
+
+	def test_executor_callbacks_run_on_loop_thread(self):
+		results = []
+		def done(result, exception):
+			results.append((result, exception, threading.current_thread().name))
+			if len(results) == 2:
+				self.loop.stop()
+		def fail():
+			raise ValueError('failed')
+		self.loop.run_in_executor(lambda x: (x * 2, threading.current_thread().name), (21,), done)
+		self.loop.run_in_executor(fail, (), done)
+		self.loop.run_forever()
+		self.assertEqual(results[0], ((42, 'executor-0'), None, threading.current_thread().name))
+		self.assertEqual((results[1][0], str(results[1][1]), results[1][2]), (None, 'failed', threading.current_thread().name))
+
+	def test_signal_handlers_run_on_loop_thread(self):
+		previous = signal.getsignal(signal.SIGUSR2)
+		received = []
+		def handler(signum):
+			received.append((signum, threading.current_thread().name))
+			self.loop.stop()
+		try:
+			self.loop.add_signal_handler(signal.SIGUSR2, handler, signal.SIGUSR2)
+			self.loop.call_soon(os.kill, os.getpid(), signal.SIGUSR2)
+			self.loop.run_forever()
+		finally:
+			signal.signal(signal.SIGUSR2, previous)
+		self.assertEqual(received, [(signal.SIGUSR2, threading.current_thread().name)])
+
+	def test_stop_from_another_thread(self):
+		# The loop sleeps until its next timer (in 5 seconds) unless stop wakes it.
+		stopper = threading.Timer(0.05, self.loop.stop)
+		stopper.start()
+		started = time.time()
+		self.loop.run_forever()
+		stopper.join()
+		self.assertTrue(time.time() - started < 1)
+		self.assertFalse(self.loop.is_running())
+
+class InboundBacklogTest(TestCase):
+	class Handler:
+		claims = None
+
+		def __init__(self):
+			self.active = 0
+			self.condition = threading.Condition()
+			self.max_active = 0
+			# sender -> pathnames, in the order that they were processed
+			self.processed = {}
+
+		def claim(self, pathname):
+			return pathname
+
+		def process_file(self, pathname):
+			sender = SMSToolsMessage.raw_sender(pathname)
+			with self.condition:
+				self.processed.setdefault(sender, []).append(pathname)
+				# Wait (once) for the lane of the other sender to be processing too.
+				self.active += 1
+				self.condition.notify_all()
+				deadline = time.time() + 2
+				while self.active < 2 and self.max_active < 2 and time.time() < deadline:
+					self.condition.wait(deadline - time.time())
+				self.max_active = max(self.max_active, self.active)
+				self.active -= 1
+			return True
+
+	def setUp(self):
+		self.inbound_dir = tempfile.mkdtemp()
+		self.smstools = settings.SMSTOOLS
+		settings.SMSTOOLS = dict(self.smstools, backlog_batch_size=4, inbound_dir=self.inbound_dir)
+
+	def tearDown(self):
+		settings.SMSTOOLS = self.smstools
+		shutil.rmtree(self.inbound_dir)
+
+	def test_drain_by_sender_in_order_of_arrival(self):
+		senders = ['17805550100', '17805550101']
+		expected = {}
+		now = time.time()
+		for i in xrange(8):
+			# Newer files have older names, so only their times give their order.
+			path = '%s/GSM1.%d' % (self.inbound_dir, 7 - i)
+			with open(path, 'w') as f:
+				f.write('From: %s\n\nhello %d\n' % (senders[i % 2], i))
+			os.utime(path, (now - 60 + i, now - 60 + i))
+			expected.setdefault(senders[i % 2], []).append(path)
+		handler = InboundBacklogTest.Handler()
+		self.assertEqual(smircd.drain_inbound_backlog(handler), 8)
+		self.assertEqual(handler.processed, expected)
+		self.assertEqual(handler.max_active, 2)
+
+class InboundClaimsTest(TestCase):
+	def setUp(self):
+		self.claim_dir = tempfile.mkdtemp()
+		self.inbound_dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.claim_dir)
+		shutil.rmtree(self.inbound_dir)
+
+	def test_claim_and_recover(self):
+		node1 = InboundClaims(self.claim_dir, 'node1', 60)
+		node2 = InboundClaims(self.claim_dir, 'node2', 60)
+		node1.setup()
+		node2.setup()
+		for filename in ['GSM1.1', 'GSM1.2']:
+			with open('%s/%s' % (self.inbound_dir, filename), 'w') as f:
+				f.write('From: 17805550001\n\nhello')
+		# Only one node gets to claim a file.
+		self.assertEqual(node1.claim('%s/GSM1.1' % (self.inbound_dir)), '%s/node1/GSM1.1' % (self.claim_dir))
+		self.assertEqual(node2.claim('%s/GSM1.1' % (self.inbound_dir)), None)
+		self.assertEqual(node1.claimed(), ['%s/node1/GSM1.1' % (self.claim_dir)])
+
+		# Files are only claimed by a scan once they have settled.
+		self.assertEqual(node2.settled(['%s/GSM1.2' % (self.inbound_dir)]), [])
+		self.assertEqual(node2.settled(['%s/GSM1.2' % (self.inbound_dir)]), ['%s/GSM1.2' % (self.inbound_dir)])
+
+		# The claims of node1 are taken over once its heartbeat is older than its lease.
+		node1.heartbeat()
+		now = node2.heartbeat()
+		self.assertEqual(node2.recover(now), [])
+		os.utime('%s/node1.heartbeat' % (self.claim_dir), (now - 61, now - 61))
+		self.assertEqual(node2.recover(now), ['%s/node2/GSM1.1' % (self.claim_dir)])
+		self.assertEqual(node1.claimed(), [])
+		self.assertEqual(sorted(node2.nodes().keys()), ['node1', 'node2'])
+		self.assertEqual((node1.counters, node2.counters), ({ 'claimed': 1, 'lost': 0, 'recovered': 0 }, { 'claimed': 0, 'lost': 1, 'recovered': 1 }))
+
+	def test_smstools_files_are_left_alone(self):
+		node = InboundClaims(self.claim_dir, 'node1', 60)
+		node.setup()
+		for filename in ['GSM1.1', 'smsd_script.sh', 'GSM1.2-concatenated']:
+			with open('%s/%s' % (self.inbound_dir, filename), 'w') as f:
+				f.write('From: 17805550001\n\nhello')
+		self.assertEqual(list_messages(self.inbound_dir), ['%s/GSM1.1' % (self.inbound_dir)])
+		pathnames = ['%s/%s' % (self.inbound_dir, filename) for filename in os.listdir(self.inbound_dir)]
+		node.settled(pathnames)
+		self.assertEqual(node.settled(pathnames), ['%s/GSM1.1' % (self.inbound_dir)])
+
+class MessageArchiveTest(TestCase):
+	def setUp(self):
+		self.archive_dir = tempfile.mkdtemp()
+		self.inbound_dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.archive_dir)
+		shutil.rmtree(self.inbound_dir)
+
+	def inbound(self, filename, phone_number, body):
+		pathname = '%s/%s' % (self.inbound_dir, filename)
+		with open(pathname, 'w') as f:
+			f.write('From: %s\n\n%s' % (phone_number, body))
+		return pathname
+
+	def test_store_and_lookup(self):
+		archive = MessageArchive(self.archive_dir, 128, 3600, 'node1')
+		archive.store(self.inbound('GSM1.1', '17805550001', 'hello'), '17805550001')
+		archive.store(self.inbound('GSM1.2', '17805550002', 'hi'), '17805550002')
+		# The first segment has reached 128 bytes, so this starts another one.
+		archive.store(self.inbound('GSM1.3', '17805550001', 'bye'), '17805550001')
+		archive.close()
+		self.assertEqual(os.listdir(self.inbound_dir), [])
+		(day,) = archive.days(None, None)
+		self.assertEqual(sorted([filename.split('.', 1)[1] for filename in os.listdir(day)]), ['seg.gz', 'seg.gz', 'seg.idx', 'seg.idx'])
+		messages = archive.lookup('17805550001', time.time() - 60, time.time() + 60)
+		self.assertEqual([(filename, data) for (_unused_timestamp, filename, data) in messages], [('GSM1.1', 'From: 17805550001\n\nhello'), ('GSM1.3', 'From: 17805550001\n\nbye')])
+		self.assertEqual(archive.lookup('17805550001', time.time() + 86400 * 2), [])
+
+	def test_inbound_files_are_removed_once_synced(self):
+		archive = MessageArchive(self.archive_dir, 65536, 3600, 'node1', 3, 60)
+		pathnames = [self.inbound('GSM1.%d' % (i), '17805550001', 'hello') for i in xrange(4)]
+		for pathname in pathnames[:2]:
+			archive.store(pathname, '17805550001')
+		self.assertEqual(sorted(os.listdir(self.inbound_dir)), ['GSM1.0', 'GSM1.1', 'GSM1.2', 'GSM1.3'])
+		self.assertTrue(archive.archived(pathnames[0]))
+		self.assertFalse(archive.archived(pathnames[2]))
+		self.assertEqual(len(archive.lookup('17805550001')), 2)
+		# The third message completes the batch.
+		archive.store(pathnames[2], '17805550001')
+		self.assertEqual(os.listdir(self.inbound_dir), ['GSM1.3'])
+		archive.store(pathnames[3], '17805550001')
+		archive.sync_if_stale()
+		self.assertEqual(os.listdir(self.inbound_dir), ['GSM1.3'])
+		archive.unlinks_since -= 60
+		archive.sync_if_stale()
+		self.assertEqual(os.listdir(self.inbound_dir), [])
+		archive.close()
+
+class AreaCodeTest(TestCase):
+	def test_area_codes(self):
+		self.assertTrue(AreaCode.validate_phone_number('17805551234'))
+		self.assertTrue(AreaCode.validate_phone_number('+14035551234'))
+		self.assertFalse(AreaCode.validate_phone_number('12125551234'))
+		self.assertFalse(AreaCode.validate_phone_number('1'))
+		self.assertFalse(AreaCode.validate_phone_number(''))
+
+	def test_numbering_prefixes(self):
+		NumberingPrefix(prefix='44', region='United Kingdom', modem='ACM1').save()
+		NumberingPrefix(prefix='1780555', region='Edmonton', allowed=False).save()
+		self.assertTrue(AreaCode.validate_phone_number('447700900123'))
+		self.assertEqual(AreaCode.lookup_phone_number('447700900123').modem, 'ACM1')
+		self.assertFalse(AreaCode.validate_phone_number('17805551234'))
+		self.assertEqual(AreaCode.lookup_phone_number('17804441234').region, 'Alberta')
+
+	def test_index_follows_changes_made_elsewhere(self):
+		NumberingPrefix(prefix='1780555', region='Edmonton').save()
+		self.assertTrue(AreaCode.validate_phone_number('17805551234'))
+		# An update sends no signals, like a change made by another process.
+		NumberingPrefix.objects.filter(prefix='1780555').update(allowed=False)
+		self.assertTrue(AreaCode.validate_phone_number('17805551234'))
+		AreaCode.index_checked -= settings.SMIRC_AREA_CODE_INDEX['check_seconds']
+		self.assertFalse(AreaCode.validate_phone_number('17805551234'))
+
+class GSMTest(TestCase):
+	def test_segments(self):
+		self.assertEqual(segments(u''), ('GSM', 1))
+		self.assertEqual(segments(u'x' * 160), ('GSM', 1))
+		self.assertEqual(segments(u'x' * 161), ('GSM', 2))
+		self.assertEqual(segments(u'x' * 306), ('GSM', 2))
+		self.assertEqual(segments(u'x' * 307), ('GSM', 3))
+		# Characters of the extension table take two septets.
+		self.assertEqual(segments(u'\u20ac' * 80), ('GSM', 1))
+		self.assertEqual(segments(u'{' * 81), ('GSM', 2))
+		# Greek capitals are in the GSM alphabet; accented characters mostly aren't.
+		self.assertEqual(segments(u'\u03a9' * 160), ('GSM', 1))
+		self.assertEqual(segments(u'\xe1' * 70), ('UCS2', 1))
+		self.assertEqual(segments(u'\xe1' * 71), ('UCS2', 2))
+		self.assertEqual(segments(u'\xe1' * 134), ('UCS2', 2))
+		self.assertEqual(segments(u'\xe1' * 135), ('UCS2', 3))
+
+	def test_truncate(self):
+		self.assertEqual(truncate(u'x' * 500, 3), u'x' * 459)
+		self.assertEqual(truncate(u'x' * 500, 1), u'x' * 160)
+		self.assertEqual(truncate(u'x' * 158 + u'{}', 1), u'x' * 158 + u'{')
+		self.assertEqual(truncate(u'\u263a' * 500, 2), u'\u263a' * 134)
+
+	def test_encode(self):
+		self.assertEqual(encode(u'alice@room: hello'), ('Alphabet: Ansi\n', 'alice@room: hello\n'))
+		self.assertEqual(encode(u'alice@room: 5\u20ac'), ('Alphabet: UTF-8\n', 'alice@room: 5\xe2\x82\xac\n'))
+		self.assertEqual(encode(u'alice@room: \u263a'), ('Alphabet: Unicode\n', u'alice@room: \u263a\n'.encode('utf-16-be')))
+		self.assertEqual(encode(u'x' * 200)[0], 'Alphabet: Ansi\nAutosplit: 3\n')
+
+class MessageHistoryTest(TestCase):
+	def setUp(self):
+		self.conversation = Conversation(name='foo')
+		self.conversation.save()
+		self.user = User(username='alice')
+		self.user.save()
+		self.membership = Membership(conversation=self.conversation, user=self.user)
+		self.membership.save()
+
+	def test_rows_are_buffered(self):
+		history = MessageHistoryBuffer(3, 3600)
+		history.record(self.membership, u'hello', ['17805550001', '17805550002'])
+		history.record(self.membership, u'anyone?', [])
+		history.flush_if_stale()
+		self.assertEqual(MessageHistory.objects.count(), 0)
+		history.record(self.membership, u'bye', ['17805550001'])
+		self.assertEqual(list(MessageHistory.objects.order_by('id').values_list('body', 'recipients', 'recipient_count')), [(u'hello', u'17805550001,17805550002', 2), (u'anyone?', u'', 0), (u'bye', u'17805550001', 1)])
+		history.record(self.membership, u'again', [])
+		history.flush()
+		self.assertEqual(MessageHistory.objects.count(), 4)
+
+	def test_purge(self):
+		for days in [1, 10, 100, 200, 300]:
+			MessageHistory(body=u'x', conversation=self.conversation, received=datetime.datetime.utcnow() - datetime.timedelta(days=days), recipient_count=0, sender=self.user).save()
+		self.assertEqual(purge_message_history(90, 2, 0), 3)
+		self.assertEqual(MessageHistory.objects.count(), 2)
+
+class PipelineMetricsTest(TestCase):
+	def test_rolling_histogram(self):
+		histogram = RollingHistogram(100)
+		self.assertEqual(histogram.stats(), {'count': 0, 'max': None, 'p50': None, 'p95': None, 'p99': None, 'total': 0})
+		for value in xrange(1000, 0, -1):
+			histogram.add(value)
+		self.assertEqual(histogram.stats(), {'count': 1000, 'max': 100, 'p50': 51, 'p95': 96, 'p99': 100, 'total': 500500})
+
+	def test_stats_file(self):
+		metrics = PipelineMetrics(10)
+		metrics.begin_message()
+		with metrics.timer('parse'):
+			cursor = QueryCountingCursor(connection.cursor(), metrics)
+			cursor.execute('SELECT 1')
+			cursor.execute('SELECT 2')
+		metrics.end_message()
+		metrics.count('processed')
+		(fd, path) = tempfile.mkstemp()
+		os.close(fd)
+		try:
+			metrics.write(path)
+			with open(path) as f:
+				stats = json.load(f)
+		finally:
+			os.unlink(path)
+		self.assertEqual(stats['counters'], {'processed': 1})
+		self.assertEqual(sorted(stats['stages'].keys()), ['parse', 'total'])
+		self.assertEqual(stats['queries_per_message']['max'], 2)
+
+class OutboundSpoolTest(TestCase):
+	def setUp(self):
+		self.outbound_dir = tempfile.mkdtemp()
+		self.staging_dir = tempfile.mkdtemp()
+		self.spool = OutboundSpool([OutboundQueue('default', self.outbound_dir, '17807291450')], self.staging_dir, 2)
+
+	def tearDown(self):
+		self.spool.stop()
+		shutil.rmtree(self.outbound_dir)
+		shutil.rmtree(self.staging_dir)
+
+	def test_enqueue(self):
+		self.spool.enqueue(['17805550001', '17805550002', '17805550003'], u'alice: hello')
+		self.spool.enqueue(['17805550001'], u'alice: \u263a')
+		self.spool.flush()
+		self.assertEqual(os.listdir(self.staging_dir), [])
+		files = {}
+		for filename in os.listdir(self.outbound_dir):
+			with open('%s/%s' % (self.outbound_dir, filename)) as f:
+				files.setdefault(filename.split('-')[0], []).append(f.read())
+		self.assertEqual(sorted(files.keys()), ['17805550001', '17805550002', '17805550003'])
+		self.assertTrue('Alphabet: Ansi\n' in files['17805550002'][0])
+		self.assertTrue(files['17805550002'][0].endswith('To: 17805550002\n\nalice: hello\n'))
+		self.assertEqual(sorted([f.split('\n')[0] for f in files['17805550001']]), ['Alphabet: Ansi', 'Alphabet: Unicode'])
+		self.assertEqual(self.spool.stats()['default']['published'], 4)
+
+	def test_priorities(self):
+		q = OutboundQueue('GSM1', self.outbound_dir, '17807291450', rate=60, burst=1)
+		spool = OutboundSpool([q], self.staging_dir)
+		now = time.time()
+		spool.write_batch([(['17805550001', '17805550002'], u'alice: hello', OutboundSpool.PRIORITY_CHAT, now), (['17805550003'], u'SMIRC: invited', OutboundSpool.PRIORITY_INVITATION, now), (['17805550004'], u'SMIRC: who', OutboundSpool.PRIORITY_SYSTEM, now)])
+		self.assertEqual(len(os.listdir(self.staging_dir)), 4)
+		released = []
+		# One message a second, highest priority first.
+		for t in [now, now + 0.5, now + 1, now + 2]:
+			spool.release(t)
+			released.append(sorted([filename.split('-')[0] for filename in os.listdir(self.outbound_dir)]))
+		self.assertEqual(released, [['17805550004'], ['17805550004'], ['17805550003', '17805550004'], ['17805550001', '17805550003', '17805550004']])
+		self.assertAlmostEqual(spool.release_wait(now + 2), 1)
+		spool.release(now + 3)
+		self.assertEqual(os.listdir(self.staging_dir), [])
+		self.assertEqual(spool.release_wait(now + 2), None)
+
+	def test_coalesce(self):
+		q = OutboundQueue('GSM1', self.outbound_dir, '17807291450')
+		spool = OutboundSpool([q], self.staging_dir, coalesce_seconds=5)
+		now = time.time()
+		spool.write_batch([([17805550001, 17805550002], u'alice@room: hello', OutboundSpool.PRIORITY_CHAT, now), ([17805550001], u'bob@room: hi', OutboundSpool.PRIORITY_CHAT, now), ([17805550001], u'SMIRC: who', OutboundSpool.PRIORITY_SYSTEM, now)])
+		spool.release(now)
+		self.assertEqual([filename.split('-')[0] for filename in os.listdir(self.outbound_dir)], ['17805550001'])
+		# A message that doesn't fit in with those that are being coalesced pushes them out.
+		spool.write_batch([([17805550002], u'bob@room: %s' % ('x' * 150), OutboundSpool.PRIORITY_CHAT, now)])
+		spool.write_batch([], True)
+		spool.release(now)
+		files = {}
+		for filename in os.listdir(self.outbound_dir):
+			with open('%s/%s' % (self.outbound_dir, filename)) as f:
+				files.setdefault(filename.split('-')[0], []).append(f.read().split('\n\n', 1)[1])
+		self.assertEqual(sorted(files['17805550001']), ['SMIRC: who\n', 'alice@room: hello\nbob@room: hi\n'])
+		self.assertEqual(sorted(files['17805550002']), ['alice@room: hello\n', 'bob@room: %s\n' % ('x' * 150)])
+		self.assertEqual(spool.stats()['GSM1']['saved'], 1)
+
+	def test_recover(self):
+		q = OutboundQueue('GSM1', self.outbound_dir, '17807291450', rate=1, burst=1)
+		spool = OutboundSpool([q], self.staging_dir)
+		now = time.time()
+		spool.write_batch([(['17805550001', '17805550002'], u'alice: hello', OutboundSpool.PRIORITY_CHAT, now), (['17805550003'], u'SMIRC: who', OutboundSpool.PRIORITY_SYSTEM, now)])
+		spool.release(now)
+		self.assertEqual(len(os.listdir(self.outbound_dir)), 1)
+		# smircd dies with two messages held, and one half written.
+		with open('%s/17805550004-abcdef.2.tmp' % (self.staging_dir), 'w') as f:
+			f.write('Alphabet: Ansi\nFrom: 17807291450\n')
+		q = OutboundQueue('GSM1', self.outbound_dir, '17807291450', rate=1, burst=1)
+		spool = OutboundSpool([q], self.staging_dir)
+		self.assertEqual(spool.recover(), 2)
+		self.assertEqual(sorted([(priority, phone_number) for (priority, _unused_sequence, _unused_queued, phone_number, _unused_path) in q.held]), [(OutboundSpool.PRIORITY_CHAT, '17805550001'), (OutboundSpool.PRIORITY_CHAT, '17805550002')])
+		self.assertEqual(len(os.listdir(self.staging_dir)), 2)
+		# They are released at the rate of their queue, and whatever is still
+		# held when the spool stops is left to be recovered again.
+		spool.start()
+		spool.stop()
+		self.assertEqual((len(os.listdir(self.outbound_dir)), len(os.listdir(self.staging_dir))), (2, 1))
+		spool.release(now + 120)
+		self.assertEqual((len(os.listdir(self.outbound_dir)), os.listdir(self.staging_dir)), (3, []))
+
+	def test_route(self):
+		modem_dirs = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+		try:
+			queues = [OutboundQueue('GSM1', modem_dirs[0], '17807291450'), OutboundQueue('GSM2', modem_dirs[1], '17807291451', 'GSM2')]
+			spool = OutboundSpool(queues, self.staging_dir)
+			NumberingPrefix(prefix='1403', region='Calgary', modem='GSM1').save()
+			# GSM1 has a backlog, so new recipients go to GSM2 (and stay there).
+			with open('%s/backlog' % (modem_dirs[0]), 'w') as f:
+				f.write('To: 17805550009\n\n')
+			now = time.time()
+			self.assertTrue(spool.route('17805550001', now) is queues[1])
+			queues[1].depth = 10
+			self.assertTrue(spool.route('17805550001', now) is queues[1])
+			self.assertTrue(spool.route('17805550002', now) is queues[0])
+			# The preferred modem of a recipient's numbering prefix comes first.
+			self.assertTrue(spool.route('14035550003', now) is queues[0])
+			# Failed queues are avoided, along with the recipients that were routed to them.
+			spool.failed(queues[1], now)
+			self.assertTrue(spool.route('17805550001', now) is queues[0])
+			spool.enqueue([17805550001], u'alice: hello')
+			spool.stop()
+			(filename,) = [filename for filename in os.listdir(modem_dirs[0]) if filename != 'backlog']
+			with open('%s/%s' % (modem_dirs[0], filename)) as f:
+				self.assertEqual(f.read(), 'Alphabet: Ansi\nFrom: 17807291450\nTo: 17805550001\n\nalice: hello\n')
+			self.assertEqual(spool.stats()['GSM2']['failures'], 1)
+			self.assertTrue(spool.stats()['GSM2']['disabled'])
+			self.assertEqual(queues[1].headers(), 'From: 17807291451\nQueue: GSM2\n')
+		finally:
+			for modem_dir in modem_dirs:
+				shutil.rmtree(modem_dir)
+
+	def test_failover(self):
+		modem_dirs = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+		try:
+			queues = [OutboundQueue('GSM1', modem_dirs[0], '17807291450'), OutboundQueue('GSM2', modem_dirs[1], '17807291451', 'GSM2')]
+			spool = OutboundSpool(queues, self.staging_dir, retry_seconds=60)
+			os.rmdir(modem_dirs[1])
+			now = time.time()
+			spool.assignments.set('17805550001', 'GSM2')
+			spool.write_batch([(['17805550001'], u'alice: hello', OutboundSpool.PRIORITY_CHAT, now)])
+			# A message that can't be published is rewritten for, and sent through, another queue.
+			spool.release(now)
+			spool.release(now)
+			(filename,) = os.listdir(modem_dirs[0])
+			with open('%s/%s' % (modem_dirs[0], filename)) as f:
+				self.assertEqual(f.read(), 'From: 17807291450\nAlphabet: Ansi\nTo: 17805550001\n\nalice: hello\n')
+			# If every queue has failed, it is held until the first of them is retried.
+			os.rename(modem_dirs[0], modem_dirs[1])
+			spool.assignments.set('17805550002', 'GSM1')
+			spool.write_batch([(['17805550002'], u'alice: hi', OutboundSpool.PRIORITY_CHAT, now)])
+			spool.release(now)
+			self.assertEqual([len(q.held) for q in queues], [1, 0])
+			self.assertAlmostEqual(spool.release_wait(now), 60)
+			os.rename(modem_dirs[1], modem_dirs[0])
+			spool.release(now + 60)
+			self.assertEqual(len(os.listdir(modem_dirs[0])), 2)
+		finally:
+			for modem_dir in modem_dirs:
+				shutil.rmtree(modem_dir, True)
+
+	def test_failover_with_one_queue(self):
+		q = OutboundQueue('default', self.outbound_dir, '17807291450')
+		spool = OutboundSpool([q], self.staging_dir, retry_seconds=60)
+		now = time.time()
+		spool.write_batch([(['17805550001'], u'alice: hello', OutboundSpool.PRIORITY_CHAT, now)])
+		os.rmdir(self.outbound_dir)
+		spool.release(now)
+		self.assertEqual(len(q.held), 1)
+		self.assertAlmostEqual(spool.release_wait(now), 60)
+		os.mkdir(self.outbound_dir)
+		spool.release(now + 60)
+		self.assertEqual((len(q.held), len(os.listdir(self.outbound_dir)), os.listdir(self.staging_dir)), (0, 1, []))
+
+class PrefixTrieTest(TestCase):
+	def test_longest_prefix(self):
+		trie = PrefixTrie()
+		trie.insert('1', 'nanp')
+		trie.insert('1780', 'edmonton')
+		trie.insert('1780555', 'fictional')
+		trie.insert('44', 'uk')
+		self.assertEqual(len(trie), 4)
+		self.assertEqual(trie.longest_prefix('17805551234'), 'fictional')
+		self.assertEqual(trie.longest_prefix('17804441234'), 'edmonton')
+		self.assertEqual(trie.longest_prefix('12125551234'), 'nanp')
+		self.assertEqual(trie.longest_prefix('4420'), 'uk')
+		self.assertEqual(trie.longest_prefix('33123'), None)
+		self.assertEqual(trie.longest_prefix('33123', 'default'), 'default')
+
+def busy(seconds):
+	deadline = time.time() + seconds
+	while time.time() < deadline:
+		pass
+
+class SamplingProfilerTest(TestCase):
+	def test_profile(self):
+		profiler = SamplingProfiler(0.001, 5, busy.func_code)
+		profiler.start()
+		worker = threading.Thread(target=busy, args=(0.2,))
+		worker.start()
+		worker.join()
+		profiler.stop()
+		self.assertTrue(profiler.stacks > 0)
+		# Only the stacks of the busy thread are counted, from busy inwards.
+		self.assertEqual(profiler.cumulative.keys(), [SamplingProfiler.function_name(busy.func_code)])
+		self.assertTrue(profiler.summary().startswith(SamplingProfiler.function_name(busy.func_code)))
+
+class SMSWorkerPoolTest(TestCase):
+	class Worker:
+		exitcode = None
+
+		def __init__(self):
+			self.alive = True
+
+		def is_alive(self):
+			return self.alive
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.pool = smircd.SMSWorkerPool(3)
+		self.started = []
+		# Workers that are never forked, with queues that we can read back.
+		def start_worker(index):
+			self.pool.queues[index] = Queue.Queue()
+			self.pool.workers[index] = SMSWorkerPoolTest.Worker()
+			self.started.append(index)
+		self.pool.start_worker = start_worker
+		for index in xrange(self.pool.size):
+			self.pool.start_worker(index)
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def message(self, name, sender):
+		path = os.path.join(self.dir, name)
+		with open(path, 'w') as f:
+			f.write('From: %s\n\nhello\n' % (sender))
+		return path
+
+	def queued(self, index):
+		queue = self.pool.queues[index]
+		pathnames = []
+		while not queue.empty():
+			pathnames.append(queue.get())
+		return pathnames
+
+	def test_dispatch_routes_by_sender(self):
+		senders = ['17805550100', '17805550101', '17805550102', '17805550103']
+		expected = dict([(index, []) for index in xrange(self.pool.size)])
+		for i in xrange(12):
+			sender = senders[i % len(senders)]
+			path = self.message('GSM1.%02d' % (i), sender)
+			self.pool.dispatch(path)
+			expected[(zlib.crc32(sender) & 0xffffffff) % self.pool.size].append(path)
+		self.assertTrue(len([index for index in expected if len(expected[index]) > 0]) > 1)
+		for index in xrange(self.pool.size):
+			self.assertEqual(self.queued(index), expected[index])
+
+	def test_dead_worker_messages_are_requeued(self):
+		sender = '17805550100'
+		index = (zlib.crc32(sender) & 0xffffffff) % self.pool.size
+		paths = [self.message('GSM1.%02d' % (i), sender) for i in xrange(4)]
+		for path in paths[:3]:
+			self.pool.dispatch(path)
+		# The worker processes (archives) the first file, then dies.
+		os.unlink(paths[0])
+		self.pool.workers[index].alive = False
+		self.pool.workers[index].exitcode = -9
+		self.pool.dispatch(paths[3])
+		self.assertEqual(self.started, [0, 1, 2, index])
+		self.assertEqual(self.queued(index), paths[1:])
+		self.pool.prune()
+		self.assertEqual(sorted(self.pool.routed.keys()), paths[1:])
+
+class SMSFileHandlerTest(TestCase):
+	class Event:
+		def __init__(self, pathname):
+			self.pathname = pathname
+
+	class Pool:
+		def __init__(self):
+			self.dispatched = []
+
+		def dispatch(self, pathname):
+			self.dispatched.append(pathname)
+
+		def prune(self):
+			pass
+
+	def setUp(self):
+		self.inbound_dir = tempfile.mkdtemp()
+		self.smstools = settings.SMSTOOLS
+		settings.SMSTOOLS = dict(self.smstools, inbound_dir=self.inbound_dir)
+		self.pool = SMSFileHandlerTest.Pool()
+		self.handler = smircd.SMSFileHandler(pool=self.pool)
+
+	def tearDown(self):
+		settings.SMSTOOLS = self.smstools
+		shutil.rmtree(self.inbound_dir)
+
+	def message(self, filename, mtime):
+		path = '%s/%s' % (self.inbound_dir, filename)
+		with open(path, 'w') as f:
+			f.write('From: 17805550100\n\nhello\n')
+		os.utime(path, (mtime, mtime))
+		return path
+
+	def test_pending_events_are_coalesced(self):
+		path = self.message('GSM1.1', time.time())
+		self.handler.process_IN_CLOSE_WRITE(SMSFileHandlerTest.Event(path))
+		self.handler.process_IN_MOVED_TO(SMSFileHandlerTest.Event(path))
+		self.assertEqual(self.pool.dispatched, [path])
+		self.assertEqual(self.handler.coalesced, 1)
+		# Once it has been processed, a new file of the same name is a new message.
+		os.unlink(path)
+		self.handler.prune_pending()
+		self.assertEqual(self.handler.pending, {})
+		self.message('GSM1.1', time.time())
+		self.handler.process_IN_CLOSE_WRITE(SMSFileHandlerTest.Event(path))
+		self.assertEqual(self.pool.dispatched, [path, path])
+
+	def test_queue_overflow_rescans_inbound_directory(self):
+		now = time.time()
+		paths = [self.message('GSM1.%d' % (3 - i), now - 60 + i) for i in xrange(3)]
+		self.message('smsd_script.sh', now - 120)
+		self.handler.process_IN_CLOSE_WRITE(SMSFileHandlerTest.Event(paths[1]))
+		# Events for the other files were lost.
+		self.handler.process_IN_Q_OVERFLOW(SMSFileHandlerTest.Event(None))
+		self.assertEqual(self.pool.dispatched, [paths[1], paths[0], paths[2]])
+		self.assertEqual(self.handler.coalesced, 1)
+
+class SMSToolsParserTest(TestCase):
+	def test_parse_message(self):
+		(headers, body) = parse_message('From: 17805551234\nAlphabet: ISO\n\n@room caf\xe9\nbye\n')
+		self.assertEqual(headers, {'from': '17805551234', 'alphabet': 'ISO'})
+		self.assertEqual(body, u'@room caf\xe9\nbye\n')
+		(headers, body) = parse_message('From: 17805551234\nAlphabet: UCS2\n\n' + u'\u263a: x'.encode('utf-16-be'))
+		self.assertEqual(body, u'\u263a: x')
+
+	def test_parse_malformed_message(self):
+		(headers, body) = parse_message('From: 17805551234\nnot a header\nAlphabet: Klingon\n\nhello')
+		self.assertEqual(headers, {'from': '17805551234', 'alphabet': 'Klingon'})
+		self.assertEqual(body, u'hello')
+		(headers, body) = parse_message('From: 17805551234\nhello')
+		self.assertEqual(headers, {'from': '17805551234'})
+		self.assertEqual(body, None)
+		(headers, body) = parse_message('\nhello')
+		self.assertEqual(headers, {})
+		self.assertEqual(body, u'hello')
+		(headers, body) = parse_message('From: 17805551234\r\nAlphabet: ISO\r\n\r\nhello\r\n')
+		self.assertEqual(headers, {'from': '17805551234', 'alphabet': 'ISO'})
+		self.assertEqual(body, u'hello\r\n')
+
+	def test_parse_message_headers(self):
+		(fd, path) = tempfile.mkstemp()
+		try:
+			os.write(fd, 'Alphabet: ISO\r\nFrom: 17805551234\r\n\r\nTo: 17805559999\n' + 'x' * 10000)
+			os.close(fd)
+			self.assertEqual(parse_message_headers(path), {'from': '17805551234', 'alphabet': 'ISO'})
+			self.assertEqual(SMSToolsMessage.raw_sender(path), '17805551234')
+		finally:
+			os.unlink(path)
+
+	def test_parse_message_headers_across_chunks(self):
+		# The empty line that ends the headers straddles two chunks.
+		headers = 'From: 17805551234\r\nSubject: %s\r\n' % ('s' * (HEADER_CHUNK_SIZE - 31))
+		self.assertEqual(len(headers), HEADER_CHUNK_SIZE - 1)
+		(fd, path) = tempfile.mkstemp()
+		try:
+			os.write(fd, headers + '\r\nTo: 17805559999\n' + 'x' * 10000)
+			os.close(fd)
+			self.assertEqual(parse_message_headers(path)['from'], '17805551234')
+			self.assertFalse(parse_message_headers(path).has_key('to'))
+		finally:
+			os.unlink(path)
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -1,5 +1,21 @@
 __version__ = '$Rev: 1784 $'
 
+import atexit
+import collections
+import copy
+import errno
+import fcntl
+import heapq
+import itertools
+import logging
+import os
+import Queue
+import select
+import signal
+import socket
+import sys
+import threading
+import time
 from logging.handlers import SysLogHandler
 try:
 	import codecs
@@ -7,6 +23,480 @@ except ImportError:
 	codecs = None
 import types
 
+logger = logging.getLogger(__name__)
+
+class AsyncLogHandler(logging.Handler):
+	"""
+	A logging handler that hands records off to another (slow, i.e. syslog)
+	handler, so that the threads that log never block on it; the records are
+	formatted and emitted by a listener thread.  At most max_records records
+	are held; when that many are waiting, records are dropped (and counted)
+	instead, and the number of dropped records is reported through the target
+	handler once the listener catches up.
+
+	Records are handed off without taking any lock (through a deque, with a
+	pipe to wake the listener up), as we log from signal handlers, which may
+	interrupt a thread that is in the middle of logging.
+
+	Records that are still waiting when the process exits normally are
+	emitted before it does; processes that exit by other means (i.e.
+	multiprocessing children) need to flush the handler first.
+	"""
+	def __init__(self, target, max_records=10000):
+		logging.Handler.__init__(self)
+		self.busy = False
+		self.closing = False
+		self.dropped = 0
+		self.max_records = max_records
+		self.pid = None
+		self.records = None
+		self.reported = 0
+		self.target = target
+		self.thread = None
+		self.wakeup = None
+		atexit.register(self.close)
+
+	def close(self):
+		if self.pid == os.getpid() and self.thread.is_alive():
+			self.closing = True
+			self.wake()
+			self.thread.join(5)
+		logging.Handler.close(self)
+
+	def emit(self, record):
+		if self.pid != os.getpid():
+			self.start()
+		if len(self.records) >= self.max_records:
+			self.dropped += 1
+			return
+		if record.exc_info:
+			# Tracebacks can't wait; the frames that they refer to are going away.
+			record = copy.copy(record)
+			record.exc_text = logging.Formatter().formatException(record.exc_info)
+			record.exc_info = None
+		self.records.append(record)
+		self.wake()
+
+	def flush(self, timeout=5):
+		"""Wait (for at most timeout seconds) until every record that has been
+		handed off has been emitted.
+		"""
+		if self.pid != os.getpid():
+			return
+		deadline = time.time() + timeout
+		while (len(self.records) > 0 or self.busy) and self.thread.is_alive() and time.time() < deadline:
+			time.sleep(0.01)
+
+	def handle(self, record):
+		# Unlike logging.Handler.handle, we don't hold our lock while emitting.
+		rv = self.filter(record)
+		if rv:
+			self.emit(record)
+		return rv
+
+	def start(self):
+		# The listener thread (and the records) of the process that we were forked
+		# from are not ours to use, and neither is the lock of our target, which
+		# that listener may have been holding when we were forked.
+		self.pid = os.getpid()
+		self.records = collections.deque()
+		self.target.createLock()
+		if self.wakeup is not None:
+			os.close(self.wakeup[0])
+			os.close(self.wakeup[1])
+		self.wakeup = os.pipe()
+		for fd in self.wakeup:
+			fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+		fcntl.fcntl(self.wakeup[1], fcntl.F_SETFL, fcntl.fcntl(self.wakeup[1], fcntl.F_GETFL) | os.O_NONBLOCK)
+		self.thread = threading.Thread(target=self._listener_main, name='async-log-listener')
+		self.thread.daemon = True
+		self.thread.start()
+
+	def wake(self):
+		try:
+			os.write(self.wakeup[1], '\0')
+		except OSError as e:
+			# A full pipe means that the listener has plenty of wake-ups waiting.
+			if e.errno != errno.EAGAIN:
+				raise
+
+	def _listener_main(self):
+		while not self.closing or len(self.records) > 0:
+			try:
+				os.read(self.wakeup[0], 4096)
+			except OSError as e:
+				if e.errno != errno.EINTR:
+					raise
+			self.busy = True
+			while len(self.records) > 0:
+				record = self.records.popleft()
+				if self.dropped != self.reported:
+					dropped = self.dropped
+					self.target.handle(logging.makeLogRecord({
+						'levelname': 'WARNING',
+						'levelno': logging.WARNING,
+						'msg': 'logging queue overflowed, %d record(s) dropped' % (dropped - self.reported),
+						'name': __name__,
+						'pathname': __file__
+					}))
+					self.reported = dropped
+				self.target.handle(record)
+			self.busy = False
+
+class EventLoopTimer:
+	"""A callback that has been scheduled on an EventLoop by call_later."""
+	def __init__(self, when, callback, args):
+		self.args = args
+		self.callback = callback
+		self.cancelled = False
+		self.when = when
+
+	def cancel(self):
+		self.cancelled = True
+
+class EventLoop:
+	"""
+	A small poll(2)-based event loop.
+
+	Callbacks are run on the thread that calls run_forever, when a registered
+	file descriptor becomes readable (add_reader), when a timer expires
+	(call_later), or when a signal is received (add_signal_handler).  The loop
+	sleeps until one of those things happens, so there is no polling interval
+	and no latency added to events.  Blocking work (i.e. database access) can
+	be handed to a pool of executor threads with run_in_executor, and its
+	result is delivered back to the loop thread.
+
+	Signal handlers are delivered through a self-pipe (signal.set_wakeup_fd),
+	so a signal wakes the loop immediately and its callback runs on the loop
+	thread rather than in the interrupted frame.
+	"""
+	def __init__(self, executor_threads=1, thread_exit_hook=None):
+		self._executor_queue = Queue.Queue()
+		self._executor_size = max(1, executor_threads)
+		self._executor_threads = []
+		self._poll = select.poll()
+		self._readers = {}
+		self._ready = collections.deque()
+		self._running = False
+		self._sequence = itertools.count()
+		self._signal_handlers = {}
+		self._signals = collections.deque()
+		self._thread_exit_hook = thread_exit_hook
+		self._timers = []
+		(self._wakeup_read, self._wakeup_write) = os.pipe()
+		for fd in [ self._wakeup_read, self._wakeup_write ]:
+			fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+			fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+		self._poll.register(self._wakeup_read, select.POLLIN)
+
+	def add_reader(self, fd, callback, *args):
+		self._readers[fd] = (callback, args)
+		self._poll.register(fd, select.POLLIN | select.POLLPRI)
+
+	def add_signal_handler(self, signum, callback, *args):
+		self._signal_handlers[signum] = (callback, args)
+		signal.signal(signum, self._signal_received)
+		signal.set_wakeup_fd(self._wakeup_write)
+
+	def call_later(self, delay, callback, *args):
+		timer = EventLoopTimer(time.time() + delay, callback, args)
+		heapq.heappush(self._timers, (timer.when, self._sequence.next(), timer))
+		return timer
+
+	def call_soon(self, callback, *args):
+		self._ready.append((callback, args))
+
+	def call_soon_threadsafe(self, callback, *args):
+		self._ready.append((callback, args))
+		self._wakeup()
+
+	def close(self):
+		"""Stop the executor threads (after they have finished any work that
+		has already been handed to them) and release the loop's resources.
+		"""
+		for _unused_thread in self._executor_threads:
+			self._executor_queue.put(None)
+		for thread in self._executor_threads:
+			thread.join()
+		self._executor_threads = []
+		if len(self._signal_handlers) > 0:
+			signal.set_wakeup_fd(-1)
+		os.close(self._wakeup_read)
+		os.close(self._wakeup_write)
+
+	def is_running(self):
+		return self._running
+
+	def remove_reader(self, fd):
+		if fd in self._readers:
+			del self._readers[fd]
+			self._poll.unregister(fd)
+
+	def run_forever(self):
+		self._running = True
+		while self._running:
+			try:
+				events = self._poll.poll(self._poll_timeout())
+			except select.error as e:
+				if e.args[0] != errno.EINTR:
+					raise
+				events = []
+			for (fd, _unused_mask) in events:
+				if fd == self._wakeup_read:
+					self._drain_wakeup()
+				elif fd in self._readers:
+					self._ready.append(self._readers[fd])
+			while len(self._signals) > 0:
+				signum = self._signals.popleft()
+				if signum in self._signal_handlers:
+					self._ready.append(self._signal_handlers[signum])
+			now = time.time()
+			while len(self._timers) > 0 and self._timers[0][0] <= now:
+				timer = heapq.heappop(self._timers)[2]
+				if not timer.cancelled:
+					self._ready.append((timer.callback, timer.args))
+			# Callbacks that are scheduled by the callbacks that we run now are run
+			# on the next pass, after we have checked for I/O again.
+			for _unused_i in xrange(len(self._ready)):
+				(callback, args) = self._ready.popleft()
+				try:
+					callback(*args)
+				except Exception as e:
+					logger.exception('unhandled exception in event loop callback %s: %s' % (callback, e))
+
+	def run_in_executor(self, func, args=(), callback=None):
+		"""Call func(*args) on an executor thread.  If a callback is given, it
+		is called on the loop thread with the arguments (result, exception)
+		once func has returned (exception is None if func succeeded).
+		"""
+		if len(self._executor_threads) < self._executor_size:
+			thread = threading.Thread(target=self._executor_main, name='executor-%d' % (len(self._executor_threads)))
+			thread.daemon = True
+			thread.start()
+			self._executor_threads.append(thread)
+		self._executor_queue.put((func, args, callback))
+
+	def stop(self):
+		self._running = False
+		self._wakeup()
+
+	def _drain_wakeup(self):
+		try:
+			while os.read(self._wakeup_read, 4096):
+				pass
+		except OSError as e:
+			if e.errno != errno.EAGAIN:
+				raise
+
+	def _executor_main(self):
+		try:
+			while True:
+				item = self._executor_queue.get()
+				if item is None:
+					break
+				(func, args, callback) = item
+				result = None
+				exception = None
+				try:
+					result = func(*args)
+				except Exception as e:
+					logger.exception('unhandled exception in executor function %s: %s' % (func, e))
+					exception = e
+				if callback is not None:
+					self.call_soon_threadsafe(callback, result, exception)
+		finally:
+			if self._thread_exit_hook is not None:
+				self._thread_exit_hook()
+
+	def _poll_timeout(self):
+		if len(self._ready) > 0 or len(self._signals) > 0:
+			return 0
+		while len(self._timers) > 0 and self._timers[0][2].cancelled:
+			heapq.heappop(self._timers)
+		if len(self._timers) > 0:
+			return max(0, int((self._timers[0][0] - time.time()) * 1000) + 1)
+		return -1
+
+	def _signal_received(self, signum, _unused_frame):
+		self._signals.append(signum)
+		self._wakeup()
+
+	def _wakeup(self):
+		try:
+			os.write(self._wakeup_write, '\0')
+		except OSError as e:
+			if e.errno != errno.EAGAIN:
+				raise
+
+class LRUCache:
+	"""
+	A thread-safe mapping that holds at most max_entries entries, discarding
+	the least recently used entry to make room for a new one.  If a ttl (in
+	seconds) is given, entries also expire that long after they were set.
+
+	Hits and misses are counted so that the effectiveness of the cache can be
+	monitored (see stats).
+	"""
+	def __init__(self, max_entries, ttl=None):
+		self._entries = collections.OrderedDict()
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.max_entries = max_entries
+		self.misses = 0
+		self.ttl = ttl
+
+	def __len__(self):
+		return len(self._entries)
+
+	def after_fork(self):
+		"""Empty the cache in a process that has just been forked, without
+		taking the lock, which one of the threads of our parent may have been
+		holding (along with an entry that it was in the middle of changing).
+		"""
+		self._entries = collections.OrderedDict()
+		self._lock = threading.Lock()
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+
+	def discard(self, key):
+		with self._lock:
+			self._entries.pop(key, None)
+
+	def discard_if(self, predicate):
+		"""Discard every entry for which predicate(key, value) is true."""
+		with self._lock:
+			for key in [key for (key, (_unused_expires, value)) in self._entries.iteritems() if predicate(key, value)]:
+				del self._entries[key]
+
+	def get(self, key, default=None):
+		with self._lock:
+			try:
+				(expires, value) = self._entries.pop(key)
+			except KeyError:
+				self.misses += 1
+				return default
+			if expires is not None and expires <= time.time():
+				self.misses += 1
+				return default
+			self._entries[key] = (expires, value)
+			self.hits += 1
+			return value
+
+	def hit_ratio(self):
+		if self.hits + self.misses == 0:
+			return 0.0
+		return float(self.hits) / (self.hits + self.misses)
+
+	def peek(self, key, default=None):
+		"""Like get, but neither counts as a hit or miss nor marks the entry as
+		recently used.
+		"""
+		with self._lock:
+			try:
+				(expires, value) = self._entries[key]
+			except KeyError:
+				return default
+			if expires is not None and expires <= time.time():
+				return default
+			return value
+
+	def set(self, key, value, ttl=None):
+		"""Set the given entry, which expires after the given ttl (if given)
+		rather than the ttl of the cache.
+		"""
+		if ttl is None:
+			ttl = self.ttl
+		expires = None
+		if ttl is not None:
+			expires = time.time() + ttl
+		with self._lock:
+			self._entries.pop(key, None)
+			self._entries[key] = (expires, value)
+			while len(self._entries) > self.max_entries:
+				self._entries.popitem(False)
+
+	def stats(self):
+		return {
+			'entries': len(self._entries),
+			'hit_ratio': self.hit_ratio(),
+			'hits': self.hits,
+			'max_entries': self.max_entries,
+			'misses': self.misses
+		}
+
+class RollingHistogram:
+	"""
+	A thread-safe histogram of the most recent max_samples values that have
+	been added to it (i.e. latencies), from which percentiles are computed on
+	demand.
+	"""
+	def __init__(self, max_samples=1024):
+		self._count = 0
+		self._lock = threading.Lock()
+		self._samples = collections.deque(maxlen=max_samples)
+		self._total = 0
+
+	def add(self, value):
+		with self._lock:
+			self._count += 1
+			self._samples.append(value)
+			self._total += value
+
+	def stats(self, percentiles=(50, 95, 99)):
+		"""Return the number and the sum of all of the values that have been
+		added, and the maximum and the given percentiles of the values that are
+		held.
+		"""
+		with self._lock:
+			samples = sorted(self._samples)
+			count = self._count
+			total = self._total
+		stats = { 'count': count, 'max': None, 'total': total }
+		for p in percentiles:
+			stats['p%d' % (p)] = None
+		if len(samples) > 0:
+			stats['max'] = samples[-1]
+			for p in percentiles:
+				stats['p%d' % (p)] = samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+		return stats
+
+class PrefixTrie:
+	"""
+	A trie of string prefixes (i.e. the digits of phone number prefixes), each
+	with an associated value.  longest_prefix finds the value of the longest
+	prefix of a given string in O(len(string)), regardless of how many
+	prefixes the trie holds.
+	"""
+	def __init__(self):
+		# Every node is a dictionary of its children, keyed by character; the
+		# value of a prefix is stored in its node under the (non-character) key None.
+		self._root = {}
+		self._size = 0
+
+	def __len__(self):
+		return self._size
+
+	def insert(self, prefix, value):
+		node = self._root
+		for c in prefix:
+			node = node.setdefault(c, {})
+		if not None in node:
+			self._size += 1
+		node[None] = value
+
+	def longest_prefix(self, s, default=None):
+		node = self._root
+		value = node.get(None, default)
+		for c in s:
+			node = node.get(c)
+			if node is None:
+				break
+			if None in node:
+				value = node[None]
+		return value
+
 def hexdump(s):
 	"""
 	Dump any string (unicode or not) to formatted hex output.
@@ -36,6 +526,129 @@ def hexdump(s):
 		result.append("%04x  %-*s  %s\n" % (i*char_sizeof, chars_per_line * ((char_sizeof * 2) + 1), hex, printable))
 	return ''.join(result)
 
+class SamplingProfiler:
+	"""
+	A statistical profiler that samples the stacks of every other thread of
+	this process (with sys._current_frames) every interval seconds, for
+	duration seconds, from a thread of its own.  Nothing is hooked into the
+	interpreter, so there is no overhead at all when no session is running.
+
+	If a root code object is given, only the stacks that pass through it are
+	counted, and only from it inwards; i.e. given the code of the function
+	that processes a message, idle threads are ignored and the profile is
+	that of message processing alone.
+
+	For every function, the number of samples that it was executing in (self)
+	and that it was on the stack in (cumulative) are counted.
+	"""
+	def __init__(self, interval, duration, root=None):
+		self.cumulative = collections.defaultdict(int)
+		self.duration = duration
+		self.interval = interval
+		self.root = root
+		self.samples = 0
+		self.self = collections.defaultdict(int)
+		self.stacks = 0
+		self.started = None
+		self._stopped = threading.Event()
+		self._thread = None
+
+	@staticmethod
+	def function_name(code):
+		return '%s:%d(%s)' % (code.co_filename, code.co_firstlineno, code.co_name)
+
+	def is_running(self):
+		return self._thread is not None and self._thread.is_alive()
+
+	def report(self):
+		"""A report of the session, with a line per function, ordered by the
+		number of samples in which the function was on the stack.
+		"""
+		lines = [
+			'%d sample(s) taken every %.3f seconds from %s, %d of which found a stack to profile' % (self.samples, self.interval, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)), self.stacks),
+			'',
+			'%10s %8s %10s %8s  %s' % ('cumulative', '%', 'self', '%', 'function')
+		]
+		for (function, count) in sorted(self.cumulative.items(), key=lambda item: (-item[1], item[0])):
+			lines.append('%10d %7.2f%% %10d %7.2f%%  %s' % (count, 100.0 * count / max(self.stacks, 1), self.self.get(function, 0), 100.0 * self.self.get(function, 0) / max(self.stacks, 1), function))
+		return '\n'.join(lines) + '\n'
+
+	def start(self, callback=None):
+		"""Start the session.  The given callback is called (on the profiler's
+		thread) with this profiler once the session is over.
+		"""
+		self.started = time.time()
+		self._thread = threading.Thread(target=self._sample_main, args=(callback,), name='sampling-profiler')
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		self._stopped.set()
+		if self._thread is not None:
+			self._thread.join()
+
+	def summary(self, limit=5):
+		"""A one-line summary of the functions that were sampled the most."""
+		hottest = sorted(self.self.items(), key=lambda item: (-item[1], item[0]))[:limit]
+		return ', '.join(['%s %.1f%%' % (function, 100.0 * count / max(self.stacks, 1)) for (function, count) in hottest])
+
+	def _sample_main(self, callback):
+		me = threading.current_thread().ident
+		deadline = self.started + self.duration
+		while not self._stopped.is_set() and time.time() < deadline:
+			self.samples += 1
+			for (thread_id, frame) in sys._current_frames().items():
+				if thread_id == me:
+					continue
+				stack = []
+				while frame is not None:
+					stack.append(frame.f_code)
+					if frame.f_code is self.root:
+						break
+					frame = frame.f_back
+				if self.root is not None and stack[-1] is not self.root:
+					continue
+				self.stacks += 1
+				self.self[SamplingProfiler.function_name(stack[0])] += 1
+				for code in set(stack):
+					self.cumulative[SamplingProfiler.function_name(code)] += 1
+			self._stopped.wait(self.interval)
+		if callback is not None:
+			try:
+				callback(self)
+			except Exception as e:
+				logger.exception('unhandled exception in profiler callback %s: %s' % (callback, e))
+
+class TokenBucket:
+	"""
+	A token bucket rate limiter: tokens accrue at rate tokens per second, up
+	to capacity tokens (the largest burst that is allowed), and every action
+	that is allowed takes a token.  Not thread-safe.
+	"""
+	def __init__(self, rate, capacity):
+		self.capacity = capacity
+		self.rate = rate
+		self.tokens = capacity
+		self.updated = None
+
+	def refill(self, now):
+		if self.updated is not None:
+			self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+
+	def take(self, now):
+		"""Take a token, if one is available.  Returns whether one was."""
+		self.refill(now)
+		if self.tokens < 1:
+			return False
+		self.tokens -= 1
+		return True
+
+	def wait(self, now):
+		"""The number of seconds until a token is available."""
+		self.refill(now)
+		return max(0, (1 - self.tokens) / self.rate)
+
 class UTFFixedSysLogHandler(SysLogHandler):
 	"""
 	A bug-fix sub-class of SysLogHandler that fixes the UTF-8 BOM syslog
@@ -76,7 +689,7 @@ class UTFFixedSysLogHandler(SysLogHandler):
 				except socket.error:
 					self._connect_unixsocket(self.address)
 					self.socket.send(msg)
-                        elif self.socktype == socket.SOCK_DGRAM:
+			elif self.socktype == socket.SOCK_DGRAM:
 				self.socket.sendto(msg, self.address)
 			else:
 				self.socket.sendall(msg)
@@ -70,6 +70,24 @@ INSTALLED_APPS = (
 	'smirc.www'
 )
 
+# In-process caches of rarely-changing chat data (i.e. conversation rosters and user
+# memberships) that are read for every message that smircd processes.
+#	generation_check_seconds: number of seconds between checks for changes made by
+#		other smircd nodes, when several nodes share an inbound directory (see
+#		SMSTOOLS['claim_dir']).
+#	max_entries: maximum number of entries held by each cache.
+#	negative_ttl: number of seconds after which a cached lookup of an unknown user
+#		(i.e. an unregistered phone number) expires; this bounds how long a user who
+#		has just registered through the website is told that they are unknown.
+#	ttl: number of seconds after which a cache entry expires; this bounds how long
+#		changes made by another process (i.e. the website) can go unnoticed.
+SMIRC_CACHE = {
+	'generation_check_seconds': 1,
+	'max_entries': 4096,
+	'negative_ttl': 5,
+	'ttl': 300
+}
+
 # Language code for this installation. All choices can be found here:
 # http://www.i18nguy.com/unicode/language-identifiers.html
 LANGUAGE_CODE = 'en-us'
@@ -78,6 +96,7 @@ LANGUAGE_CODE = 'en-us'
 # logging module to work-around the fact that settings.py can be (and sometimes is) executed
 # multiple times, but we really only want to carry out our logging initialization once.
 import logging
+from remiutilities import AsyncLogHandler
 from remiutilities import UTFFixedSysLogHandler
 if not getattr(logging.getLogger(''), 'smirc_logging_initialized', False):
 	# Initialize a basic (stderr) logger, with a log-level based on our DEBUG constant.
@@ -91,10 +110,12 @@ if not getattr(logging.getLogger(''), 'smirc_logging_initialized', False):
 	del log_level
 
 	# Also duplicate logging information to syslog via /dev/log, on facility LOG_LOCAL0.  Note
-	# that our logging format is different, as syslog implicitly includes a timestamp.
+	# that our logging format is different, as syslog implicitly includes a timestamp.  Records
+	# are sent to syslog from a background thread, through a queue of (at most) 10000 records,
+	# so that logging never blocks on syslog; records are dropped when the queue is full.
 	sh = UTFFixedSysLogHandler('/dev/log', 'local0')
 	sh.setFormatter(logging.Formatter('%(levelname)s <' + os.environ['SMIRC_AREA'] + ':' + os.environ['SMIRC_ENVIRONMENT'] + ', PID %(process)d> [%(pathname)s:%(lineno)d] %(message)s'))
-	logging.getLogger('').addHandler(sh)
+	logging.getLogger('').addHandler(AsyncLogHandler(sh, 10000))
 
 	logging.info('configuring SMIRC for %s environment' % (os.environ['SMIRC_ENVIRONMENT'].lower()))
 	setattr(logging.getLogger(''), 'smirc_logging_initialized', True)
@@ -125,13 +146,154 @@ SECRET_KEY = '_b!mf0hketu4xt(l-j+ilw75*bh&xqt#25!v1(8rmv@l3q81wo'
 
 SITE_ID = 1
 
+# The last_active times of memberships, which smircd buffers (see
+# smirc.chat.activity) rather than writing for every chat message.
+#	flush_rows, flush_seconds: number of buffered memberships, and the age (in seconds)
+#		of the oldest buffered time, at which buffered times are written to the
+#		database; this bounds how much activity is lost if smircd dies.
+SMIRC_ACTIVITY = {
+	'flush_rows': 500,
+	'flush_seconds': 5
+}
+
+# The in-memory index of area codes and numbering prefixes that smircd looks phone
+# numbers up in (see AreaCode.load_index).
+#	check_seconds: number of seconds between checks for changes to the area codes and
+#		numbering prefixes made by other processes (i.e. in the admin); this bounds how
+#		long such a change can go unnoticed.
+SMIRC_AREA_CODE_INDEX = {
+	'check_seconds': 60
+}
+
+# Modules that define SMIRC commands (subclasses of smirc.command.models.SmircCommand)
+# in addition to smirc.command.models; commands register themselves when their module
+# is imported.
+SMIRC_COMMAND_MODULES = (
+)
+
+# History of the chat messages that smircd forwards (see smirc.message.history).
+#	flush_rows, flush_seconds: number of buffered rows, and the age (in seconds) of the
+#		oldest buffered row, at which buffered rows are written to the database; this
+#		bounds how much history is lost if smircd dies.
+#	purge_chunk_size: number of rows deleted per transaction when purging old history.
+#	purge_interval: number of seconds between purges of old history.
+#	retention_days: number of days that history is kept for.
+SMIRC_MESSAGE_HISTORY = {
+	'flush_rows': 100,
+	'flush_seconds': 5,
+	'purge_chunk_size': 1000,
+	'purge_interval': 3600,
+	'retention_days': 90
+}
+
 # SMIRC's phone number.
 SMIRC_PHONE_NUMBER = '17807291450'
 
+# On-demand profiling of smircd's message processing, started by sending SIGUSR1 to
+# smircd (see smircd_profile).
+#	duration: number of seconds that a profiling session lasts.
+#	interval: number of seconds between samples.
+#	output_dir: directory that profiles are written to.
+SMIRC_PROFILER = {
+	'duration': 30,
+	'interval': 0.005,
+	'output_dir': '/var/tmp'
+}
+
+# Statistics of the smircd pipeline (see smirc.message.metrics), which every smircd
+# process writes to a JSON file of its own in stats_dir.
+#	count_queries: whether to count the database queries of every message.
+#	interval: number of seconds between rewrites of the stats files.
+#	samples: number of recent latencies (per stage) that percentiles are computed from.
+SMIRC_STATS = {
+	'count_queries': True,
+	'interval': 10,
+	'samples': 1024,
+	'stats_dir': '/var/run/smircd'
+}
+
 # Configuration for smstools sms inbound/outbound directories.
+#	archive_dir: directory that processed inbound messages are archived to (see
+#		smirc.message.archive.MessageArchive).
+#	archive_segment_bytes, archive_segment_seconds: size (in bytes) and age (in
+#		seconds) at which an archive segment is closed and compressed.
+#	archive_sync_messages, archive_sync_seconds: maximum number of processed inbound
+#		messages, and maximum number of seconds, that an archive segment is synced to
+#		disk after (and the archived messages are removed from inbound_dir); messages
+#		that have not been removed when smircd dies are processed again.
+#	backlog_batch_size: maximum number of pre-existing inbound messages that are
+#		processed in parallel when smircd drains its backlog at startup.
+#	claim_dir: directory (shared by every smircd node, and on the same filesystem as
+#		inbound_dir) that inbound messages are claimed into before they are processed,
+#		so that several smircd nodes can share one inbound directory (see
+#		smirc.message.claim.InboundClaims).  None for a single smircd node.
+#	claim_lease_seconds: number of seconds after its last heartbeat at which a node is
+#		presumed dead, and the messages that it had claimed are taken over.
+#	coalesce_seconds: number of seconds for which the chat messages to a recipient are
+#		held, so that the messages that arrive in the meantime are merged with them into
+#		as few SMS as possible (see smirc.message.spool.OutboundSpool); 0 to send every
+#		chat message as an SMS of its own.
+#	executor_threads: number of threads that smircd's event loop runs blocking work
+#		(i.e. database access) on.  Inbound messages are processed on these threads
+#		when worker_processes is 0, so more than one thread does not preserve the
+#		order of messages from a given phone number.
+#	inbound_scan_seconds: number of seconds between scans of inbound_dir for messages
+#		that other hosts have written into it (and that inotify does not see) when
+#		claim_dir is set.
+#	node_name: name of this smircd node; None for our host name.
+#	outbound_burst: number of messages that an outbound queue with a rate can release
+#		at once.
+#	outbound_max_segments: maximum number of SMS that an outbound message is split
+#		into (as a concatenated SMS); longer messages are truncated.
+#	outbound_queue_retry_seconds: number of seconds that an outbound queue that a
+#		message could not be published to is avoided for.
+#	outbound_queues: the outbound queues (in general, one per GSM modem) that outbound
+#		messages are spread over (see smirc.message.spool.OutboundSpool), each a
+#		dictionary of:
+#			name: the name of the queue, which NumberingPrefix.modem refers to.
+#			outbound_dir: directory that the messages of the queue are published to
+#				(default: outbound_dir).
+#			phone_number: phone number that the messages of the queue are sent from
+#				(default: SMIRC_PHONE_NUMBER).
+#			queue: name of the SMSTools queue of the queue, given to SMSTools in a
+#				"Queue" header (default: none).
+#			rate, burst: rate and burst of the queue (default: outbound_rate and
+#				outbound_burst).
+#		If there are none, every message is published to outbound_dir and sent from
+#		SMIRC_PHONE_NUMBER.
+#	outbound_rate: number of messages per minute that each outbound queue releases to
+#		SMSTools (replies to commands first, then invitations, then chat messages);
+#		None for no limit.
+#	outbound_staging_dir: directory that outbound messages are written to before
+#		they are published to SMSTools (by renaming them into outbound_dir, or the
+#		outbound_dir of their outbound queue).  It must be on the same filesystem as
+#		those directories.  Messages that are left in it when smircd stops are sent
+#		when it is restarted, so it must not be shared by several smircd nodes.
+#	worker_processes: number of worker processes that smircd hands inbound messages
+#		off to (messages from a given phone number are always handled by the same
+#		worker).  Set to 0 to process messages in the main smircd process.
 SMSTOOLS = {
+	'archive_dir': '/var/spool/sms/smircd-archive',
+	'archive_segment_bytes': 67108864,
+	'archive_segment_seconds': 3600,
+	'archive_sync_messages': 64,
+	'archive_sync_seconds': 1,
+	'backlog_batch_size': 8,
+	'claim_dir': None,
+	'claim_lease_seconds': 60,
+	'coalesce_seconds': 0,
+	'executor_threads': 1,
 	'inbound_dir': '/var/spool/sms/incoming',
-	'outbound_dir': '/var/spool/sms/outgoing'
+	'inbound_scan_seconds': 5,
+	'node_name': None,
+	'outbound_burst': 4,
+	'outbound_dir': '/var/spool/sms/outgoing',
+	'outbound_max_segments': 3,
+	'outbound_queue_retry_seconds': 60,
+	'outbound_queues': (),
+	'outbound_rate': None,
+	'outbound_staging_dir': '/var/spool/sms/smircd-staging',
+	'worker_processes': 4
 }
 
 TEMPLATE_CONTEXT_PROCESSORS =  (
@@ -14,14 +14,13 @@ def faq(request):
 
 def help(request):
 	command_usage_list = []
-	for klassname, obj in SmircCommand.available_commands():
+	for name, klass in SmircCommand.available_commands():
 		command_usage_list.append({
-			'command': klassname.replace('SmircCommand', '').upper(),
-			'description': SmircCommand.command_description(obj),
-			'examples': SmircCommand.command_examples(obj),
-			'usage': SmircCommand.command_usage(obj)
+			'command': name.upper(),
+			'description': klass.DESCRIPTION,
+			'examples': klass.EXAMPLES,
+			'usage': klass.USAGE
 		})
-	command_usage_list.sort(key=lambda x: x['command'])
 
 	return smirc_render_to_response(request, 'pages/help.html', {
 		'command_character': SmircCommand.COMMAND_CHARACTER,
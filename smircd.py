@@ -13,82 +13,445 @@
 #
 # See http://docs.djangoproject.com/en/dev/topics/settings/ for more information.
 #
-import datetime
+import errno
 import inspect
+import itertools
 import logging
+import multiprocessing
 import os
 import pyinotify
+import Queue
 import signal
 import sys
+import threading
+import time
 import traceback
+import zlib
 from django.conf import settings
 from django.core.mail import mail_admins
-from smirc.chat.models import Membership
+from django.db import connection
+from smirc.chat.activity import membership_activity
+from smirc.chat.cache import membership_cache
+from smirc.chat.cache import user_cache
 from smirc.command.models import SmircCommandException
+from smirc.message.archive import inbound_archive
+from smirc.message.claim import InboundClaims
+from smirc.message.claim import list_messages
+from smirc.message.claim import node_name
+from smirc.message.history import message_history
+from smirc.message.history import purge_message_history
+from smirc.message.metrics import count_queries
+from smirc.message.metrics import pipeline_metrics
+from smirc.message.metrics import stats_path
+from smirc.message.models import AreaCode
 from smirc.message.models import SmircMessageException
 from smirc.message.models import SmircOutOfAreaException
 from smirc.message.models import SmircRawMessageException
 from smirc.message.models import SMSToolsMessage
+from smirc.message.smstools import ignored
+from smirc.message.spool import outbound_spool
+from smirc.remiutilities import EventLoop
+from smirc.remiutilities import SamplingProfiler
 
 __version__ = '$Rev$'
 logger = logging.getLogger('smircd.py')
 
 class SMSFileHandler(pyinotify.ProcessEvent):
-	def process_IN_MODIFY(self, event):
-		logger.debug('event IN_MODIFY occurred for %s' % event.pathname)
-		if (os.path.splitext(os.path.basename(event.pathname))[0] == 'smsd_script'):
-			logger.warning('skipping SMSTools script %s' % event.pathname)
+	# SMSTools files are only acted upon once they are complete: when the process
+	# that wrote them closes them, or when they are moved into the inbound directory.
+	# IN_Q_OVERFLOW is always delivered, and means that events have been lost.
+	EVENT_MASK = pyinotify.EventsCodes.FLAG_COLLECTIONS['OP_FLAGS']['IN_CLOSE_WRITE'] | pyinotify.EventsCodes.FLAG_COLLECTIONS['OP_FLAGS']['IN_MOVED_TO']
+
+	def my_init(self, loop=None, pool=None, claims=None):
+		self.claims = claims
+		self.coalesced = 0
+		self.loop = loop
+		self.pending = {}
+		self.pool = pool
+
+	def claim(self, pathname):
+		"""Claim the given file for this smircd node, if we share our inbound
+		directory with other nodes (see InboundClaims).  Returns the path of the
+		file to process, or None if another node has claimed it.
+		"""
+		if self.claims is None or os.path.dirname(pathname) == self.claims.node_dir:
+			return pathname
+		return self.claims.claim(pathname)
+
+	def dispatch(self, pathname):
+		"""Claim the given file and hand it off to be processed, unless it has
+		already been handed off and is still waiting to be processed (in which
+		case this event is coalesced with the earlier one).
+		"""
+		reason = ignored(pathname)
+		if reason is not None:
+			# SMSTools' own files must stay where SMSTools put them.
+			logger.warning('skipping %s %s' % (reason, pathname))
 			return
-		if (os.path.basename(event.pathname).find('-concatenated') != -1):
-			logger.warning('skipping concatenated SMSTools transitional message %s' % event.pathname)
+		pathname = self.claim(pathname)
+		if pathname is None:
 			return
+		if pathname in self.pending and os.path.exists(pathname):
+			logger.debug('coalescing event for %s with pending event from %.3f seconds ago', pathname, time.time() - self.pending[pathname])
+			self.coalesced += 1
+			return
+		self.pending[pathname] = time.time()
+		if self.pool is not None:
+			self.pool.dispatch(pathname)
+		elif self.loop is not None:
+			self.loop.run_in_executor(self.process_file, (pathname,), lambda _unused_result, _unused_exception: self.pending.pop(pathname, None))
+		else:
+			self.process_file(pathname)
+			del self.pending[pathname]
+
+	def process_IN_CLOSE_WRITE(self, event):
+		logger.debug('event IN_CLOSE_WRITE occurred for %s', event.pathname)
+		self.dispatch(event.pathname)
+
+	def process_IN_MOVED_TO(self, event):
+		logger.debug('event IN_MOVED_TO occurred for %s', event.pathname)
+		self.dispatch(event.pathname)
+
+	def process_IN_Q_OVERFLOW(self, event):
+		logger.error('inotify event queue overflowed, rescanning inbound directory %s' % (settings.SMSTOOLS['inbound_dir']))
+		for pathname in inbound_backlog():
+			self.dispatch(pathname)
+
+	def prune_pending(self, interval=None):
+		"""Forget about files that have been handed off to worker processes and
+		that have since been processed (i.e. archived out of the inbound or
+		claim directory), and roll the archive segment of this process over if it has
+		expired.  Reschedules itself on the event loop if given an interval.
+		"""
+		for pathname in self.pending.keys():
+			if not os.path.exists(pathname):
+				del self.pending[pathname]
+		if self.pool is not None:
+			self.pool.prune()
+		inbound_archive.expire()
+		if interval is not None:
+			self.loop.call_later(interval, self.prune_pending, interval)
+
+	def process_file(self, pathname):
+		reason = ignored(pathname)
+		if reason is not None:
+			logger.warning('skipping %s %s' % (reason, pathname))
+			return False
+		if not os.path.isfile(pathname) or inbound_archive.archived(pathname):
+			logger.debug('skipping %s, it has already been processed', pathname)
+			return False
+		pipeline_metrics.begin_message()
+		try:
+			self.process_message(pathname)
+		finally:
+			pipeline_metrics.end_message()
+		pipeline_metrics.count('processed')
+		return True
+
+	def process_message(self, pathname):
 		message = SMSToolsMessage()
 		response = None
 		try:
-			message.receive(event.pathname)
+			message.receive(pathname)
 		except (SmircCommandException, SmircMessageException) as e:
+			pipeline_metrics.count('rejected')
 			response = SMSToolsMessage()
 			response.body = str(e)
 			response.system = True
 		except SmircOutOfAreaException as e:
+			pipeline_metrics.count('rejected')
 			logger.warning('message out of area exception: %s' % (str(e)))
 		except SmircRawMessageException as e:
-			logger.error('raw message exception occurred while receiving messages %s: %s' % (event.pathname, e))
+			pipeline_metrics.count('failed')
+			logger.error('raw message exception occurred while receiving messages %s: %s' % (pathname, e))
 		except Exception as e:
-			logger.exception('unhandled exception occurred while receiving message %s: %s' % (event.pathname, e))
+			pipeline_metrics.count('failed')
+			logger.exception('unhandled exception occurred while receiving message %s: %s' % (pathname, e))
 
-			subject = 'unhandled exception occurred while receiving message %s' % (event.pathname)
-			message = '\n'.join(traceback.format_exception(*(sys.exc_info())))
-			mail_admins(subject, message, fail_silently=True)
+			subject = 'unhandled exception occurred while receiving message %s' % (pathname)
+			details = '\n'.join(traceback.format_exception(*(sys.exc_info())))
+			mail_admins(subject, details, fail_silently=True)
 		else:
 			if (message.command):
+				pipeline_metrics.count('commands')
 				response = SMSToolsMessage()
 				try:
-					response.body = message.command.execute()
+					with pipeline_metrics.timer('execute'):
+						response.body = message.command.execute()
 				except SmircCommandException as e:
 					response.body = str(e)
 				response.system = True
 			else:
-				message.sender.last_active = datetime.datetime.utcnow()
-				message.sender.save()
+				pipeline_metrics.count('chat')
+				with pipeline_metrics.timer('last_active'):
+					message.sender.mark_active(message.default_conversation_id)
 				try:
-					for recipient in Membership.objects.filter(conversation=message.sender.conversation).exclude(user=message.sender.user):
-						message.send(recipient.user.get_profile().phone_number)
-				except Membership.DoesNotExist:
-					pass
+					with pipeline_metrics.timer('fan_out'):
+						message.fan_out()
 				except Exception as e:
+					pipeline_metrics.count('failed')
 					logger.exception('unhandled exception occurred while forwarding message: %s' % (e))
 		try:
-			os.rename(event.pathname, '%s/archived/%s' % (settings.SMSTOOLS['inbound_dir'], os.path.basename(event.pathname)))
-		except OSError as e:
-			logger.exception('operating system exception occurred while archiving message %s: %s' % (event.pathname, e))
+			with pipeline_metrics.timer('archive'):
+				inbound_archive.store(pathname, message.raw_phone_number)
+		except (IOError, OSError) as e:
+			logger.exception('operating system exception occurred while archiving message %s: %s' % (pathname, e))
 		if response is not None:
 			try:
-				response.send(message.raw_phone_number)
+				with pipeline_metrics.timer('respond'):
+					response.send(message.raw_phone_number)
 			except Exception as e:
 				logger.exception('unhandled exception occurred while sending message to %s: %s' % (message.raw_phone_number, e))
 
-def signal_handler(signum, _unused_frame):
+class SMSWorkerPool:
+	"""A pool of worker processes that inbound message files are handed off to,
+	so that a slow message (or a slow database) does not hold up the rest of
+	the inbound queue.
+
+	Every worker has its own queue, and files are routed to a worker by a hash
+	of their "from" header; messages from the same phone number are therefore
+	always processed by the same worker, in the order that they were received.
+	Workers forward their outbound messages to the outbound spool of the main
+	smircd process, which writes them.
+
+	The pool is started before the main smircd process starts any threads of
+	its own (see the bottom of this file), as Python 2 does not reset the
+	locks of a forked child: a lock that one of those threads held at the time
+	would never be released in the child.  Workers that replace dead ones can't
+	wait for that, so every worker also replaces the locks that it inherited
+	(see sms_worker_after_fork).
+	"""
+	def __init__(self, size):
+		self.outbound = None
+		# pathname -> (index of the worker that it was routed to, sequence number
+		# of its routing), until it has been processed (see prune)
+		self.routed = {}
+		self.routed_sequence = itertools.count()
+		self.size = size
+		self.queues = [None] * size
+		self.workers = [None] * size
+
+	def dispatch(self, pathname):
+		try:
+			sender = SMSToolsMessage.raw_sender(pathname)
+		except IOError as e:
+			logger.debug('not dispatching %s, it could not be read: %s', pathname, e)
+			return
+		index = (zlib.crc32(str(sender)) & 0xffffffff) % self.size
+		if not self.workers[index].is_alive():
+			logger.error('worker %d exited unexpectedly (exit code %s), restarting it' % (index, self.workers[index].exitcode))
+			self.restart_worker(index)
+		logger.debug('dispatching %s from %s to worker %d', pathname, sender, index)
+		self.routed[pathname] = (index, self.routed_sequence.next())
+		self.queues[index].put(pathname)
+
+	def prune(self):
+		"""Forget about the files that have been processed (i.e. archived out of
+		the inbound or claim directory).
+		"""
+		for pathname in self.routed.keys():
+			if not os.path.exists(pathname):
+				del self.routed[pathname]
+
+	def restart_worker(self, index):
+		"""Replace the given (dead) worker.  The files that were still queued to
+		it are lost along with its queue, so those that have not been processed
+		are queued to its replacement, in the order that they were routed.
+		"""
+		self.start_worker(index)
+		requeued = sorted([(sequence, pathname) for (pathname, (routed_index, sequence)) in self.routed.items() if routed_index == index and os.path.exists(pathname)])
+		for (_unused_sequence, pathname) in requeued:
+			self.queues[index].put(pathname)
+		if len(requeued) > 0:
+			logger.warning('requeued %d message(s) that worker %d had not processed' % (len(requeued), index))
+
+	def start(self):
+		# Our children must not share our database connection (or inherit our
+		# buffered message history and activity), but they do share generation
+		# counters that keep their caches coherent.
+		membership_activity.flush()
+		message_history.flush()
+		connection.close()
+		membership_cache.share_generation(multiprocessing.Value('L', 0))
+		user_cache.share_generation(multiprocessing.Value('L', 0))
+		self.outbound = multiprocessing.Queue()
+		for index in xrange(self.size):
+			self.start_worker(index)
+		# The receiver is a thread, so it is only started once every worker has
+		# been forked.
+		outbound_spool.receive_from(self.outbound)
+		logger.info('started %d worker process(es)' % (self.size))
+
+	def signal(self, signum):
+		for worker in self.workers:
+			if worker.is_alive():
+				os.kill(worker.pid, signum)
+
+	def start_worker(self, index):
+		self.queues[index] = multiprocessing.Queue()
+		self.workers[index] = multiprocessing.Process(target=sms_worker, args=(index, self.queues[index], self.outbound), name='smircd-worker-%d' % (index))
+		self.workers[index].start()
+
+	def stop(self, timeout=30):
+		for queue in self.queues:
+			queue.put(None)
+		for index, worker in enumerate(self.workers):
+			worker.join(timeout)
+			if worker.is_alive():
+				logger.error('worker %d did not exit within %d seconds, terminating it' % (index, timeout))
+				worker.terminate()
+				worker.join()
+		logger.info('stopped %d worker process(es)' % (self.size))
+
+def sms_worker(index, queue, outbound):
+	"""Main loop of an SMSWorkerPool worker process.  Processes the files that
+	are put on the given queue until either a None sentinel is received or the
+	termination flag is set by signal_handler.  Files that are still queued when
+	a worker terminates are left in the inbound (or claim) directory, and are
+	picked up as part of the backlog the next time that smircd starts.
+	"""
+	global smircd_reload_requested
+	global smircd_terminate
+
+	sms_worker_after_fork()
+	smircd_terminate = False
+	# We inherit the signal wake-up file descriptor of our parent's event loop; our
+	# signals are ours to deal with, so don't wake our parent up with them.
+	signal.set_wakeup_fd(-1)
+	for signum in [ signal.SIGHUP, signal.SIGINT, signal.SIGTERM, signal.SIGQUIT, signal.SIGUSR1 ]:
+		signal.signal(signum, signal_handler)
+	outbound_spool.forward_to(outbound)
+	handler = SMSFileHandler()
+	logger.debug('worker %d started', index)
+	try:
+		while not smircd_terminate:
+			if smircd_reload_requested:
+				smircd_reload_requested = False
+				AreaCode.load_index()
+			try:
+				pathname = queue.get(True, 1)
+			except Queue.Empty:
+				inbound_archive.expire()
+				inbound_archive.sync_if_stale()
+				membership_activity.flush_if_stale()
+				message_history.flush_if_stale()
+				pipeline_metrics.write_if_due(stats_path('worker-%d' % (index)), settings.SMIRC_STATS['interval'])
+				continue
+			except IOError as e:
+				if e.errno == errno.EINTR:
+					continue
+				raise
+			if pathname is None:
+				break
+			handler.process_file(pathname)
+			inbound_archive.sync_if_stale()
+			membership_activity.flush_if_stale()
+			message_history.flush_if_stale()
+			pipeline_metrics.write_if_due(stats_path('worker-%d' % (index)), settings.SMIRC_STATS['interval'])
+	finally:
+		membership_activity.flush()
+		message_history.flush()
+		connection.close()
+		pipeline_metrics.write(stats_path('worker-%d' % (index)))
+		if smircd_profiler is not None:
+			smircd_profiler.stop()
+		inbound_archive.close()
+	logger.info('worker %d exiting, cache statistics: %s, %s' % (index, membership_cache.stats(), user_cache.stats()))
+	# We exit without running atexit handlers, so make sure that our log records
+	# have been sent before we do.
+	for log_handler in logging.getLogger('').handlers:
+		log_handler.flush()
+
+def sms_worker_after_fork():
+	"""Replace the locks (and discard the state that they guard) that a newly
+	forked worker inherited from the main smircd process, whose threads may
+	have been holding them when it was forked (see SMSWorkerPool).  The
+	database connection of the main process is dropped without being closed,
+	as closing it would close it for the main process as well.
+	"""
+	# The logging module's own lock, and those of its handlers.
+	logging._lock = threading.RLock()
+	for handler_ref in logging._handlerList:
+		log_handler = handler_ref()
+		if log_handler is not None:
+			log_handler.createLock()
+	connection.connection = None
+	for forked in [ inbound_archive, membership_activity, membership_cache, message_history, pipeline_metrics, user_cache ]:
+		forked.after_fork()
+
+def inbound_backlog():
+	"""List the message files that are currently sitting in the inbound
+	directory, ordered by their time of arrival (oldest first).  SMSTools' own
+	files are left out.
+	"""
+	return list_messages(settings.SMSTOOLS['inbound_dir'])
+
+def drain_inbound_backlog(handler, loop=None):
+	"""Process the messages that were received while smircd was not running
+	(i.e. that are already sitting in the inbound directory at startup).
+
+	The backlog is drained in order of arrival, in batches of at most
+	SMSTOOLS['backlog_batch_size'] files.  The files in a batch are processed
+	in parallel, one thread per sender, so that messages from the same phone
+	number are still handled in the order that they were received.  Draining
+	stops early if the given event loop is stopped (or, without an event loop,
+	if the termination flag is set).
+	"""
+	backlog = inbound_backlog()
+	if handler.claims is not None:
+		# The messages that we had claimed, but not processed, when we last
+		# stopped come first.
+		backlog = handler.claims.claimed() + backlog
+	if len(backlog) == 0:
+		return 0
+	logger.info('draining %d pre-existing message(s) from inbound directory %s' % (len(backlog), settings.SMSTOOLS['inbound_dir']))
+
+	def drain_lane(lane):
+		try:
+			for pathname in lane:
+				pathname = handler.claim(pathname)
+				if pathname is not None and handler.process_file(pathname):
+					recovered.append(pathname)
+		finally:
+			connection.close()
+
+	batch_size = max(1, settings.SMSTOOLS.get('backlog_batch_size', 8))
+	recovered = []
+	started = time.time()
+	for i in xrange(0, len(backlog), batch_size):
+		if (loop is None and smircd_terminate) or (loop is not None and not loop.is_running()):
+			logger.warning('termination requested, leaving %d message(s) in the inbound directory' % (len(backlog) - i))
+			break
+		lanes = {}
+		lane_order = []
+		for pathname in backlog[i:i + batch_size]:
+			try:
+				sender = SMSToolsMessage.raw_sender(pathname)
+			except IOError:
+				continue
+			if not sender in lanes:
+				lanes[sender] = []
+				lane_order.append(sender)
+			lanes[sender].append(pathname)
+		threads = []
+		for sender in lane_order:
+			thread = threading.Thread(target=drain_lane, args=(lanes[sender],), name='backlog-%s' % (sender))
+			thread.start()
+			threads.append(thread)
+		for thread in threads:
+			thread.join()
+	elapsed = max(time.time() - started, 0.001)
+	logger.info('recovered %d pre-existing message(s) in %.2f seconds (%.1f messages/second)' % (len(recovered), elapsed, len(recovered) / elapsed))
+	return len(recovered)
+
+def signal_handler(signum, _unused_frame, loop=None):
+	"""Handle a signal, either directly (as installed by signal.signal) or as a
+	callback of the given event loop.  Termination signals stop the event loop
+	if there is one, and set the termination flag otherwise.  SIGHUP sets the
+	reload flag (the main smircd process handles SIGHUP with smircd_reload), and
+	SIGUSR1 starts a profiling session (see smircd_profile).
+	"""
+	global smircd_reload_requested
 	global smircd_terminate
 	
 	sigdesc = 'UNKNOWN'
@@ -97,13 +460,150 @@ def signal_handler(signum, _unused_frame):
 			sigdesc = member[0]
 			break
 	if signum in [ signal.SIGINT, signal.SIGTERM, signal.SIGQUIT ]:
-		logger.info('signal_handler received signal %s(%d), setting termination flag' % (sigdesc, signum))
-		smircd_terminate = True
+		if loop is not None:
+			logger.info('signal_handler received signal %s(%d), stopping event loop' % (sigdesc, signum))
+			loop.stop()
+		else:
+			logger.info('signal_handler received signal %s(%d), setting termination flag' % (sigdesc, signum))
+			smircd_terminate = True
 	elif signum in [ signal.SIGHUP ]:
-		logger.warning('signal_handler ignoring signal %s(%d)' % (sigdesc, signum))
+		logger.info('signal_handler received signal %s(%d), setting reload flag' % (sigdesc, signum))
+		smircd_reload_requested = True
+	elif signum in [ signal.SIGUSR1 ]:
+		logger.info('signal_handler received signal %s(%d), starting profiling session' % (sigdesc, signum))
+		smircd_profile()
 	else:
 		logger.error('signal_handler ignoring unhandled signal %s(%d)' % (sigdesc, signum))
 
+def smircd_live(loop, watch_manager, notifier, handler):
+	"""Switch smircd from draining its backlog to processing messages as they
+	arrive (handing them to the worker pool, if one is configured): start
+	reading inotify events from the event loop.
+	"""
+	if not loop.is_running():
+		return
+	loop.add_reader(watch_manager.get_fd(), smircd_read_events, notifier)
+	handler.prune_pending(60)
+	if handler.claims is not None:
+		smircd_scan_inbound(loop, handler)
+	smircd_check_area_codes(loop)
+	smircd_flush_activity(loop, 1)
+	smircd_flush_history(loop, 1)
+	smircd_sync_archive(loop, 1)
+	loop.call_later(settings.SMIRC_MESSAGE_HISTORY['purge_interval'], smircd_purge_history, loop)
+	logger.info('waiting for messages to arrive in %s' % (settings.SMSTOOLS['inbound_dir']))
+
+def smircd_heartbeat(loop, handler):
+	"""Rewrite the heartbeat file of this smircd node, and take over (and
+	process) the claims of any nodes that have died, every
+	SMSTOOLS['claim_lease_seconds'] / 4 seconds.
+	"""
+	try:
+		for pathname in handler.claims.recover(handler.claims.heartbeat()):
+			handler.dispatch(pathname)
+	except (IOError, OSError) as e:
+		logger.exception('operating system exception occurred while renewing our claims: %s' % (e))
+	loop.call_later(settings.SMSTOOLS['claim_lease_seconds'] / 4.0, smircd_heartbeat, loop, handler)
+
+def smircd_scan_inbound(loop, handler):
+	"""Claim (and process) the messages that other hosts have written into
+	our (shared) inbound directory, which inotify does not tell us about, every
+	SMSTOOLS['inbound_scan_seconds'] seconds.
+	"""
+	try:
+		for pathname in handler.claims.settled(inbound_backlog()):
+			handler.dispatch(pathname)
+	except OSError as e:
+		logger.exception('operating system exception occurred while scanning inbound directory %s: %s' % (settings.SMSTOOLS['inbound_dir'], e))
+	loop.call_later(settings.SMSTOOLS['inbound_scan_seconds'], smircd_scan_inbound, loop, handler)
+
+def smircd_check_area_codes(loop):
+	"""Reload the area code index if the area codes or numbering prefixes have
+	been changed by another process (on the executor, as they are compared
+	with the database), every SMIRC_AREA_CODE_INDEX['check_seconds'] seconds.
+	Our worker processes check for themselves, when they validate the phone
+	numbers of inbound messages; we need to as well, as we route outbound
+	messages (see OutboundSpool.route).
+	"""
+	loop.run_in_executor(lambda: AreaCode.check_index(time.time()))
+	loop.call_later(settings.SMIRC_AREA_CODE_INDEX['check_seconds'], smircd_check_area_codes, loop)
+
+def smircd_flush_activity(loop, interval):
+	"""Write the last_active times that this process has buffered for too long
+	(on the executor, as they go to the database), every interval seconds.
+	"""
+	loop.run_in_executor(membership_activity.flush_if_stale)
+	loop.call_later(interval, smircd_flush_activity, loop, interval)
+
+def smircd_flush_history(loop, interval):
+	"""Write the message history that this process has buffered for too long
+	(on the executor, as it goes to the database), every interval seconds.
+	"""
+	loop.run_in_executor(message_history.flush_if_stale)
+	loop.call_later(interval, smircd_flush_history, loop, interval)
+
+def smircd_sync_archive(loop, interval):
+	"""Sync the archive segment of this process (and remove the message files
+	that have been archived to it) if they have waited for too long (on the
+	executor, as it goes to the disk), every interval seconds.
+	"""
+	loop.run_in_executor(inbound_archive.sync_if_stale)
+	loop.call_later(interval, smircd_sync_archive, loop, interval)
+
+def smircd_purge_history(loop):
+	"""Purge the message history that is older than our retention period
+	(on the executor), every SMIRC_MESSAGE_HISTORY['purge_interval'] seconds.
+	"""
+	loop.run_in_executor(purge_message_history, (settings.SMIRC_MESSAGE_HISTORY['retention_days'], settings.SMIRC_MESSAGE_HISTORY['purge_chunk_size']))
+	loop.call_later(settings.SMIRC_MESSAGE_HISTORY['purge_interval'], smircd_purge_history, loop)
+
+def smircd_write_stats(loop):
+	"""Rewrite the stats file of this process every SMIRC_STATS['interval']
+	seconds.
+	"""
+	pipeline_metrics.write(stats_path('smircd'))
+	loop.call_later(settings.SMIRC_STATS['interval'], smircd_write_stats, loop)
+
+def smircd_profile(handler=None):
+	"""Start a time-boxed sampling profiling session of the message processing
+	of this process (and of our worker processes, if we have any).  Once the
+	session is over (or smircd exits), the profile is written to a timestamped file in
+	SMIRC_PROFILER['output_dir'] and the hottest functions are logged.
+	"""
+	global smircd_profiler
+
+	if smircd_profiler is not None and smircd_profiler.is_running():
+		logger.warning('not starting a profiling session, one is already running')
+		return
+	smircd_profiler = SamplingProfiler(settings.SMIRC_PROFILER['interval'], settings.SMIRC_PROFILER['duration'], SMSFileHandler.process_file.im_func.func_code)
+	smircd_profiler.start(smircd_profile_done)
+	logger.info('profiling message processing for %d seconds' % (settings.SMIRC_PROFILER['duration']))
+	if handler is not None and handler.pool is not None:
+		handler.pool.signal(signal.SIGUSR1)
+
+def smircd_profile_done(profiler):
+	path = '%s/smircd-profile-%s-%d.txt' % (settings.SMIRC_PROFILER['output_dir'], time.strftime('%Y%m%d-%H%M%S', time.localtime(profiler.started)), os.getpid())
+	try:
+		with open(path, 'w') as f:
+			f.write(profiler.report())
+	except IOError as e:
+		logger.error('could not write profile to %s: %s' % (path, e))
+		return
+	logger.info('profile written to %s, hottest functions: %s' % (path, profiler.summary()))
+
+def smircd_read_events(notifier):
+	notifier.read_events()
+	notifier.process_events()
+
+def smircd_reload(handler):
+	"""Reload the data that smircd keeps in memory (i.e. the area code index),
+	both in this process and in our worker processes.
+	"""
+	logger.info('reloading in-memory data')
+	AreaCode.load_index()
+	if handler.pool is not None:
+		handler.pool.signal(signal.SIGHUP)
+
 def smircd_sanity_check():
 	errors = 0
 
@@ -119,46 +619,128 @@ def smircd_sanity_check():
 				logger.error('inbound directory %s is not readable' % (settings.SMSTOOLS['inbound_dir']))
 				errors += 1
 
-	if not os.path.exists(settings.SMSTOOLS['outbound_dir']):
-		logger.error('outbound directory %s does not exist' % (settings.SMSTOOLS['outbound_dir']))
-		errors += 1
-	else:
-		if not os.path.isdir(settings.SMSTOOLS['outbound_dir']):
-			logger.error('outbound directory %s is not a directory' % (settings.SMSTOOLS['outbound_dir']))
+	for outbound_dir in sorted(set([q.outbound_dir for q in outbound_spool.outbound_queues])):
+		if not os.path.exists(outbound_dir):
+			logger.error('outbound directory %s does not exist' % (outbound_dir))
 			errors += 1
 		else:
-			if not os.access(settings.SMSTOOLS['outbound_dir'], os.W_OK):
-				logger.error('outbound directory %s is not writable' % (settings.SMSTOOLS['outbound_dir']))
+			if not os.path.isdir(outbound_dir):
+				logger.error('outbound directory %s is not a directory' % (outbound_dir))
 				errors += 1
+			else:
+				if not os.access(outbound_dir, os.W_OK):
+					logger.error('outbound directory %s is not writable' % (outbound_dir))
+					errors += 1
+				else:
+					# The staging directory is created at startup if it does not exist.
+					if os.path.exists(settings.SMSTOOLS['outbound_staging_dir']):
+						if not os.path.isdir(settings.SMSTOOLS['outbound_staging_dir']):
+							logger.error('outbound staging directory %s is not a directory' % (settings.SMSTOOLS['outbound_staging_dir']))
+							errors += 1
+						elif not os.access(settings.SMSTOOLS['outbound_staging_dir'], os.W_OK):
+							logger.error('outbound staging directory %s is not writable' % (settings.SMSTOOLS['outbound_staging_dir']))
+							errors += 1
+						elif os.stat(settings.SMSTOOLS['outbound_staging_dir']).st_dev != os.stat(outbound_dir).st_dev:
+							logger.error('outbound staging directory %s is not on the same filesystem as outbound directory %s' % (settings.SMSTOOLS['outbound_staging_dir'], outbound_dir))
+							errors += 1
+
+	# The claim directory (and our working directory in it) is created at startup if
+	# it does not exist.
+	if settings.SMSTOOLS['claim_dir'] is not None and os.path.exists(settings.SMSTOOLS['claim_dir']):
+		if not os.path.isdir(settings.SMSTOOLS['claim_dir']):
+			logger.error('claim directory %s is not a directory' % (settings.SMSTOOLS['claim_dir']))
+			errors += 1
+		elif not os.access(settings.SMSTOOLS['claim_dir'], os.W_OK):
+			logger.error('claim directory %s is not writable' % (settings.SMSTOOLS['claim_dir']))
+			errors += 1
+		elif os.path.exists(settings.SMSTOOLS['inbound_dir']) and os.stat(settings.SMSTOOLS['claim_dir']).st_dev != os.stat(settings.SMSTOOLS['inbound_dir']).st_dev:
+			logger.error('claim directory %s is not on the same filesystem as inbound directory %s' % (settings.SMSTOOLS['claim_dir'], settings.SMSTOOLS['inbound_dir']))
+			errors += 1
+
+	# The archive directory is created at startup if it does not exist.
+	if os.path.exists(settings.SMSTOOLS['archive_dir']):
+		if not os.path.isdir(settings.SMSTOOLS['archive_dir']):
+			logger.error('archive directory %s is not a directory' % (settings.SMSTOOLS['archive_dir']))
+			errors += 1
+		elif not os.access(settings.SMSTOOLS['archive_dir'], os.W_OK):
+			logger.error('archive directory %s is not writable' % (settings.SMSTOOLS['archive_dir']))
+			errors += 1
 
 	if errors > 0:
 		sys.exit(-2)
 	
+smircd_profiler = None
+smircd_reload_requested = False
 smircd_terminate = False
 
 if __name__ == '__main__':
 	logger.debug('settings.SMSTOOLS: %s', str(settings.SMSTOOLS))
 	smircd_sanity_check()
 
-	if not os.path.exists('%s/archived' % (settings.SMSTOOLS['inbound_dir'])):
-		os.mkdir('%s/archived' % (settings.SMSTOOLS['inbound_dir']))
+	if not os.path.exists(settings.SMSTOOLS['archive_dir']):
+		os.makedirs(settings.SMSTOOLS['archive_dir'])
+	if not os.path.exists(settings.SMIRC_STATS['stats_dir']):
+		os.makedirs(settings.SMIRC_STATS['stats_dir'])
+	if settings.SMIRC_STATS['count_queries']:
+		count_queries(pipeline_metrics)
+	pipeline_metrics.add_source('outbound_queues', outbound_spool.stats)
+	if not os.path.exists(settings.SMSTOOLS['outbound_staging_dir']):
+		os.mkdir(settings.SMSTOOLS['outbound_staging_dir'])
+
+	claims = None
+	if settings.SMSTOOLS['claim_dir'] is not None:
+		claims = InboundClaims(settings.SMSTOOLS['claim_dir'], node_name(), settings.SMSTOOLS['claim_lease_seconds'])
+		claims.setup()
+		logger.info('claiming inbound messages as node %s in %s' % (claims.node, claims.node_dir))
+		# Our caches must see the changes that the other nodes make.
+		membership_cache.share_generation_file('%s/membership_cache.generation' % (settings.SMSTOOLS['claim_dir']), settings.SMIRC_CACHE['generation_check_seconds'])
+		user_cache.share_generation_file('%s/user_cache.generation' % (settings.SMSTOOLS['claim_dir']), settings.SMIRC_CACHE['generation_check_seconds'])
+
+	AreaCode.load_index()
+	# Messages that were held (i.e. by the rate of their queue) when we last
+	# stopped are still in the staging directory; their inbound messages have
+	# been archived already, so they must not be lost.
+	outbound_spool.recover()
 
-	signal.signal(signal.SIGHUP, signal_handler)
-	signal.signal(signal.SIGINT, signal_handler)
-	signal.signal(signal.SIGTERM, signal_handler)
-	signal.signal(signal.SIGQUIT, signal_handler)
+	# Our workers are forked before we start any threads (see SMSWorkerPool).
+	pool = None
+	if settings.SMSTOOLS.get('worker_processes', 0) > 0:
+		pool = SMSWorkerPool(settings.SMSTOOLS['worker_processes'])
+		pool.start()
+	outbound_spool.start()
 
+	loop = EventLoop(settings.SMSTOOLS.get('executor_threads', 1), connection.close)
 	watch_manager = pyinotify.WatchManager()
-	sms_file_handler = SMSFileHandler()
+	sms_file_handler = SMSFileHandler(loop=loop, pool=pool, claims=claims)
+	for signum in [ signal.SIGINT, signal.SIGTERM, signal.SIGQUIT ]:
+		loop.add_signal_handler(signum, signal_handler, signum, None, loop)
+	loop.add_signal_handler(signal.SIGHUP, smircd_reload, sms_file_handler)
+	loop.add_signal_handler(signal.SIGUSR1, smircd_profile, sms_file_handler)
 	notifier = pyinotify.Notifier(watch_manager, sms_file_handler)
-	watch_manager.add_watch(settings.SMSTOOLS['inbound_dir'], pyinotify.EventsCodes.FLAG_COLLECTIONS['OP_FLAGS']['IN_MODIFY'])
-	
-	# TODO: deal with pre-existing files (i.e. files that have already been received and
-	# are sitting on our inbound directory right now.
-	while True:
-		notifier.process_events()
-		if smircd_terminate == True:
-			notifier.stop()
-			break
-		if notifier.check_events(timeout=500):
-			notifier.read_events()
+	notifier.coalesce_events()
+	watch_manager.add_watch(settings.SMSTOOLS['inbound_dir'], SMSFileHandler.EVENT_MASK)
+
+	# Deal with pre-existing files (i.e. files that were received while we were not
+	# running and are sitting in our inbound directory right now) before going live.
+	# The watch is added first so that nothing that arrives while the backlog is being
+	# drained is missed; those events are queued by the kernel until smircd_live.
+	loop.run_in_executor(drain_inbound_backlog, (sms_file_handler, loop), lambda _unused_result, _unused_exception: smircd_live(loop, watch_manager, notifier, sms_file_handler))
+	smircd_write_stats(loop)
+	if claims is not None:
+		# Our heartbeat starts before we drain our backlog (which may take a while),
+		# so that other nodes don't take over the claims that we are processing.
+		smircd_heartbeat(loop, sms_file_handler)
+	loop.run_forever()
+
+	if sms_file_handler.pool is not None:
+		sms_file_handler.pool.stop()
+	loop.close()
+	membership_activity.flush()
+	message_history.flush()
+	outbound_spool.stop()
+	inbound_archive.close()
+	pipeline_metrics.write(stats_path('smircd'))
+	if smircd_profiler is not None:
+		smircd_profiler.stop()
+	logger.info('cache statistics: %s, %s' % (membership_cache.stats(), user_cache.stats()))
+	notifier.stop()